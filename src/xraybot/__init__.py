@@ -1,11 +1,41 @@
-from ._xray_bot import XrayBot
-from ._worker import WorkerType
+from typing import TYPE_CHECKING
 from ._data import TestEntity, TestResultEntity, XrayResultType, WorkerResult
 from ._utils import logger
 
+if TYPE_CHECKING:
+    from ._xray_bot import XrayBot
+    from ._orchestrator import XrayBotOrchestrator
+    from ._worker import WorkerType
+    from ._resilience import RetryPolicy
+    from ._cassette import summarize_cassette
+
+# the bot modules import atlassian and requests, they are only imported on first
+# access, so `import xraybot` and the command line parsing stay fast
+_LAZY_ATTRS = {
+    "XrayBot": "._xray_bot",
+    "XrayBotOrchestrator": "._orchestrator",
+    "WorkerType": "._worker",
+    "RetryPolicy": "._resilience",
+    "summarize_cassette": "._cassette",
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRS:
+        import importlib
+
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 __all__ = [
     "XrayBot",
+    "XrayBotOrchestrator",
     "WorkerType",
+    "RetryPolicy",
+    "summarize_cassette",
     "TestEntity",
     "TestResultEntity",
     "XrayResultType",
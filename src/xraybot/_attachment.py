@@ -0,0 +1,104 @@
+import mimetypes
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class MultipartFileBody:
+    """
+    File-like multipart/form-data body of a single file, the file is read from
+    disk while the body is being sent instead of being loaded into memory.
+    """
+
+    def __init__(self, path: str, filename: str, field_name: str = "file"):
+        self.boundary = uuid.uuid4().hex
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        filename = filename.replace('"', "_")
+        self._head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file_size = os.path.getsize(path)
+        self._file = open(path, "rb")
+        self._head_pos = 0
+        self._tail_pos = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def read(self, size: int = -1) -> bytes:
+        # never read the whole file at once, even if asked to
+        size = size if 0 < size <= 1024 * 1024 else 1024 * 1024
+        if self._head_pos < len(self._head):
+            data = self._head[self._head_pos : self._head_pos + size]
+            self._head_pos += len(data)
+            return data
+        data = self._file.read(size)
+        if data:
+            return data
+        data = self._tail[self._tail_pos : self._tail_pos + size]
+        self._tail_pos += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class InFlightBudget:
+    """
+    Limit the concurrent uploads and the total bytes being uploaded, a file
+    larger than the whole budget is uploaded alone.
+    """
+
+    def __init__(
+        self, max_concurrency: int = 4, max_in_flight_bytes: int = 64 * 1024 * 1024
+    ):
+        self._cond = threading.Condition()
+        self._max_concurrency = max_concurrency
+        self._max_in_flight_bytes = max_in_flight_bytes
+        self._concurrency = 0
+        self._in_flight_bytes = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    def configure(self, max_concurrency: int, max_in_flight_bytes: int):
+        """
+        :param max_concurrency: int, max concurrent uploads
+        :param max_in_flight_bytes: int, max total size of the files being uploaded
+        """
+        with self._cond:
+            self._max_concurrency = max_concurrency
+            self._max_in_flight_bytes = max_in_flight_bytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, size: int) -> Iterator[None]:
+        with self._cond:
+            self._cond.wait_for(
+                lambda: (
+                    self._concurrency == 0
+                    or (
+                        self._concurrency < self._max_concurrency
+                        and self._in_flight_bytes + size <= self._max_in_flight_bytes
+                    )
+                )
+            )
+            self._concurrency += 1
+            self._in_flight_bytes += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._concurrency -= 1
+                self._in_flight_bytes -= size
+                self._cond.notify_all()
@@ -0,0 +1,162 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional
+from ._utils import logger, write_json
+
+PROJECT_ID = "project_id"
+CUSTOM_FIELDS = "custom_fields"
+FOLDERS = "folders"
+TEST_PLANS = "test_plans"
+TEST_EXECUTIONS = "test_executions"
+ISSUE_IDS = "issue_ids"
+COST_MODEL = "cost_model"
+
+# seconds each entry is trusted for, entries change more often from top to bottom
+DEFAULT_TTLS: Dict[str, float] = {
+    PROJECT_ID: 7 * 24 * 3600,
+    ISSUE_IDS: 7 * 24 * 3600,
+    CUSTOM_FIELDS: 24 * 3600,
+    TEST_PLANS: 24 * 3600,
+    TEST_EXECUTIONS: 24 * 3600,
+    FOLDERS: 3600,
+    COST_MODEL: 30 * 24 * 3600,
+}
+
+
+class MetadataCache:
+    """
+    On disk cache of the jira/xray metadata of one project, a new bot loads it
+    instead of querying the metadata again. Each entry expires after its ttl and
+    is dropped once a request using it fails.
+
+    Cached values are not checked against jira/xray when read, they are validated
+    on use: the cached folders and issue ids leading to a not found or validation
+    error are dropped and queried again, and the request retried once. Any other
+    value is trusted until its ttl expires or a run using it fails, the run then
+    invalidates the whole cache.
+
+    Changes are kept in memory and written by `flush`, called when the bot is
+    closed and when the process exits, instead of rewriting the file on each
+    change of the concurrent workers. Dropping all the entries is written at once.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        jira_url: str,
+        project_key: str,
+        ttls: Optional[Dict[str, float]] = None,
+    ):
+        """
+        :param cache_dir: str, directory of the cache files
+        :param jira_url: str, jira url the cache belongs to
+        :param project_key: str, jira project key the cache belongs to
+        :param ttls: seconds to trust each entry for, overriding `DEFAULT_TTLS`
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_key = hashlib.sha1(
+            f"{jira_url.rstrip('/')}|{project_key}".encode("utf-8")
+        ).hexdigest()
+        self._path = os.path.join(cache_dir, f"{cache_key}.json")
+        self._ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+                logger.info(f"Loaded metadata cache: {self._path}")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignore broken metadata cache {self._path}: {e}")
+        _open_caches.add(self)
+
+    def get(self, name: str) -> Any:
+        """
+        :return: the cached value, None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if time.time() - entry["stored_at"] >= self._ttls[name]:
+                return None
+            return entry["value"]
+
+    def put(self, name: str, value: Any):
+        with self._lock:
+            self._entries[name] = {"value": value, "stored_at": time.time()}
+            self._dirty = True
+
+    def update(self, name: str, values: Dict[str, Any]):
+        """
+        Merge the values into a dict entry, keeping the entry stored time.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or time.time() - entry["stored_at"] >= self._ttls[name]:
+                entry = {"value": {}, "stored_at": time.time()}
+                self._entries[name] = entry
+            if values.items() <= entry["value"].items():
+                return
+            entry["value"].update(values)
+            self._dirty = True
+
+    def discard(self, name: str, *keys: str):
+        """
+        Drop keys of a dict entry, e.g: a stale issue id.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            for key in keys:
+                if entry["value"].pop(key, None) is not None:
+                    self._dirty = True
+
+    def invalidate(self, *names: str):
+        """
+        :param names: entries to drop, all the entries are dropped if not specified
+        """
+        with self._lock:
+            self._dirty = True
+            if names:
+                for name in names:
+                    self._entries.pop(name, None)
+            else:
+                self._entries.clear()
+                # dropped after a failure, a process killed later never keeps them
+                self._flush()
+
+    def flush(self):
+        """
+        Write the changed entries to disk.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._dirty:
+            return
+        try:
+            write_json(self._path, self._entries)
+            self._dirty = False
+        except OSError as e:
+            # the cache only saves requests, never fail the bot for it
+            logger.warning(f"Failed to write metadata cache {self._path}: {e}")
+
+
+# caches flushed when the process exits, weakly referenced so one registered
+# hook never keeps the dropped caches alive
+_open_caches: "weakref.WeakSet[MetadataCache]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_caches():
+    for cache in list(_open_caches):
+        cache.flush()
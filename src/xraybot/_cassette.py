@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, TextIO
+from urllib.parse import urlparse
+import requests
+from requests.structures import CaseInsensitiveDict
+
+RECORD = "record"
+REPLAY = "replay"
+
+_RECORDED_RESPONSE_HEADERS = ("Content-Type",)
+
+
+def _request_key(request: requests.PreparedRequest) -> str:
+    body = request.body
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if isinstance(body, bytes):
+        try:
+            # the same json body could be serialized with another key order
+            body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+        except ValueError:
+            pass
+        digest = hashlib.sha1(body).hexdigest()
+    else:
+        # streamed bodies, e.g: attachments with a random multipart boundary
+        digest = ""
+    return f"{request.method} {request.url} {digest}"
+
+
+class Cassette:
+    """
+    Record the jira and xray exchanges of a bot with their latency into a
+    cassette file, one json object per line, or serve them back without network
+    access. Only the method, url and body of the requests are kept, never their
+    headers, so no credential is written.
+
+    When replaying, each request gets the responses recorded for the same method,
+    url and body in their recorded order, the last one is served again once
+    they are all served.
+    """
+
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0):
+        """
+        :param path: str, cassette file
+        :param mode: str, "record" or "replay"
+        :param latency_scale: float, replayed latency relative to the recorded
+        one, 0 replays without waiting
+        """
+        assert mode in (RECORD, REPLAY), f"Invalid cassette mode: {mode}"
+        self.path = path
+        self.mode = mode
+        self._latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._file: Optional[TextIO] = None
+        self._records: Dict[str, List[dict]] = {}
+        self._served: Counter = Counter()
+        if mode == RECORD:
+            self._file = open(path, "w", encoding="utf-8")
+        else:
+            for record in load_cassette(path):
+                self._records.setdefault(record["key"], []).append(record)
+
+    def record(
+        self,
+        request: requests.PreparedRequest,
+        response: requests.Response,
+        started: float,
+    ):
+        """
+        :param started: float, time.monotonic() before sending the request
+        """
+        # read the body here, so the latency includes the download
+        content = response.content
+        line = json.dumps(
+            {
+                "key": _request_key(request),
+                "method": request.method,
+                "url": request.url,
+                "started": started - self._started,
+                "elapsed": time.monotonic() - started,
+                "status": response.status_code,
+                "headers": {
+                    k: response.headers[k]
+                    for k in _RECORDED_RESPONSE_HEADERS
+                    if k in response.headers
+                },
+                "content": base64.b64encode(content).decode("ascii"),
+            }
+        )
+        with self._lock:
+            assert self._file is not None, "Cassette is closed"
+            self._file.write(f"{line}\n")
+            self._file.flush()
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        key = _request_key(request)
+        with self._lock:
+            records = self._records.get(key)
+            if not records:
+                raise AssertionError(f"No recorded response in {self.path}: {key}")
+            record = records[min(self._served[key], len(records) - 1)]
+            self._served[key] += 1
+        if self._latency_scale > 0:
+            time.sleep(record["elapsed"] * self._latency_scale)
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        response._content = base64.b64decode(record["content"])
+        response.encoding = "utf-8"
+        response.url = request.url or ""
+        response.request = request
+        return response
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_cassette(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_cassette(path: str) -> Dict[str, int]:
+    """
+    Count the requests of a cassette by method, host and path, e.g: to compare
+    the requests sent by two versions for the same sync.
+    """
+    counts: Counter = Counter()
+    for record in load_cassette(path):
+        url = urlparse(record["url"])
+        counts[f"{record['method']} {url.netloc}{url.path}"] += 1
+    return dict(counts.most_common())
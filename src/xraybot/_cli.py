@@ -0,0 +1,228 @@
+import argparse
+import dataclasses
+import json
+import os
+import sys
+from typing import Dict, List, Optional, TYPE_CHECKING
+from ._data import TestEntity, TestResultEntity, XrayResultType
+
+if TYPE_CHECKING:
+    from ._xray_bot import XrayBot
+
+# credentials are read from the environment by default, so they never show up
+# in the command lines of the CI logs
+_CREDENTIAL_ARGS = [
+    ("--jira-url", "XRAYBOT_JIRA_URL"),
+    ("--jira-username", "XRAYBOT_JIRA_USERNAME"),
+    ("--jira-pwd", "XRAYBOT_JIRA_PWD"),
+    ("--jira-account-id", "XRAYBOT_JIRA_ACCOUNT_ID"),
+    ("--project-key", "XRAYBOT_PROJECT_KEY"),
+    ("--xray-api-token", "XRAYBOT_XRAY_API_TOKEN"),
+]
+
+_JUNIT_TEST_KEY_PROPERTY = "test_key"
+
+
+def _load_tests(path: str) -> List[TestEntity]:
+    """
+    :param path: str, json file of a test list, or of a snapshot with a "tests" list
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data["tests"]
+    return [TestEntity(**t) for t in data]
+
+
+def _dump_tests(path: Optional[str], tests: List[TestEntity]):
+    content = json.dumps([dataclasses.asdict(t) for t in tests], indent=2)
+    if path is None:
+        print(content)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+def _load_junit_results(path: str) -> List[TestResultEntity]:
+    # test cases are mapped to xray tests by the `test_key` property, the worst
+    # result wins for test cases sharing a key
+    import xml.etree.ElementTree as ElementTree
+
+    priorities = [XrayResultType.PASSED, XrayResultType.TODO, XrayResultType.FAILED]
+    results: Dict[str, XrayResultType] = {}
+    for test_case in ElementTree.parse(path).getroot().iter("testcase"):
+        key = None
+        for prop in test_case.iter("property"):
+            if prop.get("name") == _JUNIT_TEST_KEY_PROPERTY:
+                key = prop.get("value")
+        if key is None:
+            continue
+        if test_case.find("failure") is not None or test_case.find("error") is not None:
+            result = XrayResultType.FAILED
+        elif test_case.find("skipped") is not None:
+            result = XrayResultType.TODO
+        else:
+            result = XrayResultType.PASSED
+        key = key.upper()
+        if key not in results or priorities.index(result) > priorities.index(
+            results[key]
+        ):
+            results[key] = result
+    return [TestResultEntity(key=k, result=v) for k, v in results.items()]
+
+
+def _load_results(path: str) -> List[TestResultEntity]:
+    """
+    :param path: str, junit xml file, or json file of [{"key": "KEY-1", "result": "PASSED"}]
+    """
+    if path.lower().endswith(".xml"):
+        return _load_junit_results(path)
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return [
+        TestResultEntity(key=r["key"], result=XrayResultType(r["result"])) for r in data
+    ]
+
+
+def _create_bot(args: argparse.Namespace) -> "XrayBot":
+    from ._xray_bot import XrayBot
+
+    credentials = []
+    for arg, env in _CREDENTIAL_ARGS:
+        value = getattr(args, arg[2:].replace("-", "_"))
+        assert value, f"Missing {arg} argument or {env} environment variable"
+        credentials.append(value)
+    bot = XrayBot(*credentials)
+    try:
+        for custom_field in args.custom_field:
+            name, sep, value = custom_field.partition("=")
+            assert sep, f"Custom field should be NAME=VALUE: {custom_field}"
+            values = value.split(",")
+            bot.configure_custom_field(name, values if len(values) > 1 else value)
+        if args.metadata_cache:
+            bot.configure_metadata_cache(args.metadata_cache)
+    except BaseException:
+        bot.close()
+        raise
+    return bot
+
+
+def _check(args: argparse.Namespace):
+    with _create_bot(args) as bot:
+        bot.sync_check(_load_tests(args.tests))
+
+
+def _sync(args: argparse.Namespace):
+    with _create_bot(args) as bot:
+        bot.sync_tests(
+            _load_tests(args.tests), journal_path=args.journal, resume=args.resume
+        )
+
+
+def _create_drafts(args: argparse.Namespace):
+    with _create_bot(args) as bot:
+        tests = bot.create_tests_draft(_load_tests(args.tests))
+    _dump_tests(args.output, tests)
+
+
+def _upload(args: argparse.Namespace):
+    with _create_bot(args) as bot:
+        test_plan_key, test_execution_key = bot.upload_test_results(
+            args.test_plan,
+            args.test_execution,
+            _load_results(args.results),
+            clean_obsolete=args.clean_obsolete,
+            full_test_set=args.full_test_set,
+            ignore_missing=args.ignore_missing,
+        )
+    print(
+        json.dumps({"test_plan": test_plan_key, "test_execution": test_execution_key})
+    )
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    for arg, env in _CREDENTIAL_ARGS:
+        common.add_argument(arg, default=os.environ.get(env), help=f"default: ${env}")
+    common.add_argument(
+        "--custom-field",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE[,VALUE]",
+        help="custom field of the tests, can be repeated",
+    )
+    common.add_argument(
+        "--metadata-cache",
+        default=os.environ.get("XRAYBOT_METADATA_CACHE"),
+        metavar="DIR",
+        help="directory of the metadata cache, default: $XRAYBOT_METADATA_CACHE",
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="xraybot", description="Synchronize xray tests and upload test results"
+    )
+    sub_parsers = parser.add_subparsers(dest="command", required=True)
+
+    check = sub_parsers.add_parser(
+        "check", parents=[common], help="check the local tests before syncing"
+    )
+    check.add_argument("tests", help="json file of the local tests")
+    check.set_defaults(func=_check)
+
+    sync = sub_parsers.add_parser(
+        "sync", parents=[common], help="sync the local tests to xray"
+    )
+    sync.add_argument("tests", help="json file of the local tests")
+    sync.add_argument("--journal", help="journal file to resume an interrupted sync")
+    sync.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume the sync from the journal, requires --journal",
+    )
+    sync.set_defaults(func=_sync)
+
+    create_drafts = sub_parsers.add_parser(
+        "create-drafts",
+        parents=[common],
+        help="create draft tests for the local tests without key",
+    )
+    create_drafts.add_argument("tests", help="json file of the local tests")
+    create_drafts.add_argument(
+        "-o", "--output", help="json file of the keyed tests, default: stdout"
+    )
+    create_drafts.set_defaults(func=_create_drafts)
+
+    upload = sub_parsers.add_parser(
+        "upload",
+        parents=[common],
+        help="upload test results to a test execution, without evidences",
+        description="Upload test results to a test execution and print the test "
+        "plan and test execution keys as json. Evidences are not uploaded, so not "
+        "reported either.",
+    )
+    upload.add_argument(
+        "results",
+        help=f"junit xml file with `{_JUNIT_TEST_KEY_PROPERTY}` test case properties, "
+        'or json file of [{"key": ..., "result": ...}]',
+    )
+    upload.add_argument("--test-plan", required=True, help="test plan name")
+    upload.add_argument("--test-execution", required=True, help="test execution name")
+    upload.add_argument("--clean-obsolete", action="store_true")
+    upload.add_argument("--full-test-set", action="store_true")
+    upload.add_argument("--ignore-missing", action="store_true")
+    upload.set_defaults(func=_upload)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "sync" and args.resume and args.journal is None:
+        # exits with the usage error, the sync would silently start over
+        parser.error("sync: --resume requires --journal")
+    try:
+        args.func(args)
+    except AssertionError as e:
+        print(f"xraybot {args.command} failed: {e}", file=sys.stderr)
+        return 1
+    return 0
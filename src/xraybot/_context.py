@@ -1,18 +1,115 @@
-from typing import List, Union, Dict
+import copy
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Union, Dict, Optional, Tuple, Any, Iterator
 from atlassian import Jira
 import requests
 import json
-from functools import cached_property
-from ._utils import logger
+from urllib.parse import urlparse
+from ._cassette import Cassette
+from ._cache import MetadataCache, CUSTOM_FIELDS, ISSUE_IDS, PROJECT_ID
+from ._data import TestEntity
+from ._resilience import (
+    CircuitBreaker,
+    CircuitBreakerAdapter,
+    ConcurrencyLimiter,
+    HostConcurrencyLimiter,
+    Retrier,
+    RetryPolicy,
+    XrayGraphQLError,
+)
+from ._scheduler import SharedExecutor
+from ._utils import logger, json_loads, synchronized_cached_property
 
+XRAY_URL = "https://xray.cloud.getxray.app/api/v2"
+
+DEFAULT_RETRY_OVERRIDES = {
+    # a new folder or a moved test could be unknown for a while, wait for it
+    "move_test_folder": RetryPolicy(
+        tries=10, base_delay=2, max_delay=5, retry_permanent=True
+    ),
+}
+
+
+def _create_http_session(
+    pool_size: int,
+    circuit_breaker: CircuitBreaker,
+    host_limiter: Optional[HostConcurrencyLimiter] = None,
+) -> requests.Session:
+    session = requests.Session()
+    adapter = CircuitBreakerAdapter(
+        circuit_breaker,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        host_limiter=host_limiter,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class _JiraFieldsMetadata:
+    """
+    Jira fields metadata, it only depends on the jira instance so it can be shared
+    between the bots of different projects.
+    """
 
-class _XrayBotConfig:
     def __init__(self, jira: Jira):
         self._jira: Jira = jira
+        self._metadata_cache: Optional[MetadataCache] = None
+        self._loaded_from_cache = False
+
+    def configure_metadata_cache(self, metadata_cache: MetadataCache):
+        self._metadata_cache = metadata_cache
+
+    @synchronized_cached_property
+    def all_custom_fields(self):
+        if self._metadata_cache is not None:
+            all_custom_fields = self._metadata_cache.get(CUSTOM_FIELDS)
+            if all_custom_fields is not None:
+                self._loaded_from_cache = True
+                return all_custom_fields
+        all_custom_fields = self._jira.get_all_custom_fields()
+        self._loaded_from_cache = False
+        if self._metadata_cache is not None:
+            self._metadata_cache.put(CUSTOM_FIELDS, all_custom_fields)
+        return all_custom_fields
+
+    @synchronized_cached_property
+    def custom_field_ids(self) -> Dict[str, str]:
+        # the first field wins for duplicated names, as the former linear lookup
+        return {f["name"]: f["id"] for f in reversed(self.all_custom_fields)}
+
+    def get_custom_field_id(self, name: str) -> Optional[str]:
+        field_id = self.custom_field_ids.get(name)
+        if field_id is None and self._loaded_from_cache:
+            # the cached fields could miss a newly created field, query them again
+            assert self._metadata_cache is not None
+            self._metadata_cache.invalidate(CUSTOM_FIELDS)
+            # popped instead of deleted, a concurrent caller could do it first
+            self.__dict__.pop("all_custom_fields", None)
+            self.__dict__.pop("custom_field_ids", None)
+            field_id = self.custom_field_ids.get(name)
+        return field_id
+
+
+class _XrayBotConfig:
+    def __init__(
+        self, jira: Jira, fields_metadata: Optional[_JiraFieldsMetadata] = None
+    ):
+        self._jira: Jira = jira
+        self._fields_metadata = (
+            fields_metadata
+            if fields_metadata is not None
+            else _JiraFieldsMetadata(jira)
+        )
         self._custom_fields: Dict[str, Union[str, List[str]]] = {}
+        self._tests_custom_fields_payload: Optional[dict] = None
         self._worker_num: int = 4
         self._automation_folder_name = "Automation Test"
         self._obsolete_automation_folder_name = "Obsolete"
+        self._test_index_ttl: float = 0
 
     def configure_worker_num(self, worker_num: int):
         self._worker_num = worker_num
@@ -23,6 +120,13 @@ class _XrayBotConfig:
     def configure_obsolete_automation_folder_name(self, folder_name: str):
         self._obsolete_automation_folder_name = folder_name
 
+    def configure_test_index_ttl(self, ttl: float):
+        """
+        :param ttl: float, seconds the xray tests listing and the test plan/execution
+        lookups are reused for, 0 disables the reuse
+        """
+        self._test_index_ttl = ttl
+
     @property
     def worker_num(self) -> int:
         return self._worker_num
@@ -35,13 +139,21 @@ class _XrayBotConfig:
     def obsolete_automation_folder_name(self) -> str:
         return self._obsolete_automation_folder_name
 
+    @property
+    def test_index_ttl(self) -> float:
+        return self._test_index_ttl
+
     @property
     def custom_fields(self):
         return self._custom_fields
 
-    @cached_property
+    @property
     def all_custom_fields(self):
-        return self._jira.get_all_custom_fields()
+        return self._fields_metadata.all_custom_fields
+
+    @property
+    def fields_metadata(self) -> _JiraFieldsMetadata:
+        return self._fields_metadata
 
     def configure_custom_field(
         self, field_name: str, field_value: Union[str, List[str]]
@@ -51,22 +163,132 @@ class _XrayBotConfig:
         :param field_value: custom field value of the test ticket
         e.g: field_value="value", field_value=["value1", "value2"]
         """
+        assert self.get_custom_field_by_name(field_name) is not None, (
+            f"Custom field not found: {field_name}"
+        )
         self._custom_fields[field_name] = field_value
+        self._tests_custom_fields_payload = None
+
+    def get_custom_field_by_name(self, name: str) -> Optional[str]:
+        return self._fields_metadata.get_custom_field_id(name)
+
+    def get_tests_custom_fields_payload(self) -> dict:
+        # computed once per custom fields configuration instead of once per test
+        if self._tests_custom_fields_payload is None:
+            fields: dict = {}
+            for k, v in self._custom_fields.items():
+                custom_field = self.get_custom_field_by_name(k)
+                if isinstance(v, list) and v:
+                    fields[custom_field] = [{"value": _} for _ in v]
+                else:
+                    fields[custom_field] = {"value": v}
+            self._tests_custom_fields_payload = fields
+        return self._tests_custom_fields_payload
+
+
+class _XrayTestIndex:
+    """
+    In-process index of the xray tests listing, test plan/execution keys and
+    jira issue ids, shared by the consecutive calls on one bot.
+    """
+
+    def __init__(self, config: _XrayBotConfig):
+        self._config = config
+        self._lock = threading.RLock()
+        self._tests: Optional[Dict[str, TestEntity]] = None
+        self._tests_filter: Optional[str] = None
+        self._tests_loaded_at: float = 0
+        self._test_plans: Dict[str, Tuple[str, float]] = {}
+        self._test_executions: Dict[str, Tuple[str, float]] = {}
+        self._issue_ids: Dict[str, str] = {}
+
+    def _is_fresh(self, loaded_at: float) -> bool:
+        return time.monotonic() - loaded_at < self._config.test_index_ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._tests = None
+            self._tests_filter = None
+            self._test_plans.clear()
+            self._test_executions.clear()
+            self._issue_ids.clear()
+
+    def get_tests(self, tests_filter: str) -> Optional[List[TestEntity]]:
+        with self._lock:
+            if (
+                self._tests is None
+                or self._tests_filter != tests_filter
+                or not self._is_fresh(self._tests_loaded_at)
+            ):
+                return None
+            return copy.deepcopy(list(self._tests.values()))
+
+    def put_tests(self, tests_filter: str, tests: List[TestEntity]):
+        if self._config.test_index_ttl <= 0:
+            return
+        with self._lock:
+            self._tests = {t.key: copy.deepcopy(t) for t in tests if t.key is not None}
+            self._tests_filter = tests_filter
+            self._tests_loaded_at = time.monotonic()
+
+    def upsert_tests(self, tests: List[TestEntity]):
+        with self._lock:
+            for test in tests:
+                if test.key is None:
+                    continue
+                if test.issue_id is not None:
+                    self._issue_ids[test.key] = test.issue_id
+                if self._tests is not None:
+                    self._tests[test.key] = copy.deepcopy(test)
+
+    def remove_tests(self, keys: List[str]):
+        with self._lock:
+            if self._tests is not None:
+                for key in keys:
+                    self._tests.pop(key, None)
+
+    def _get_named_key(
+        self, named_keys: Dict[str, Tuple[str, float]], name: str
+    ) -> Optional[str]:
+        with self._lock:
+            entry = named_keys.get(name)
+            if entry is None or not self._is_fresh(entry[1]):
+                return None
+            return entry[0]
+
+    def _put_named_keys(
+        self, named_keys: Dict[str, Tuple[str, float]], keys_by_name: Dict[str, str]
+    ):
+        if self._config.test_index_ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for name, key in keys_by_name.items():
+                named_keys[name] = (key, now)
+
+    def get_test_plan_key(self, test_plan_name: str) -> Optional[str]:
+        return self._get_named_key(self._test_plans, test_plan_name)
+
+    def put_test_plan_keys(self, keys_by_name: Dict[str, str]):
+        self._put_named_keys(self._test_plans, keys_by_name)
+
+    def get_test_execution_key(self, test_execution_name: str) -> Optional[str]:
+        return self._get_named_key(self._test_executions, test_execution_name)
+
+    def put_test_execution_keys(self, keys_by_name: Dict[str, str]):
+        self._put_named_keys(self._test_executions, keys_by_name)
 
-    def get_custom_field_by_name(self, name: str):
-        for f in self.all_custom_fields:
-            if f["name"] == name:
-                return f["id"]
+    def get_issue_id(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._issue_ids.get(key)
 
-    def get_tests_custom_fields_payload(self):
-        fields = dict()
-        for k, v in self._custom_fields.items():
-            custom_field = self.get_custom_field_by_name(k)
-            if isinstance(v, list) and v:
-                fields[custom_field] = [{"value": _} for _ in v]
-            else:
-                fields[custom_field] = {"value": v}
-        return fields
+    def put_issue_id(self, key: str, issue_id: str):
+        with self._lock:
+            self._issue_ids[key] = issue_id
+
+    def discard_issue_id(self, key: str):
+        with self._lock:
+            self._issue_ids.pop(key, None)
 
 
 class XrayBotContext:
@@ -79,37 +301,86 @@ class XrayBotContext:
         project_key: str,
         timeout: int,
         xray_api_token: str,
+        pool_size: int = 10,
+        jira: Optional[Jira] = None,
+        xray_session: Optional[requests.Session] = None,
+        fields_metadata: Optional[_JiraFieldsMetadata] = None,
+        concurrency_limiter: Optional[ConcurrencyLimiter] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        host_limiter: Optional[HostConcurrencyLimiter] = None,
     ):
-        self._jira: Jira = Jira(
-            url=jira_url,
-            username=jira_username,
-            password=jira_pwd,
-            timeout=timeout,
-            cloud=True,
+        """
+        The optional jira client, xray session, fields metadata, concurrency
+        limiter, circuit breaker and host limiter are passed in when they are
+        shared with the bots of other projects.
+        """
+        self._circuit_breaker = (
+            circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        )
+        # each host allows as many requests as the connection pool by default
+        self._host_limiter = (
+            host_limiter
+            if host_limiter is not None
+            else HostConcurrencyLimiter(pool_size)
+        )
+        self._jira: Jira = (
+            jira
+            if jira is not None
+            else Jira(
+                url=jira_url,
+                username=jira_username,
+                password=jira_pwd,
+                timeout=timeout,
+                cloud=True,
+                session=_create_http_session(
+                    pool_size, self._circuit_breaker, self._host_limiter
+                ),
+            )
         )
         self._jira_account_id: str = jira_account_id
-        self._xray_session = requests.Session()
         self._xray_api_token = xray_api_token
-        self._xray_session.headers.update(
-            {
-                "Authorization": f"Bearer {self._xray_api_token}",
-                "Content-Type": "application/json",
-            }
-        )
+        if xray_session is None:
+            xray_session = _create_http_session(
+                pool_size, self._circuit_breaker, self._host_limiter
+            )
+            xray_session.headers.update(
+                {
+                    "Authorization": f"Bearer {self._xray_api_token}",
+                    "Content-Type": "application/json",
+                }
+            )
+        self._xray_session: requests.Session = xray_session
         self._project_key: str = project_key
-        self._config = _XrayBotConfig(self._jira)
-        self._xray_url = "https://xray.cloud.getxray.app/api/v2"
+        self._config = _XrayBotConfig(self._jira, fields_metadata)
+        self._concurrency_limiter = concurrency_limiter
+        self._test_index = _XrayTestIndex(self._config)
+        self._metadata_cache: Optional[MetadataCache] = None
+        self._xray_url = XRAY_URL
+        self._executor = SharedExecutor(lambda: self._config.worker_num)
+        self._retrier = Retrier(
+            overrides=DEFAULT_RETRY_OVERRIDES, concurrency_limiter=concurrency_limiter
+        )
+        self._cassette: Optional[Cassette] = None
 
-    def execute_xray_graphql(self, payload):
-        """Execute a GraphQL query or mutation"""
+    def execute_xray_graphql(self, payload: str, variables: Optional[dict] = None):
+        """
+        Execute a GraphQL query or mutation
+        :param payload: str, GraphQL document
+        :param variables: dict, values of the document variables
+        """
         url = f"{self._xray_url}/graphql"
         logger.info("Executing GraphQL query")
-        response = self._xray_session.post(url, json={"query": payload})
+        body: Dict[str, Any] = {"query": payload}
+        if variables is not None:
+            body["variables"] = variables
+        response = self._xray_session.post(url, json=body)
         response.raise_for_status()
-        result = response.json()
+        # decode the raw bytes, avoiding the charset detection of response.json
+        result = json_loads(response.content)
         if "errors" in result:
-            raise AssertionError(
-                f"GraphQL error: {json.dumps(result['errors'], indent=2)}"
+            raise XrayGraphQLError(
+                f"GraphQL error: {json.dumps(result['errors'], indent=2)}",
+                result["errors"],
             )
         return result["data"]
 
@@ -125,6 +396,83 @@ class XrayBotContext:
     def jira(self) -> Jira:
         return self._jira
 
+    @property
+    def xray_session(self) -> requests.Session:
+        return self._xray_session
+
+    @property
+    def concurrency_limiter(self) -> Optional[ConcurrencyLimiter]:
+        return self._concurrency_limiter
+
+    @contextmanager
+    def concurrency_slot(self, held: bool = False) -> Iterator[None]:
+        """
+        Hold a slot of the concurrency limiter shared with the bots of other
+        projects, if any.
+        :param held: bool, the caller already holds a slot for this work, e.g: a
+        worker querying a listing, waiting for another slot could deadlock
+        """
+        if self._concurrency_limiter is None or held:
+            yield
+            return
+        with self._concurrency_limiter.hold():
+            yield
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        return self._circuit_breaker
+
+    @property
+    def host_limiter(self) -> HostConcurrencyLimiter:
+        return self._host_limiter
+
+    @property
+    def executor(self) -> SharedExecutor:
+        return self._executor
+
+    @property
+    def retrier(self) -> Retrier:
+        return self._retrier
+
+    def configure_host_concurrency(self, jira_limit: int, xray_limit: int):
+        """
+        :param jira_limit: int, max in-flight requests to the jira host
+        :param xray_limit: int, max in-flight requests to the xray host
+        """
+        self._host_limiter.configure(urlparse(self._jira.url).netloc, jira_limit)
+        self._host_limiter.configure(urlparse(self._xray_url).netloc, xray_limit)
+
+    def configure_cassette(self, path: str, mode: str, latency_scale: float = 1.0):
+        """
+        Record the jira and xray traffic into a cassette file, or replay it.
+        :param path: str, cassette file
+        :param mode: str, "record" or "replay"
+        :param latency_scale: float, replayed latency relative to the recorded one
+        """
+        cassette = Cassette(path, mode, latency_scale)
+        adapters = [
+            adapter
+            for session in (self._jira.session, self._xray_session)
+            for adapter in session.adapters.values()
+        ]
+        assert any(
+            isinstance(adapter, CircuitBreakerAdapter) for adapter in adapters
+        ), "Cassettes need the http sessions created by the bot"
+        for adapter in adapters:
+            if isinstance(adapter, CircuitBreakerAdapter):
+                adapter.cassette = cassette
+        if self._cassette is not None:
+            self._cassette.close()
+        self._cassette = cassette
+        logger.info(f"Cassette configured: {path}, mode: {mode}")
+
+    def close(self):
+        self._executor.shutdown()
+        if self._metadata_cache is not None:
+            self._metadata_cache.flush()
+        if self._cassette is not None:
+            self._cassette.close()
+
     @property
     def project_key(self) -> str:
         return self._project_key
@@ -133,6 +481,42 @@ class XrayBotContext:
     def config(self) -> _XrayBotConfig:
         return self._config
 
-    @cached_property
+    @property
+    def test_index(self) -> _XrayTestIndex:
+        return self._test_index
+
+    @property
+    def metadata_cache(self) -> Optional[MetadataCache]:
+        return self._metadata_cache
+
+    def configure_metadata_cache(
+        self, cache_dir: str, ttls: Optional[Dict[str, float]] = None
+    ):
+        """
+        :param cache_dir: str, directory of the cache files
+        :param ttls: seconds to trust each cached entry for
+        """
+        if self._metadata_cache is not None:
+            # replaced, keep the changes of the previous cache
+            self._metadata_cache.flush()
+        self._metadata_cache = MetadataCache(
+            cache_dir, self._jira.url, self._project_key, ttls
+        )
+        self._config.fields_metadata.configure_metadata_cache(self._metadata_cache)
+        for key, issue_id in (self._metadata_cache.get(ISSUE_IDS) or {}).items():
+            self._test_index.put_issue_id(key, issue_id)
+
+    def invalidate_metadata_cache(self):
+        if self._metadata_cache is not None:
+            self._metadata_cache.invalidate()
+
+    @synchronized_cached_property
     def project_id(self) -> int:
-        return self._jira.get_project(self._project_key)["id"]
+        if self._metadata_cache is not None:
+            project_id = self._metadata_cache.get(PROJECT_ID)
+            if project_id is not None:
+                return project_id
+        project_id = self._jira.get_project(self._project_key)["id"]
+        if self._metadata_cache is not None:
+            self._metadata_cache.put(PROJECT_ID, project_id)
+        return project_id
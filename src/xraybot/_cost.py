@@ -0,0 +1,112 @@
+import threading
+from typing import Dict, List, Sequence, Tuple
+from ._data import TestEntity
+
+
+def task_size(args: Sequence, operations: int = 0) -> float:
+    """
+    Size of a worker task from its args: the links of its tests and the items of
+    its lists, e.g: the issue ids of a chunk.
+    :param operations: int, requests the worker sends whatever its args
+    """
+    size = float(operations)
+    for arg in args:
+        if isinstance(arg, TestEntity):
+            size += len(arg.req_keys) + len(arg.defect_keys)
+        elif isinstance(arg, (list, tuple)):
+            size += len(arg)
+    return size
+
+
+class _LinearCostModel:
+    """
+    latency = base + per_unit * size, fitted by least squares over the observed
+    tasks, older observations fade out so the model follows the recent latency.
+    """
+
+    _DECAY = 0.98
+
+    def __init__(self):
+        # decayed sums of 1, x, x^2, y, x*y
+        self._n = 0.0
+        self._sx = 0.0
+        self._sxx = 0.0
+        self._sy = 0.0
+        self._sxy = 0.0
+
+    def observe(self, size: float, latency: float):
+        d = self._DECAY
+        self._n = self._n * d + 1
+        self._sx = self._sx * d + size
+        self._sxx = self._sxx * d + size * size
+        self._sy = self._sy * d + latency
+        self._sxy = self._sxy * d + size * latency
+
+    def coefficients(self) -> Tuple[float, float]:
+        if self._n == 0:
+            # nothing observed yet, every link costs as much as the task itself
+            return 1.0, 1.0
+        mean_y = self._sy / self._n
+        det = self._n * self._sxx - self._sx * self._sx
+        if det <= 1e-9:
+            # all the tasks had the same size so far
+            return mean_y, 0.0
+        per_unit = (self._n * self._sxy - self._sx * self._sy) / det
+        per_unit = max(per_unit, 0.0)
+        base = max(mean_y - per_unit * self._sx / self._n, 0.0)
+        return base, per_unit
+
+    def estimate(self, size: float) -> float:
+        base, per_unit = self.coefficients()
+        return base + per_unit * size
+
+    def dump(self) -> List[float]:
+        return [self._n, self._sx, self._sxx, self._sy, self._sxy]
+
+    def load(self, sums: Sequence[float]):
+        self._n, self._sx, self._sxx, self._sy, self._sxy = (float(_) for _ in sums)
+
+
+class WorkerCostModel:
+    """
+    Per worker type cost models, learning the latency of the tasks from their
+    size while the workers run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, _LinearCostModel] = {}
+
+    def estimate(self, worker_name: str, args: Sequence, operations: int = 0) -> float:
+        with self._lock:
+            model = self._models.setdefault(worker_name, _LinearCostModel())
+            return model.estimate(task_size(args, operations))
+
+    def observe(
+        self, worker_name: str, args: Sequence, latency: float, operations: int = 0
+    ):
+        with self._lock:
+            model = self._models.setdefault(worker_name, _LinearCostModel())
+            model.observe(task_size(args, operations), latency)
+
+    def dump(self) -> Dict[str, List[float]]:
+        """
+        :return: the fitted sums of each worker type, JSON serializable
+        """
+        with self._lock:
+            return {name: model.dump() for name, model in self._models.items()}
+
+    def load(self, state: Dict[str, List[float]]):
+        """
+        Restore the sums dumped by a previous run, the first tasks are then
+        ordered by the latency learned before instead of the default estimate.
+        """
+        with self._lock:
+            for name, sums in state.items():
+                model = _LinearCostModel()
+                try:
+                    model.load(sums)
+                except (TypeError, ValueError):
+                    # written by an incompatible version, learn it again
+                    continue
+                self._models[name] = model
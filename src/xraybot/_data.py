@@ -3,10 +3,16 @@ from enum import Enum
 from typing import List, Any, Optional
 
 
+# prefixes the message of a cancelled result
+CANCELLED_MARK = "⏹️"
+
+
 @dataclass
 class WorkerResult:
     success: bool
     data: Any
+    # unsuccessful as its work never ran
+    cancelled: bool = False
 
 
 @dataclass
@@ -50,3 +56,5 @@ class XrayResultType(Enum):
 class TestResultEntity:
     key: str
     result: XrayResultType
+    # paths of the evidence files, e.g: logs and screenshots
+    evidences: List[str] = field(default_factory=list)
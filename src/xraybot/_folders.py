@@ -0,0 +1,100 @@
+import threading
+from typing import Dict, List, Iterable
+from ._data import TestEntity
+
+
+def _get_parent_path(path: str) -> str:
+    return path.rsplit("/", 1)[0] or "/"
+
+
+class FolderModel:
+    """
+    In memory model of the xray repo folders, test counts are tracked as the
+    tests are moved, so the folders emptied by a sync are known without
+    querying the folders again.
+    """
+
+    def __init__(self, root_folder: dict):
+        """
+        :param root_folder: dict, the root folder returned by `getFolder`
+        """
+        self._lock = threading.Lock()
+        # direct tests count and sub folder paths of each folder path
+        self._tests_count: Dict[str, int] = {}
+        self._sub_folders: Dict[str, List[str]] = {}
+        self._test_folders: Dict[str, str] = {}
+        self._add_folders("/", root_folder.get("folders") or [])
+
+    def _add_folders(self, parent_path: str, folders: List[dict]):
+        self._sub_folders.setdefault(parent_path, [])
+        for folder in folders:
+            path = folder["path"]
+            self._sub_folders[parent_path].append(path)
+            self._tests_count[path] = folder["testsCount"]
+            self._add_folders(path, folder.get("folders") or [])
+
+    def track_tests(self, tests: Iterable[TestEntity], root_path: str):
+        """
+        Record the current folder of the tests, so their moves can be counted.
+        :param tests: tests with issue id and repo path
+        :param root_path: str, folder path the repo paths are relative to
+        """
+        with self._lock:
+            for test in tests:
+                if test.issue_id is not None:
+                    self._test_folders[test.issue_id] = "/".join(
+                        [root_path] + test.repo_path
+                    )
+
+    def add_folder(self, path: str):
+        with self._lock:
+            if path not in self._tests_count:
+                self._tests_count[path] = 0
+                self._sub_folders.setdefault(_get_parent_path(path), []).append(path)
+                self._sub_folders.setdefault(path, [])
+
+    def move_test(self, issue_id: str, path: str):
+        with self._lock:
+            old_path = self._test_folders.get(issue_id)
+            if old_path == path:
+                return
+            if old_path in self._tests_count:
+                self._tests_count[old_path] = max(self._tests_count[old_path] - 1, 0)
+            # an untracked test was outside the model, count it in its new folder only
+            self._tests_count[path] = self._tests_count.get(path, 0) + 1
+            self._test_folders[issue_id] = path
+
+    def remove_folders(self, paths: Iterable[str]):
+        with self._lock:
+            for path in paths:
+                self._tests_count.pop(path, None)
+                self._sub_folders.pop(path, None)
+                parent_sub_folders = self._sub_folders.get(_get_parent_path(path))
+                if parent_sub_folders and path in parent_sub_folders:
+                    parent_sub_folders.remove(path)
+
+    def get_empty_folders(
+        self, root_path: str, excluded_paths: Iterable[str] = ()
+    ) -> List[List[str]]:
+        """
+        Get all the folders under the root folder without any test in their
+        whole sub tree, excluded folders and their parents are never empty.
+        :return: empty folder paths grouped by depth, the deepest first
+        """
+        excluded = set(excluded_paths)
+        empty_by_depth: Dict[int, List[str]] = {}
+
+        def _count_tests(path: str, depth: int) -> int:
+            count = self._tests_count.get(path, 0)
+            for sub_path in self._sub_folders.get(path, []):
+                count += _count_tests(sub_path, depth + 1)
+            if path in excluded:
+                count += 1
+            if count == 0:
+                empty_by_depth.setdefault(depth, []).append(path)
+            return count
+
+        with self._lock:
+            for sub_path in self._sub_folders.get(root_path, []):
+                _count_tests(sub_path, 0)
+        return [empty_by_depth[_] for _ in sorted(empty_by_depth, reverse=True)]
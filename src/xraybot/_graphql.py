@@ -0,0 +1,304 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Any, List
+
+# all the values are passed as variables, so the documents never change and
+# never need escaping
+
+PAGE_SIZE = 100
+# max 25 resolvers, each page query contains 3 resolvers, so 8 pages per batch
+MAX_PAGES_PER_BATCH = 8
+# each folder deletion is a single resolver
+MAX_FOLDERS_PER_DELETE_BATCH = 20
+# test issue ids per add/remove tests mutation, larger requests are slow and
+# may be rejected
+MAX_TESTS_PER_MUTATION = 500
+
+
+@dataclass(frozen=True)
+class PagedQuery:
+    """
+    Query of a single page, `$start` is the page start variable which is
+    renamed for each aliased page of a batch document, `$limit` is the page size
+    shared by all the pages.
+    """
+
+    name: str
+    variables: str
+    selection: str
+
+
+GET_TESTS_TOTAL = """
+query ($jql: String, $projectId: String, $folder: FolderSearchInput) {
+    getTests(jql: $jql, testType: {name: "Automated"}, folder: $folder, projectId: $projectId, limit: 1) {
+        total
+    }
+}
+"""
+
+GET_TESTS_PAGE = PagedQuery(
+    name="getTests",
+    variables="$jql: String, $projectId: String, $folder: FolderSearchInput",
+    selection="""
+    getTests(jql: $jql, testType: {name: "Automated"}, folder: $folder, projectId: $projectId, limit: $limit, start: $start) {
+        results {
+            issueId
+            unstructured
+            folder {
+                path
+            }
+            jira(fields: ["key", "summary", "description", "labels", "issuelinks"])
+        }
+    }
+    """,
+)
+
+GET_TEST_PLANS_TOTAL = """
+query ($jql: String) {
+    getTestPlans(jql: $jql, limit: 1) {
+        total
+    }
+}
+"""
+
+GET_TEST_PLANS_PAGE = PagedQuery(
+    name="getTestPlans",
+    variables="$jql: String",
+    selection="""
+    getTestPlans(jql: $jql, limit: $limit, start: $start) {
+        results {
+            issueId
+            jira(fields: ["key", "summary"])
+        }
+    }
+    """,
+)
+
+GET_TEST_EXECUTIONS_TOTAL = """
+query ($jql: String) {
+    getTestExecutions(jql: $jql, limit: 1) {
+        total
+    }
+}
+"""
+
+GET_TEST_EXECUTIONS_PAGE = PagedQuery(
+    name="getTestExecutions",
+    variables="$jql: String",
+    selection="""
+    getTestExecutions(jql: $jql, limit: $limit, start: $start) {
+        results {
+            issueId
+            jira(fields: ["key", "summary"])
+        }
+    }
+    """,
+)
+
+GET_TEST_PLAN_TESTS_TOTAL = """
+query ($issueId: String) {
+    getTestPlan(issueId: $issueId) {
+        tests(limit: 1) {
+            total
+        }
+    }
+}
+"""
+
+GET_TEST_PLAN_TESTS_PAGE = PagedQuery(
+    name="getTestPlan",
+    variables="$issueId: String",
+    selection="""
+    getTestPlan(issueId: $issueId) {
+        tests(limit: $limit, start: $start) {
+            results {
+                issueId
+                jira(fields: ["key", "status"])
+            }
+        }
+    }
+    """,
+)
+
+GET_TEST_EXECUTION_TESTS_TOTAL = """
+query ($issueId: String) {
+    getTestExecution(issueId: $issueId) {
+        tests(limit: 1) {
+            total
+        }
+    }
+}
+"""
+
+GET_TEST_EXECUTION_TESTS_PAGE = PagedQuery(
+    name="getTestExecution",
+    variables="$issueId: String",
+    selection="""
+    getTestExecution(issueId: $issueId) {
+        tests(limit: $limit, start: $start) {
+            results {
+                issueId
+                jira(fields: ["key", "status"])
+            }
+        }
+    }
+    """,
+)
+
+GET_ROOT_FOLDER = """
+query ($projectId: String!) {
+    getFolder(projectId: $projectId, path: "/") {
+        name
+        path
+        testsCount
+        folders
+    }
+}
+"""
+
+CREATE_FOLDER = """
+mutation ($projectId: String, $path: String!) {
+    createFolder(projectId: $projectId, path: $path) {
+        folder {
+            name
+            path
+            testsCount
+        }
+        warnings
+    }
+}
+"""
+
+UPDATE_TEST_FOLDER = """
+mutation ($issueId: String!, $folderPath: String!) {
+    updateTestFolder(issueId: $issueId, folderPath: $folderPath)
+}
+"""
+
+UPDATE_TEST_TYPE = """
+mutation ($issueId: String!) {
+    updateTestType(issueId: $issueId, testType: {name: "Automated"}) {
+        issueId
+    }
+}
+"""
+
+UPDATE_UNSTRUCTURED_TEST_DEFINITION = """
+mutation ($issueId: String!, $unstructured: String!) {
+    updateUnstructuredTestDefinition(issueId: $issueId, unstructured: $unstructured) {
+        issueId
+        unstructured
+    }
+}
+"""
+
+CREATE_TEST = """
+mutation ($unstructured: String, $jira: JSON!) {
+    createTest(testType: {name: "Automated"}, unstructured: $unstructured, jira: $jira) {
+        test {
+            issueId
+            jira(fields: ["key"])
+        }
+    }
+}
+"""
+
+CREATE_TEST_PLAN = """
+mutation ($jira: JSON!) {
+    createTestPlan(jira: $jira) {
+        testPlan {
+            issueId
+            jira(fields: ["key"])
+        }
+    }
+}
+"""
+
+CREATE_TEST_EXECUTION = """
+mutation ($jira: JSON!) {
+    createTestExecution(jira: $jira) {
+        testExecution {
+            issueId
+            jira(fields: ["key"])
+        }
+    }
+}
+"""
+
+ADD_TEST_ENVIRONMENTS_TO_TEST_EXECUTION = """
+mutation ($issueId: String!, $testEnvironments: [String]!) {
+    addTestEnvironmentsToTestExecution(issueId: $issueId, testEnvironments: $testEnvironments) {
+        warning
+    }
+}
+"""
+
+ADD_TESTS_TO_TEST_EXECUTION = """
+mutation ($issueId: String!, $testIssueIds: [String]!) {
+    addTestsToTestExecution(issueId: $issueId, testIssueIds: $testIssueIds) {
+        warning
+    }
+}
+"""
+
+ADD_TESTS_TO_TEST_PLAN = """
+mutation ($issueId: String!, $testIssueIds: [String]!) {
+    addTestsToTestPlan(issueId: $issueId, testIssueIds: $testIssueIds) {
+        warning
+    }
+}
+"""
+
+ADD_TEST_EXECUTIONS_TO_TEST_PLAN = """
+mutation ($issueId: String!, $testExecIssueIds: [String]!) {
+    addTestExecutionsToTestPlan(issueId: $issueId, testExecIssueIds: $testExecIssueIds) {
+        warning
+    }
+}
+"""
+
+REMOVE_TESTS_FROM_TEST_EXECUTION = """
+mutation ($issueId: String!, $testIssueIds: [String]!) {
+    removeTestsFromTestExecution(issueId: $issueId, testIssueIds: $testIssueIds)
+}
+"""
+
+REMOVE_TESTS_FROM_TEST_PLAN = """
+mutation ($issueId: String!, $testIssueIds: [String]!) {
+    removeTestsFromTestPlan(issueId: $issueId, testIssueIds: $testIssueIds)
+}
+"""
+
+
+@lru_cache(maxsize=None)
+def build_batch_document(query: PagedQuery, page_count: int) -> str:
+    """
+    Alias the page query `page_count` times into one document, the document
+    only depends on the page count, so only a few distinct documents are sent.
+    """
+    start_variables = ", ".join(f"$start{i}: Int" for i in range(page_count))
+    pages = "".join(
+        f"page{i}: {query.selection.strip().replace('$start', f'$start{i}')}\n"
+        for i in range(page_count)
+    )
+    return f"query ({query.variables}, $limit: Int, {start_variables}) {{\n{pages}}}"
+
+
+@lru_cache(maxsize=None)
+def build_delete_folders_document(folder_count: int) -> str:
+    path_variables = ", ".join(f"$path{i}: String!" for i in range(folder_count))
+    deletions = "".join(
+        f"delete{i}: deleteFolder(projectId: $projectId, path: $path{i})\n"
+        for i in range(folder_count)
+    )
+    return f"mutation ($projectId: String, {path_variables}) {{\n{deletions}}}"
+
+
+def build_batch_variables(
+    variables: Dict[str, Any], page_starts: List[int]
+) -> Dict[str, Any]:
+    return {
+        **variables,
+        "limit": PAGE_SIZE,
+        **{f"start{i}": start for i, start in enumerate(page_starts)},
+    }
@@ -0,0 +1,150 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Set, Tuple
+from ._data import TestEntity
+from ._utils import logger
+
+# a resumed sync queries the xray tests again past this age, tests could have
+# been changed by others since the snapshot
+MAX_SNAPSHOT_AGE = 6 * 3600
+
+
+def test_fingerprint(test: TestEntity) -> str:
+    # same fields as TestEntity.__eq__, so an edited local test is synced again
+    data = dataclasses.asdict(test)
+    data.pop("issue_id")
+    for k in ("labels", "req_keys", "defect_keys"):
+        data[k] = sorted(data[k])
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SyncJournal:
+    """
+    Append only journal of a sync, one json record per line:
+    - the xray tests snapshot the sync is categorized against
+    - each completed per-test operation
+    """
+
+    def __init__(
+        self,
+        path: str,
+        project_key: str,
+        resume: bool = False,
+        max_snapshot_age: float = MAX_SNAPSHOT_AGE,
+    ):
+        """
+        :param path: str, journal file path
+        :param project_key: str, jira project key the journal belongs to
+        :param resume: bool, load the records of an interrupted sync instead of
+        starting a new journal
+        :param max_snapshot_age: float, seconds the snapshot of an interrupted sync
+        is trusted for, an older journal is started again
+        """
+        self._path = path
+        self._project_key = project_key
+        self._lock = threading.Lock()
+        self._completed: Set[Tuple[str, Optional[str], str]] = set()
+        self._snapshot: Optional[List[TestEntity]] = None
+        self._snapshot_at: Optional[float] = None
+        if resume and os.path.exists(path):
+            self._load()
+            if self._snapshot is not None and (
+                self._snapshot_at is None
+                or time.time() - self._snapshot_at > max_snapshot_age
+            ):
+                logger.warning(
+                    f"Journal snapshot is older than {max_snapshot_age}s, "
+                    f"start the sync again: {path}"
+                )
+                self._completed.clear()
+                self._snapshot = None
+                resume = False
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self):
+        with open(self._path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last record could be partially written when the sync died
+                    logger.warning(f"Ignore broken journal record: {line}")
+                    break
+                if record["type"] == "snapshot":
+                    assert record["project_key"] == self._project_key, (
+                        f"Journal {self._path} belongs to project {record['project_key']}, not {self._project_key}"
+                    )
+                    self._snapshot = [TestEntity(**t) for t in record["tests"]]
+                    self._snapshot_at = record.get("created_at")
+                elif record["type"] == "completed":
+                    self._completed.add(
+                        (record["operation"], record["key"], record["fingerprint"])
+                    )
+        logger.info(
+            f"Loaded {len(self._completed)} completed operations from journal: {self._path}"
+        )
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    @property
+    def snapshot(self) -> Optional[List[TestEntity]]:
+        return self._snapshot
+
+    def record_snapshot(self, tests: List[TestEntity]):
+        self._snapshot = tests
+        self._snapshot_at = time.time()
+        self._append(
+            {
+                "type": "snapshot",
+                "project_key": self._project_key,
+                "created_at": self._snapshot_at,
+                "tests": [dataclasses.asdict(t) for t in tests],
+            }
+        )
+
+    def is_completed(
+        self, operation: str, key: Optional[str], fingerprint: str
+    ) -> bool:
+        with self._lock:
+            return (operation, key, fingerprint) in self._completed
+
+    def completed_keys(self) -> Set[Optional[str]]:
+        with self._lock:
+            return set(key for _, key, __ in self._completed)
+
+    def retain_completed(self, predicate: Callable[[str, Optional[str], str], bool]):
+        """
+        Forget the completed operations not matching the predicate, they are run
+        again by the resumed sync.
+        :param predicate: callable, called with the operation, key and fingerprint
+        """
+        with self._lock:
+            self._completed = set(_ for _ in self._completed if predicate(*_))
+
+    def record_completed(self, operation: str, key: Optional[str], fingerprint: str):
+        self._append(
+            {
+                "type": "completed",
+                "operation": operation,
+                "key": key,
+                "fingerprint": fingerprint,
+            }
+        )
+        with self._lock:
+            self._completed.add((operation, key, fingerprint))
+
+    def close(self, remove: bool = False):
+        """
+        :param remove: bool, remove the journal file, e.g: the sync is finished
+        """
+        self._file.close()
+        if remove:
+            os.remove(self._path)
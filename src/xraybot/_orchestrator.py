@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from typing import Callable, Dict, List, Any, Optional, Iterable
+from atlassian import Jira
+from ._context import (
+    XRAY_URL,
+    XrayBotContext,
+    _JiraFieldsMetadata,
+    _create_http_session,
+)
+from ._data import TestEntity, TestResultEntity, WorkerResult
+from ._resilience import CircuitBreaker, ConcurrencyLimiter, HostConcurrencyLimiter
+from ._utils import logger
+from ._xray_bot import XrayBot
+
+
+class XrayBotOrchestrator:
+    """
+    Drive the bots of several jira projects in one process, the bots share
+    the jira client, the xray session, the jira fields metadata and a global
+    concurrency budget for their workers.
+    """
+
+    _JIRA_API_TIMEOUT = 75
+    _MAX_CONCURRENCY = 30
+
+    def __init__(
+        self,
+        jira_url: str,
+        jira_username: str,
+        jira_pwd: str,
+        jira_account_id: str,
+        xray_api_token: str,
+        max_concurrency: int = _MAX_CONCURRENCY,
+    ):
+        """
+        :param max_concurrency: int, max running workers and listing pages summed over
+        all the projects
+        """
+        self._jira_url = jira_url
+        self._jira_username = jira_username
+        self._jira_pwd = jira_pwd
+        self._jira_account_id = jira_account_id
+        self._xray_api_token = xray_api_token
+        self._max_concurrency = max_concurrency
+        # jira and xray hosts are shared, so are their circuits
+        self._circuit_breaker = CircuitBreaker()
+        self._host_limiter = HostConcurrencyLimiter(max_concurrency)
+        self._jira = Jira(
+            url=jira_url,
+            username=jira_username,
+            password=jira_pwd,
+            timeout=self._JIRA_API_TIMEOUT,
+            cloud=True,
+            session=_create_http_session(
+                max_concurrency, self._circuit_breaker, self._host_limiter
+            ),
+        )
+        self._xray_session = _create_http_session(
+            max_concurrency, self._circuit_breaker, self._host_limiter
+        )
+        self._xray_session.headers.update(
+            {
+                "Authorization": f"Bearer {xray_api_token}",
+                "Content-Type": "application/json",
+            }
+        )
+        self._fields_metadata = _JiraFieldsMetadata(self._jira)
+        self._concurrency_limiter = ConcurrencyLimiter(max_concurrency)
+        self._bots: Dict[str, XrayBot] = {}
+
+    def add_project(self, project_key: str) -> XrayBot:
+        """
+        :param project_key: str, jira project key, e.g: "TEST"
+        :return: the bot of the project, use it to configure the project specific
+        custom fields and folder names
+        """
+        if project_key not in self._bots:
+            context = XrayBotContext(
+                self._jira_url,
+                self._jira_username,
+                self._jira_pwd,
+                self._jira_account_id,
+                project_key,
+                timeout=self._JIRA_API_TIMEOUT,
+                xray_api_token=self._xray_api_token,
+                jira=self._jira,
+                xray_session=self._xray_session,
+                fields_metadata=self._fields_metadata,
+                concurrency_limiter=self._concurrency_limiter,
+                circuit_breaker=self._circuit_breaker,
+                host_limiter=self._host_limiter,
+            )
+            self._bots[project_key] = XrayBot._from_context(context)
+        return self._bots[project_key]
+
+    def get_bot(self, project_key: str) -> XrayBot:
+        assert project_key in self._bots, f"Project {project_key} is not added."
+        return self._bots[project_key]
+
+    def configure_host_concurrency(self, jira_limit: int, xray_limit: int):
+        """
+        :param jira_limit: int, max in-flight requests to the jira host, summed over
+        all the projects
+        :param xray_limit: int, max in-flight requests to the xray host, summed over
+        all the projects
+        """
+        self._host_limiter.configure(urlparse(self._jira_url).netloc, jira_limit)
+        self._host_limiter.configure(urlparse(XRAY_URL).netloc, xray_limit)
+
+    def close(self):
+        for bot in self._bots.values():
+            bot.close()
+
+    def __enter__(self) -> "XrayBotOrchestrator":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def project_keys(self) -> List[str]:
+        return list(self._bots.keys())
+
+    def run(
+        self,
+        func: Callable[[XrayBot], Any],
+        project_keys: Optional[Iterable[str]] = None,
+    ) -> Dict[str, WorkerResult]:
+        """
+        Run func with the bot of each project concurrently.
+        :param func: callable taking the project bot
+        :param project_keys: projects to run, all added projects by default
+        :return: result of each project, the data is the func return value on
+        success, otherwise the error message
+        """
+        project_keys = (
+            list(project_keys) if project_keys is not None else self.project_keys
+        )
+        bots = [self.get_bot(_) for _ in project_keys]
+
+        def _run(bot: XrayBot) -> WorkerResult:
+            try:
+                return WorkerResult(success=True, data=func(bot))
+            except Exception as e:
+                logger.info(f"Project [{bot.context.project_key}] raised error: {e}")
+                return WorkerResult(success=False, data=f"❌{e}")
+
+        # project level threads only wait on their workers, the requests are
+        # bounded by the shared concurrency limiter
+        with ThreadPoolExecutor(max(1, len(bots))) as executor:
+            results = list(executor.map(_run, bots))
+        return dict(zip(project_keys, results))
+
+    def sync_tests(
+        self, local_tests_by_project: Dict[str, List[TestEntity]]
+    ) -> Dict[str, WorkerResult]:
+        """
+        :param local_tests_by_project: local tests of each project key
+        """
+        for project_key in local_tests_by_project:
+            self.add_project(project_key)
+        return self.run(
+            lambda bot: bot.sync_tests(local_tests_by_project[bot.context.project_key]),
+            local_tests_by_project.keys(),
+        )
+
+    def upload_test_results(
+        self,
+        test_plan_name: str,
+        test_execution_name: str,
+        test_results_by_project: Dict[str, List[TestResultEntity]],
+        clean_obsolete: bool = False,
+        full_test_set: bool = False,
+        ignore_missing: bool = False,
+    ) -> Dict[str, WorkerResult]:
+        """
+        :param test_results_by_project: test results of each project key
+        :return: result of each project, the data is (test plan key, test execution key)
+        on success
+        """
+        for project_key in test_results_by_project:
+            self.add_project(project_key)
+        return self.run(
+            lambda bot: bot.upload_test_results(
+                test_plan_name,
+                test_execution_name,
+                test_results_by_project[bot.context.project_key],
+                clean_obsolete=clean_obsolete,
+                full_test_set=full_test_set,
+                ignore_missing=ignore_missing,
+            ),
+            test_results_by_project.keys(),
+        )
@@ -0,0 +1,431 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from ._cassette import Cassette, RECORD, REPLAY
+from ._utils import logger
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+
+# lower cased markers of the GraphQL errors a retry can succeed after, looked
+# up in the error classification/code and message
+_TRANSIENT_GRAPHQL_MARKERS = (
+    "throttl",
+    "rate limit",
+    "rate_limit",
+    "too many requests",
+    "too_many_requests",
+    "timeout",
+    "timed out",
+    "internal server error",
+    "internal_server_error",
+    "internal error",
+)
+
+
+class XrayGraphQLError(AssertionError):
+    """
+    Raised for the errors of a GraphQL response, returned with a 200 status.
+    """
+
+    def __init__(self, message: str, errors: List[Dict[str, Any]]):
+        super().__init__(message)
+        self.errors = errors
+
+    @property
+    def is_transient(self) -> bool:
+        """
+        Only the throttling, timeout and internal server errors are transient,
+        e.g: a validation or permission error fails the same way again.
+        """
+
+        def _is_transient(error: Dict[str, Any]) -> bool:
+            extensions = error.get("extensions") or {}
+            text = " ".join(
+                str(_)
+                for _ in (
+                    extensions.get("classification"),
+                    extensions.get("code"),
+                    error.get("message"),
+                )
+                if _
+            ).lower()
+            return any(_ in text for _ in _TRANSIENT_GRAPHQL_MARKERS)
+
+        return bool(self.errors) and all(
+            isinstance(_, dict) and _is_transient(_) for _ in self.errors
+        )
+
+
+def get_error_status_code(e: Exception) -> Optional[int]:
+    response = getattr(e, "response", None)
+    return response.status_code if response is not None else None
+
+
+def is_fatal_error(e: Exception) -> bool:
+    # nothing can succeed any more once the token is revoked or the circuit is open
+    return isinstance(e, CircuitOpenError) or get_error_status_code(e) == 401
+
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+FATAL = "fatal"
+
+
+def classify_error(e: Exception) -> str:
+    """
+    :return: FATAL if nothing can succeed any more, TRANSIENT if a retry can
+    succeed, PERMANENT if the same call always fails, e.g: a 400 response or an
+    assertion
+    """
+    if is_fatal_error(e):
+        return FATAL
+    if isinstance(e, XrayGraphQLError):
+        return TRANSIENT if e.is_transient else PERMANENT
+    status_code = get_error_status_code(e)
+    if status_code is not None:
+        return (
+            TRANSIENT if status_code in (408, 429) or status_code >= 500 else PERMANENT
+        )
+    if isinstance(
+        e, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)
+    ):
+        return TRANSIENT
+    return PERMANENT
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    :param tries: int, max calls including the first one
+    :param base_delay: float, seconds before the first retry, doubled for each
+    next retry
+    :param max_delay: float, max seconds between two calls
+    :param jitter: bool, wait a random time up to the delay, so the workers
+    failing together never retry together
+    :param retry_permanent: bool, also retry the permanent errors, for the calls
+    waiting for an eventually consistent state
+    """
+
+    tries: int = 3
+    base_delay: float = 1
+    max_delay: float = 30
+    jitter: bool = True
+    retry_permanent: bool = False
+
+    def get_delay(self, retry: int) -> float:
+        """
+        :param retry: int, retry number, starting from 1
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+NO_RETRY = RetryPolicy(tries=1)
+
+
+class RetryBudget:
+    """
+    Retries allowed in a run, proportional to the calls made, so retries never
+    multiply the load when most calls fail during an incident.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        """
+        :param ratio: float, retries allowed per call
+        :param min_retries: int, retries always allowed
+        """
+        self._lock = threading.Lock()
+        self._ratio = ratio
+        self._min_retries = min_retries
+        self._calls = 0
+        self._retries = 0
+
+    def record_call(self):
+        with self._lock:
+            self._calls += 1
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._retries >= self._min_retries + self._ratio * self._calls:
+                return False
+            self._retries += 1
+            return True
+
+    def reset(self):
+        with self._lock:
+            self._calls = 0
+            self._retries = 0
+
+
+class ConcurrencyLimiter:
+    """
+    Limit the running workers and listing pages of all the bots sharing it. A
+    thread holds a slot while it works and gives it back while it sleeps before
+    a retry, nested holds of a thread share its slot.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._local = threading.local()
+
+    @property
+    def is_held(self) -> bool:
+        return getattr(self._local, "depth", 0) > 0
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._semaphore.acquire()
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self._semaphore.release()
+
+    def sleep(self, seconds: float):
+        if not self.is_held:
+            time.sleep(seconds)
+            return
+        self._semaphore.release()
+        try:
+            time.sleep(seconds)
+        finally:
+            self._semaphore.acquire()
+
+
+class Retrier:
+    """
+    Call operations with the retry policy of their name, spending the shared
+    retry budget of the run.
+    """
+
+    def __init__(
+        self,
+        default_policy: RetryPolicy = RetryPolicy(),
+        overrides: Optional[Dict[str, RetryPolicy]] = None,
+        budget: Optional[RetryBudget] = None,
+        concurrency_limiter: Optional[ConcurrencyLimiter] = None,
+    ):
+        """
+        :param concurrency_limiter: the slot of the calling thread is given back
+        while it sleeps before a retry
+        """
+        self.default_policy = default_policy
+        self.overrides: Dict[str, RetryPolicy] = dict(overrides or {})
+        self.budget = budget if budget is not None else RetryBudget()
+        self._concurrency_limiter = concurrency_limiter
+
+    def get_policy(self, operation: str) -> RetryPolicy:
+        return self.overrides.get(operation, self.default_policy)
+
+    def call(
+        self,
+        operation: str,
+        func: Callable[[], Any],
+        policy: Optional[RetryPolicy] = None,
+    ) -> Any:
+        """
+        Call func until it succeeds, the fatal errors, the permanent errors and
+        the errors once the budget is spent are raised without retrying.
+        :param operation: str, operation name the policy is looked up by
+        :param policy: the policy to use instead of the operation policy
+        """
+        policy = policy if policy is not None else self.get_policy(operation)
+        retry = 0
+        while True:
+            self.budget.record_call()
+            try:
+                return func()
+            except Exception as e:
+                kind = classify_error(e)
+                if (
+                    retry + 1 >= policy.tries
+                    or kind == FATAL
+                    or (kind == PERMANENT and not policy.retry_permanent)
+                ):
+                    raise
+                if not self.budget.try_spend():
+                    logger.warning(f"Retry budget exhausted, not retrying {operation}")
+                    raise
+                retry += 1
+                delay = policy.get_delay(retry)
+                logger.warning(
+                    f"{operation} failed with {kind} error: {e}, retrying in {delay:.1f} seconds..."
+                )
+                if self._concurrency_limiter is not None:
+                    self._concurrency_limiter.sleep(delay)
+                else:
+                    time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Per host circuit breaker, a host circuit opens on an authentication error
+    or on consecutive server errors, requests to an open host fail immediately
+    until the reset timeout elapses.
+    """
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 60):
+        self._lock = threading.Lock()
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._open_reasons: Dict[str, str] = {}
+
+    def configure(self, failure_threshold: int, reset_timeout: float):
+        """
+        :param failure_threshold: int, consecutive server errors opening a host circuit
+        :param reset_timeout: float, seconds before an open host is tried again
+        """
+        with self._lock:
+            self._failure_threshold = failure_threshold
+            self._reset_timeout = reset_timeout
+
+    def _open(self, host: str, reason: str):
+        if host not in self._opened_at:
+            logger.error(f"Circuit opened for host {host}: {reason}")
+        self._opened_at[host] = time.monotonic()
+        self._open_reasons[host] = reason
+
+    def _is_host_open(self, host: str) -> bool:
+        opened_at = self._opened_at.get(host)
+        if opened_at is None:
+            return False
+        if time.monotonic() - opened_at >= self._reset_timeout:
+            # half open, the next failure opens the circuit again
+            del self._opened_at[host]
+            self._failures[host] = self._failure_threshold - 1
+            return False
+        return True
+
+    def check(self, host: str):
+        with self._lock:
+            if self._is_host_open(host):
+                raise CircuitOpenError(
+                    f"Circuit is open for host {host}: {self._open_reasons[host]}"
+                )
+
+    def record_response(self, host: str, status_code: int):
+        with self._lock:
+            if status_code == 401:
+                self._open(host, "authentication failed")
+            elif status_code >= 500:
+                self._record_failure(host, f"HTTP {status_code}")
+            else:
+                self._failures[host] = 0
+
+    def record_connection_error(self, host: str, e: Exception):
+        with self._lock:
+            self._record_failure(host, str(e))
+
+    def _record_failure(self, host: str, reason: str):
+        self._failures[host] = self._failures.get(host, 0) + 1
+        if self._failures[host] >= self._failure_threshold:
+            self._open(
+                host, f"{self._failures[host]} consecutive failures, last: {reason}"
+            )
+
+    @property
+    def open_hosts(self) -> List[str]:
+        with self._lock:
+            return [host for host in list(self._opened_at) if self._is_host_open(host)]
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+            self._opened_at.clear()
+            self._open_reasons.clear()
+
+
+class HostConcurrencyLimiter:
+    """
+    Limit the in-flight requests of each host, whichever thread pool sends them.
+    """
+
+    def __init__(self, default_limit: Optional[int] = None):
+        """
+        :param default_limit: int, limit of the hosts without their own limit,
+        unlimited if not specified
+        """
+        self._cond = threading.Condition()
+        self._default_limit = default_limit
+        self._limits: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+
+    def configure(self, host: str, limit: int):
+        """
+        :param host: str, host with port if not default, e.g: "foo.atlassian.net"
+        :param limit: int, max in-flight requests to the host
+        """
+        assert limit > 0, f"Invalid concurrency limit of {host}: {limit}"
+        with self._cond:
+            self._limits[host] = limit
+            self._cond.notify_all()
+
+    def _has_slot(self, host: str) -> bool:
+        limit = self._limits.get(host, self._default_limit)
+        return limit is None or self._in_flight.get(host, 0) < limit
+
+    @contextmanager
+    def acquire(self, host: str) -> Iterator[None]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._has_slot(host))
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight[host] -= 1
+                self._cond.notify_all()
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    def __init__(
+        self,
+        circuit_breaker: CircuitBreaker,
+        *args,
+        host_limiter: Optional[HostConcurrencyLimiter] = None,
+        **kwargs,
+    ):
+        self._circuit_breaker = circuit_breaker
+        self._host_limiter = host_limiter
+        # records the exchanges, or serves the recorded ones instead of sending
+        self.cassette: Optional[Cassette] = None
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        host = urlparse(request.url).netloc
+        self._circuit_breaker.check(host)
+        if self._host_limiter is None:
+            return self._send(host, request, *args, **kwargs)
+        with self._host_limiter.acquire(host):
+            return self._send(host, request, *args, **kwargs)
+
+    def _send(self, host: str, request, *args, **kwargs):
+        cassette = self.cassette
+        started = time.monotonic()
+        try:
+            if cassette is not None and cassette.mode == REPLAY:
+                response = cassette.replay(request)
+            else:
+                response = super().send(request, *args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self._circuit_breaker.record_connection_error(host, e)
+            raise
+        if cassette is not None and cassette.mode == RECORD:
+            cassette.record(request, response, started)
+        self._circuit_breaker.record_response(host, response.status_code)
+        return response
@@ -0,0 +1,219 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+from ._data import WorkerResult, CANCELLED_MARK
+from ._utils import logger
+
+
+class _Task:
+    def __init__(
+        self, name: str, func: Callable[[], Any], deps: List[str], after: List[str]
+    ):
+        self.name = name
+        self.func = func
+        self.deps = deps + after
+        # the task fails without running only if one of these fails
+        self.required_deps = set(deps)
+        self.waiting_deps = set(self.deps)
+
+
+class DependencyScheduler:
+    """
+    Run tasks as soon as their dependencies succeed instead of running them in
+    barrier separated batches. Tasks can be added before `run` or by other
+    running tasks, a task depending on a failed task fails without running,
+    a task only ordered after a failed task still runs.
+
+    The scheduler only tracks the dependencies, the tasks run on the shared
+    executor, submitted by the thread calling `run` in the order they get ready.
+    """
+
+    def __init__(self, executor: "SharedExecutor"):
+        self._executor = executor
+        self._lock = threading.Condition()
+        self._tasks: Dict[str, _Task] = {}
+        self._results: Dict[str, WorkerResult] = {}
+        self._dependents: Dict[str, List[str]] = {}
+        self._ready: Deque[_Task] = deque()
+        self._running = 0
+
+    def add(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        deps: Iterable[str] = (),
+        after: Iterable[str] = (),
+    ):
+        """
+        :param name: str, unique task name, other tasks depend on it by the name
+        :param func: callable without args, the task fails if it raises or returns
+        an unsuccessful WorkerResult
+        :param deps: names of the tasks to wait for
+        :param after: names of the tasks to wait for, whether they succeed or not
+        """
+        with self._lock:
+            assert name not in self._tasks, f"Duplicated task: {name}"
+            task = _Task(name, func, list(deps), list(after))
+            self._tasks[name] = task
+            for dep in task.deps:
+                self._dependents.setdefault(dep, []).append(name)
+                if dep in self._results:
+                    self._resolve_dep(task, dep)
+            if not task.waiting_deps and name not in self._results:
+                self._set_ready(task)
+
+    def _resolve_dep(self, task: _Task, dep: str):
+        task.waiting_deps.discard(dep)
+        if (
+            dep in task.required_deps
+            and not self._results[dep].success
+            and task.name not in self._results
+        ):
+            self._finish(
+                task.name,
+                WorkerResult(
+                    success=False,
+                    data=f"{CANCELLED_MARK} Dependency {dep} failed -> 🐛{task.name}",
+                    cancelled=True,
+                ),
+            )
+
+    def _set_ready(self, task: _Task):
+        self._ready.append(task)
+        self._lock.notify_all()
+
+    def _run_task(self, task: _Task):
+        try:
+            ret = task.func()
+            result = (
+                ret
+                if isinstance(ret, WorkerResult)
+                else WorkerResult(success=True, data=ret)
+            )
+        except Exception as e:
+            logger.info(f"Task [{task.name}] raised error: {e}")
+            result = WorkerResult(success=False, data=f"❌{e} -> 🐛{task.name}")
+        with self._lock:
+            self._running -= 1
+            self._finish(task.name, result)
+            self._lock.notify_all()
+
+    def _finish(self, name: str, result: WorkerResult):
+        self._results[name] = result
+        for dependent_name in self._dependents.get(name, []):
+            dependent = self._tasks[dependent_name]
+            if dependent_name in self._results:
+                continue
+            self._resolve_dep(dependent, name)
+            if not dependent.waiting_deps and dependent_name not in self._results:
+                self._set_ready(dependent)
+
+    def run(self) -> Dict[str, WorkerResult]:
+        """
+        Run all the tasks until no task is running or runnable.
+        :return: result of each task by name
+        """
+        while True:
+            with self._lock:
+                while not self._ready and self._running > 0:
+                    self._lock.wait()
+                if not self._ready:
+                    break
+                ready = list(self._ready)
+                self._ready.clear()
+                self._running += len(ready)
+            # submitted without the lock, a task could run inline and finish
+            for task in ready:
+                self._executor.submit(self._run_task, task)
+        with self._lock:
+            for task in self._tasks.values():
+                if task.name not in self._results:
+                    missing = ", ".join(sorted(task.waiting_deps))
+                    self._results[task.name] = WorkerResult(
+                        success=False,
+                        data=f"❌Missing dependency {missing} -> 🐛{task.name}",
+                    )
+            return dict(self._results)
+
+
+class SharedExecutor:
+    """
+    Long-lived thread pool shared by the workers, the scheduled tasks and the
+    paged listings of a bot, instead of a new pool per call. A call submitted
+    from a pool thread is queued only if a thread is left for it, otherwise it
+    runs in the submitting thread, so a task waiting for its own sub tasks never
+    waits for a free thread of the pool it occupies.
+    """
+
+    def __init__(self, get_worker_num: Callable[[], int]):
+        """
+        :param get_worker_num: callable returning the pool size, read once the
+        pool is started
+        """
+        self._get_worker_num = get_worker_num
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._worker_num = 0
+        # calls queued or running in the pool
+        self._pending = 0
+        self._local = threading.local()
+
+    def _start_executor(self) -> ThreadPoolExecutor:
+        # called with the lock held
+        if self._executor is None:
+            self._worker_num = self._get_worker_num()
+            self._executor = ThreadPoolExecutor(
+                self._worker_num, thread_name_prefix="xraybot"
+            )
+        return self._executor
+
+    def _release(self, _future: "Future[Any]"):
+        with self._lock:
+            self._pending -= 1
+
+    def _run_in_pool(self, func: Callable[..., Any], *args) -> Any:
+        self._local.in_pool = True
+        try:
+            return func(*args)
+        finally:
+            self._local.in_pool = False
+
+    def submit(self, func: Callable[..., Any], *args) -> "Future[Any]":
+        in_pool = getattr(self._local, "in_pool", False)
+        with self._lock:
+            executor = self._start_executor()
+            queued = not in_pool or self._pending < self._worker_num
+            if queued:
+                self._pending += 1
+        if not queued:
+            future: "Future[Any]" = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        try:
+            future = executor.submit(self._run_in_pool, func, *args)
+        except BaseException:
+            self._release(Future())
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def map(self, func: Callable[..., Any], *iterables) -> List[Any]:
+        """
+        :return: results in the input order, the first error is raised
+        """
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return [_.result() for _ in futures]
+
+    def shutdown(self):
+        """
+        Wait for the running tasks and stop the threads, the pool is started
+        again on the next call.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,101 @@
+import dataclasses
+import json
+import zlib
+from typing import List, Dict, Any
+from ._data import TestEntity
+from ._utils import write_json
+
+
+PARTITION_BY_KEY = "key"
+PARTITION_BY_REPO_PATH = "repo_path"
+
+
+def _get_partition_value(test: TestEntity, partition_by: str) -> str:
+    if partition_by == PARTITION_BY_KEY:
+        assert test.key is not None, f"Local test {test} requires key in sync"
+        return test.key.upper()
+    elif partition_by == PARTITION_BY_REPO_PATH:
+        # keep each top level repo folder in a single shard, so shards do not
+        # create the same sub folders
+        return test.repo_path[0] if test.repo_path else ""
+    else:
+        raise AssertionError(f"Unsupported partition: {partition_by}")
+
+
+def get_shard_index(test: TestEntity, shard_count: int, partition_by: str) -> int:
+    # crc32 is stable across processes, unlike the builtin hash
+    value = _get_partition_value(test, partition_by)
+    return zlib.crc32(value.encode("utf-8")) % shard_count
+
+
+def partition_tests(
+    tests: List[TestEntity], shard_count: int, partition_by: str = PARTITION_BY_KEY
+) -> List[List[TestEntity]]:
+    assert shard_count > 0, "Shard count must be positive"
+    shards: List[List[TestEntity]] = [[] for _ in range(shard_count)]
+    for test in tests:
+        shards[get_shard_index(test, shard_count, partition_by)].append(test)
+    return shards
+
+
+def dump_tests(path: str, project_key: str, tests: List[TestEntity]):
+    write_json(
+        path,
+        {
+            "project_key": project_key,
+            "tests": [dataclasses.asdict(t) for t in tests],
+        },
+    )
+
+
+def load_tests(path: str, project_key: str) -> List[TestEntity]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["project_key"] == project_key, (
+        f"Snapshot {path} belongs to project {data['project_key']}, not {project_key}"
+    )
+    return [TestEntity(**t) for t in data["tests"]]
+
+
+def write_shard_manifest(
+    path: str,
+    project_key: str,
+    shard_index: int,
+    shard_count: int,
+    partition_by: str,
+    keys: List[str],
+    errors: List[str],
+):
+    write_json(
+        path,
+        {
+            "project_key": project_key,
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+            "partition_by": partition_by,
+            "keys": keys,
+            "errors": errors,
+        },
+    )
+
+
+def read_shard_manifests(paths: List[str], project_key: str) -> List[Dict[str, Any]]:
+    manifests = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            manifests.append(json.load(f))
+    assert manifests, "No shard manifest to merge"
+    for manifest in manifests:
+        assert manifest["project_key"] == project_key, (
+            f"Shard manifest of project {manifest['project_key']} cannot be merged into {project_key}"
+        )
+    shard_counts = set(_["shard_count"] for _ in manifests)
+    assert len(shard_counts) == 1, f"Inconsistent shard counts: {shard_counts}"
+    partitions = set(_["partition_by"] for _ in manifests)
+    assert len(partitions) == 1, f"Inconsistent partitions: {partitions}"
+    shard_count = shard_counts.pop()
+    shard_indexes = sorted(_["shard_index"] for _ in manifests)
+    assert shard_indexes == list(range(shard_count)), (
+        f"Expect manifests of all {shard_count} shards, got shards: {shard_indexes}"
+    )
+    return manifests
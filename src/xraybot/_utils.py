@@ -1,17 +1,168 @@
+import atexit
+import json
 import logging
-from typing import List
+import logging.handlers
+import os
+import queue
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
 import sys
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+T = TypeVar("T")
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s - %(message)s"
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class _EventRateFilter(logging.Filter):
+    """
+    Keep at most `max_per_second` records of each event every second, the
+    number of dropped records is appended to the next kept one. Records without
+    event and warnings are never dropped.
+    """
+
+    def __init__(self, max_per_second: int):
+        super().__init__()
+        self._max_per_second = max_per_second
+        self._lock = threading.Lock()
+        # event -> [window start second, kept in window, dropped since last kept]
+        self._windows: Dict[str, List[int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        with self._lock:
+            window = self._windows.setdefault(event, [second, 0, 0])
+            if window[0] != second:
+                window[0], window[1] = second, 0
+            if window[1] >= self._max_per_second:
+                window[2] += 1
+                return False
+            window[1] += 1
+            dropped, window[2] = window[2], 0
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar events dropped)"
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue never leaves the process, format in the listener thread
+        # instead of the worker threads
+        return record
+
 
 class Logger(logging.RootLogger):
     def __init__(self):
         super().__init__(logging.INFO)
         handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter("%(asctime)s %(levelname)s - %(message)s")
+        formatter = logging.Formatter(_LOG_FORMAT)
         handler.setFormatter(formatter)
         self.handlers = []
         self.addHandler(handler)
         self.propagate = False
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._sync_handlers: List[logging.Handler] = []
+        self._sync_formatters: List[Optional[logging.Formatter]] = []
+        atexit.register(self.stop_async)
+
+    def event(self, event: str, msg: str, *args, level: int = logging.INFO, **fields):
+        """
+        Log a structured event, the message is %-formatted only if the record is
+        emitted, e.g: logger.event("test_update", "Start updating test: %s", key)
+        :param event: str, event name, the records of an event can be rate limited
+        :param fields: extra fields of the json formatted records
+        """
+        if self.isEnabledFor(level):
+            self._log(level, msg, args, extra={"event": event, "fields": fields})
+
+    def start_async(
+        self, max_events_per_second: Optional[int] = None, json_format: bool = False
+    ):
+        """
+        Hand the records to a background thread writing them, so the worker
+        threads never wait for the output or the formatting.
+        :param max_events_per_second: int, max records of each event per second,
+        e.g: the per test messages, all records are kept if not specified
+        :param json_format: bool, write one json object per record
+        """
+        self.stop_async()
+        self._sync_handlers = self.handlers
+        self._sync_formatters = [_.formatter for _ in self.handlers]
+        if json_format:
+            for handler in self._sync_handlers:
+                handler.setFormatter(_JsonFormatter())
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        queue_handler = _LazyQueueHandler(log_queue)
+        if max_events_per_second is not None:
+            queue_handler.addFilter(_EventRateFilter(max_events_per_second))
+        self._listener = logging.handlers.QueueListener(
+            log_queue, *self._sync_handlers, respect_handler_level=True
+        )
+        self._listener.start()
+        self.handlers = [queue_handler]
+
+    def stop_async(self):
+        """
+        Write the queued records and log synchronously again.
+        """
+        if self._listener is None:
+            return
+        self.handlers = self._sync_handlers
+        self._listener.stop()
+        self._listener = None
+        for handler, formatter in zip(self.handlers, self._sync_formatters):
+            handler.setFormatter(formatter)
+
+
+class Truncated:
+    """
+    Lazily formatted list keeping only the first items, for large payloads in
+    log messages, e.g: logger.info("Removing: %s", Truncated(issue_ids))
+    """
+
+    def __init__(self, items: Sequence[Any], limit: int = 10):
+        self._items = items
+        self._limit = limit
+
+    def __str__(self) -> str:
+        if len(self._items) <= self._limit:
+            return str(list(self._items))
+        shown = ", ".join(str(_) for _ in self._items[: self._limit])
+        return f"[{shown}, ... (+{len(self._items) - self._limit} more)]"
 
 
 logger = Logger()
@@ -42,52 +193,98 @@ def build_repo_hierarchy(paths: List[List[str]]) -> List[dict]:
     return root
 
 
-def dict_to_graphql_param(d: dict, multilines_keys: List[str] = []) -> str:
+def json_loads(data: Union[bytes, str]) -> Any:
+    # orjson is an optional dependency, it decodes large responses several
+    # times faster and builds smaller intermediate objects
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def write_json(path: str, data: Any):
+    # write to a temporary file firstly, readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def jira_key_order(key: Optional[str]) -> Tuple[str, int]:
+    """
+    Sort key of a jira key, the same order as `order by key` in jql: by the
+    project key, then by the issue number, e.g: "KEY-9" < "KEY-10".
     """
-    Convert a Python dict to GraphQL parameter string format.
+    assert key is not None, "Jira key cannot be None"
+    project_key, sep, number = key.rpartition("-")
+    assert sep and number.isdigit(), f"Invalid jira key: {key}"
+    return project_key, int(number)
 
-    Example:
-        >>> dict_to_graphql_param({"summary": "Exploratory Test", "project": {"key": "CALC"}})
-        '{ summary:"Exploratory Test", project: {key: "CALC"} }'
 
-    Args:
-        d: Dictionary to convert
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
 
-    Returns:
-        GraphQL parameter string
+
+class SingleFlight:
+    """
+    Concurrent calls for the same key share one in-flight call, the callers
+    arriving while it runs wait for its result or its error.
     """
-    assert isinstance(d, dict), f"Expected dict, got {type(d).__name__}"
-
-    def format_value(key, value):
-        """Format a single value for GraphQL."""
-        if value is None:
-            return "null"
-        elif isinstance(value, bool):
-            return "true" if value else "false"
-        elif isinstance(value, (int, float)):
-            return str(value)
-        elif isinstance(value, str):
-            # Escape quotes in strings
-            if len(value.splitlines()) > 1 or key in multilines_keys:
-                return f'"""\n{value}\n"""'
-            else:
-                escaped = value.replace('"', '\\"')
-                return f'"{escaped}"'
-        elif isinstance(value, dict):
-            return dict_to_graphql_param(value)
-        elif isinstance(value, (list, tuple)):
-            # Format list as GraphQL array
-            items = ", ".join(format_value(None, item) for item in value)
-            return f"[{items}]"
-        else:
-            # Fallback: convert to string and quote it
-            return f'"{str(value)}"'
-
-    # Format key-value pairs
-    pairs = []
-    for key, value in d.items():
-        formatted_value = format_value(key, value)
-        pairs.append(f"{key}: {formatted_value}")
-
-    # Join pairs with comma and space, wrap in braces
-    return "{" + ", ".join(pairs) + "}"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class synchronized_cached_property(Generic[T]):
+    """
+    Same as functools.cached_property, while the threads accessing an uncached
+    value at the same time wait for a single computation, per instance.
+    """
+
+    def __init__(self, func: Callable[[Any], T]):
+        self.func = func
+        self.attrname = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name: str):
+        self.attrname = name
+
+    def __get__(self, instance, owner=None) -> T:
+        if instance is None:
+            return self  # type: ignore[return-value]
+        cache = instance.__dict__
+        if self.attrname in cache:
+            return cache[self.attrname]
+        lock = cache.setdefault(f"_{self.attrname}_lock", threading.Lock())
+        with lock:
+            if self.attrname in cache:
+                return cache[self.attrname]
+            value = self.func(instance)
+            cache[self.attrname] = value
+            return value
@@ -0,0 +1,315 @@
+import copy
+import hashlib
+import hmac
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+from ._data import TestEntity
+from ._utils import logger
+
+ISSUE_EVENTS = ("jira:issue_created", "jira:issue_updated")
+ISSUE_DELETED_EVENT = "jira:issue_deleted"
+LINK_EVENTS = ("issuelink_created", "issuelink_deleted")
+SIGNATURE_HEADER = "X-Hub-Signature"
+
+
+class XrayTestMirror:
+    """
+    In-memory copy of the automated xray tests, updated test by test and
+    numbering each change, so readers can ask what changed since their cursor.
+    """
+
+    def __init__(self, max_changes: int = 100000):
+        """
+        :param max_changes: int, changes kept for `changes_since`, older cursors
+        have to read all the tests again
+        """
+        self._lock = threading.Lock()
+        self._tests: Optional[Dict[str, TestEntity]] = None
+        self._cursor = 0
+        self._changes: Deque[Tuple[int, str]] = deque(maxlen=max_changes)
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self._tests is not None
+
+    @property
+    def cursor(self) -> int:
+        with self._lock:
+            return self._cursor
+
+    def _record_change(self, key: str):
+        self._cursor += 1
+        self._changes.append((self._cursor, key))
+
+    def get_tests(self) -> Optional[List[TestEntity]]:
+        """
+        :return: copy of the tests, None until the first reconciliation
+        """
+        with self._lock:
+            if self._tests is None:
+                return None
+            return copy.deepcopy(list(self._tests.values()))
+
+    def get_test(self, key: str) -> Optional[TestEntity]:
+        with self._lock:
+            test = self._tests.get(key) if self._tests is not None else None
+            return copy.deepcopy(test)
+
+    def find_key(self, issue_id: str) -> Optional[str]:
+        with self._lock:
+            for test in (self._tests or {}).values():
+                if test.issue_id == issue_id:
+                    return test.key
+            return None
+
+    def upsert(self, test: TestEntity):
+        assert test.key is not None, "Jira test key cannot be None"
+        with self._lock:
+            if self._tests is None or self._tests.get(test.key) == test:
+                return
+            self._tests[test.key] = copy.deepcopy(test)
+            self._record_change(test.key)
+
+    def remove(self, key: str):
+        with self._lock:
+            if self._tests is None or self._tests.pop(key, None) is None:
+                return
+            self._record_change(key)
+
+    def _keys_changed_since(self, cursor: int) -> Optional[Set[str]]:
+        if cursor >= self._cursor:
+            return set()
+        if not self._changes or self._changes[0][0] > cursor + 1:
+            return None
+        return set(key for seq, key in self._changes if seq > cursor)
+
+    def replace(
+        self, tests: List[TestEntity], queried_at: Optional[int] = None
+    ) -> Tuple[int, Set[str]]:
+        """
+        Replace all the tests, only the differences are recorded as changes.
+        :param queried_at: int, cursor when the tests started being queried, the
+        tests upserted or removed since then are newer than the queried ones and
+        are kept
+        :return: number of changed tests, keys kept as newer than the queried tests
+        """
+        new_tests = {t.key: copy.deepcopy(t) for t in tests if t.key is not None}
+        with self._lock:
+            old_tests = self._tests or {}
+            kept: Set[str] = set()
+            if queried_at is not None and self._tests is not None:
+                newer_keys = self._keys_changed_since(queried_at)
+                if newer_keys is None:
+                    logger.warning(
+                        "Too many changes while querying the tests, replace them all"
+                    )
+                else:
+                    kept = newer_keys
+            for key in kept:
+                if key in old_tests:
+                    new_tests[key] = old_tests[key]
+                else:
+                    new_tests.pop(key, None)
+            changed = [
+                key
+                for key in new_tests.keys() | old_tests.keys()
+                if new_tests.get(key) != old_tests.get(key)
+            ]
+            self._tests = new_tests
+            for key in sorted(changed):
+                self._record_change(key)
+            return len(changed), kept
+
+    def changes_since(self, cursor: int) -> Tuple[int, Optional[List[str]]]:
+        """
+        :param cursor: int, cursor returned by the previous call, 0 at first
+        :return: the new cursor and the keys of the changed tests, the changed keys
+        are None if the cursor is older than the kept changes
+        """
+        with self._lock:
+            if self._keys_changed_since(cursor) is None:
+                return self._cursor, None
+            keys = list(
+                dict.fromkeys(key for seq, key in self._changes if seq > cursor)
+            )
+            return self._cursor, keys
+
+
+class XrayWebhookReceiver:
+    """
+    Receive the jira issue and issue link webhooks of the test issues, each
+    notified test is queried again from xray and updated in the mirror. All the
+    tests are queried again every reconcile interval, correcting missed events.
+    """
+
+    def __init__(
+        self,
+        query_tests: Callable[[], List[TestEntity]],
+        query_test: Callable[[str], Optional[TestEntity]],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        secret: Optional[str] = None,
+        reconcile_interval: float = 3600,
+    ):
+        """
+        :param query_tests: callable querying all the automated tests
+        :param query_test: callable querying one automated test by key or issue id,
+        returning None if it is not an automated test anymore
+        :param host: str, host to listen on
+        :param port: int, port to listen on, a free port is picked if 0
+        :param secret: str, webhook secret, the requests are checked against their
+        `X-Hub-Signature` header if specified
+        :param reconcile_interval: float, seconds between full reconciliations
+        """
+        self.mirror = XrayTestMirror()
+        self._query_tests = query_tests
+        self._query_test = query_test
+        self._secret = secret
+        self._reconcile_interval = reconcile_interval
+        self._stopped = threading.Event()
+        self._pending_cond = threading.Condition()
+        self._pending: Set[str] = set()
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def server_address(self) -> Tuple[str, int]:
+        host, port = self._server.server_address[:2]
+        return str(host), int(port)
+
+    def start(self):
+        for target in (
+            self._server.serve_forever,
+            self._refresh_loop,
+            self._reconcile_loop,
+        ):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Webhook receiver listening on: {self.server_address}")
+
+    def stop(self):
+        self._stopped.set()
+        with self._pending_cond:
+            self._pending_cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def reconcile(self):
+        logger.info("Start reconciling the xray tests mirror")
+        # webhooks keep updating the mirror while the tests are being queried
+        queried_at = self.mirror.cursor
+        changed, kept = self.mirror.replace(self._query_tests(), queried_at)
+        if kept:
+            # the kept tests are refreshed again, their events could be older than
+            # the query
+            self._queue_refresh(list(kept))
+        logger.info(
+            f"Reconciled the xray tests mirror, {changed} tests changed, "
+            f"{len(kept)} tests updated meanwhile to refresh"
+        )
+
+    def verify_signature(self, body: bytes, signature: Optional[str]) -> bool:
+        if self._secret is None:
+            return True
+        if signature is None:
+            return False
+        expected = hmac.new(self._secret.encode("utf-8"), body, hashlib.sha256)
+        return hmac.compare_digest(f"sha256={expected.hexdigest()}", signature)
+
+    def handle_event(self, payload: dict):
+        """
+        Queue the tests notified by a webhook payload to be queried again.
+        """
+        event = payload.get("webhookEvent")
+        if event in ISSUE_EVENTS or event == ISSUE_DELETED_EVENT:
+            issue = payload.get("issue") or {}
+            issue_type = (issue.get("fields") or {}).get("issuetype") or {}
+            if issue_type.get("name", "Test") != "Test" or "key" not in issue:
+                return
+            if event == ISSUE_DELETED_EVENT:
+                self.mirror.remove(issue["key"])
+            else:
+                self._queue_refresh([issue["key"]])
+        elif event in LINK_EVENTS:
+            link = payload.get("issueLink") or {}
+            # either side could be the test, a non test issue is never found
+            self._queue_refresh(
+                [
+                    str(link[_])
+                    for _ in ("sourceIssueId", "destinationIssueId")
+                    if link.get(_) is not None
+                ]
+            )
+
+    def _queue_refresh(self, issues: List[str]):
+        with self._pending_cond:
+            self._pending.update(issues)
+            self._pending_cond.notify_all()
+
+    def _refresh_loop(self):
+        while True:
+            with self._pending_cond:
+                self._pending_cond.wait_for(
+                    lambda: self._pending or self._stopped.is_set()
+                )
+                if self._stopped.is_set():
+                    return
+                issue = self._pending.pop()
+            try:
+                self._refresh(issue)
+            except Exception as e:
+                # the next reconciliation corrects the test
+                logger.warning(f"Failed to refresh test {issue} from webhook: {e}")
+
+    def _refresh(self, issue: str):
+        test = self._query_test(issue)
+        if test is not None:
+            self.mirror.upsert(test)
+            return
+        key = issue if not issue.isdigit() else self.mirror.find_key(issue)
+        if key is not None:
+            self.mirror.remove(key)
+
+    def _reconcile_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.warning(f"Failed to reconcile the xray tests mirror: {e}")
+            self._stopped.wait(self._reconcile_interval)
+
+    def _build_handler(self):
+        receiver = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not receiver.verify_signature(
+                    body, self.headers.get(SIGNATURE_HEADER)
+                ):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                receiver.handle_event(payload)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"Webhook receiver: {format % args}")
+
+        return _Handler
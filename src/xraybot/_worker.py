@@ -1,21 +1,79 @@
-import requests
-from functools import lru_cache
 from abc import abstractmethod
+from dataclasses import dataclass
 from enum import Enum
+from functools import partial
 import json
-from typing import List, Optional, Tuple
-from retry import retry
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Dict, Callable, Any, Iterator, TypeVar
 from atlassian.rest_client import HTTPError
-from concurrent.futures import ThreadPoolExecutor
-from ._data import TestEntity, WorkerResult, TestResultEntity
-from ._utils import logger, build_repo_hierarchy, dict_to_graphql_param
+from ._data import TestEntity, WorkerResult, TestResultEntity, CANCELLED_MARK
+from ._utils import (
+    logger,
+    build_repo_hierarchy,
+    jira_key_order,
+    synchronized_cached_property,
+    SingleFlight,
+    Truncated,
+)
+from . import _graphql
 from ._context import XrayBotContext
-from functools import cached_property
+from ._cache import COST_MODEL, FOLDERS, ISSUE_IDS, TEST_EXECUTIONS, TEST_PLANS
+from ._folders import FolderModel
+from ._attachment import InFlightBudget, MultipartFileBody
+from ._resilience import PERMANENT, classify_error, is_fatal_error
+from ._cost import WorkerCostModel, task_size
+
+T = TypeVar("T")
+
+# keys per jql search looking up issue ids, a search page holds 100 issues
+MAX_KEYS_PER_ISSUE_ID_SEARCH = 100
+ISSUE_SEARCH_URL = "rest/api/3/search/jql"
+BULK_EDIT_FIELDS_URL = "rest/api/3/bulk/issues/fields"
+BULK_QUEUE_URL = "rest/api/3/bulk/queue"
+# jira accepts at most 1000 issues per bulk edit
+MAX_ISSUES_PER_BULK_EDIT = 1000
+BULK_EDIT_TIMEOUT = 600
+_BULK_TASK_PENDING_STATUSES = ("ENQUEUED", "RUNNING", "CANCEL_REQUESTED")
+
+
+def _xray_test_to_entity(issue: dict) -> TestEntity:
+    desc = issue["jira"]["description"]
+    links = issue["jira"]["issuelinks"]
+    return TestEntity(
+        key=issue["jira"]["key"],
+        unique_identifier=issue["unstructured"],
+        summary=issue["jira"]["summary"],
+        description=desc if desc is not None else "",
+        labels=issue["jira"]["labels"],
+        repo_path=issue["folder"]["path"].split("/")[2:],
+        req_keys=[
+            _["outwardIssue"]["key"]
+            for _ in links
+            if _["type"]["name"] == "Test" and _.get("outwardIssue")
+        ],
+        defect_keys=[
+            _["outwardIssue"]["key"]
+            for _ in links
+            if _["type"]["name"] == "Defect" and _.get("outwardIssue")
+        ],
+        issue_id=issue["issueId"],
+    )
 
 
 class _XrayAPIWrapper:
     def __init__(self, context: XrayBotContext):
         self.context = context
+        # tracks the folder test counts while tests are moved by a sync
+        self.folder_model: Optional[FolderModel] = None
+        self._folders_from_cache = False
+        # shared with `all_folders`, so a refresh never races its computation
+        self._all_folders_lock = threading.Lock()
+        self.attachment_budget = InFlightBudget()
+        # concurrent workers look up the same test plan/execution issue id
+        self._issue_id_flights = SingleFlight()
 
     def prepare_repo_folder_hierarchy(self, test_entities: List[TestEntity]):
         self.init_automation_folder()
@@ -39,71 +97,165 @@ class _XrayAPIWrapper:
         self.create_repo_folder(
             f"{self.context.config.automation_folder_name}/{self.context.config.obsolete_automation_folder_name}"
         )
-        # ensure all_folders is refreshed
-        del self.all_folders
+        # ensure all_folders is refreshed, the created folders already dropped
+        # the cached ones
+        self.refresh_all_folders(invalidate_cache=False)
+
+    def _get_paged_results(
+        self,
+        total_query: str,
+        page_query: _graphql.PagedQuery,
+        variables: Dict[str, Any],
+        get_total: Callable[[dict], int],
+        get_results: Callable[[dict], List[dict]],
+        convert: Callable[[dict], Any] = lambda _: _,
+    ) -> List[Any]:
+        # the pages run in other threads, they share the slot of a caller worker
+        held = self.context.concurrency_limiter is not None and (
+            self.context.concurrency_limiter.is_held
+        )
+        with self.context.concurrency_slot(held):
+            total = get_total(self.context.execute_xray_graphql(total_query, variables))
+        pages = total // _graphql.PAGE_SIZE + 1
+
+        def _worker(batch_start):
+            batch_end = min(batch_start + _graphql.MAX_PAGES_PER_BATCH, pages)
+            logger.debug(
+                f"Start getting {page_query.name} from page {batch_start} to {batch_end}"
+            )
+            page_starts = [
+                page * _graphql.PAGE_SIZE for page in range(batch_start, batch_end)
+            ]
+            with self.context.concurrency_slot(held):
+                batch_results = self.context.execute_xray_graphql(
+                    _graphql.build_batch_document(page_query, len(page_starts)),
+                    _graphql.build_batch_variables(variables, page_starts),
+                )
+            # convert in the page worker, the page dicts are released as soon
+            # as the batch is converted instead of being held for all pages
+            return [
+                convert(result)
+                for page in batch_results.values()
+                for result in get_results(page)
+            ]
+
+        all_results: List[Any] = []
+        for batch in self.context.executor.map(
+            _worker, range(0, pages, _graphql.MAX_PAGES_PER_BATCH)
+        ):
+            all_results.extend(batch)
+        return all_results
+
+    def _get_xray_tests_variables(
+        self, repo_folder: str, customized_field_jql: str
+    ) -> Dict[str, Any]:
+        jql = f"project = '{self.context.project_key}' and type = 'Test' and status != 'Obsolete' and reporter = '{self.context.jira_username}'{customized_field_jql}"
+        return {
+            "jql": jql,
+            "projectId": self.context.project_id,
+            "folder": {"path": f"/{repo_folder}", "includeDescendants": True},
+        }
 
     def get_xray_tests_by_repo_folder(
         self, repo_folder: str, customized_field_jql: str = ""
-    ):
-        jql = f"project = '{self.context.project_key}' and type = 'Test' and status != 'Obsolete' and reporter = '{self.context.jira_username}'{customized_field_jql}"
-        get_test_param = f'jql: "{jql}", testType: {{name: "Automated"}}, folder: {{path: "/{repo_folder}", includeDescendants: true}}, projectId: "{self.context.project_id}"'
-        payload = f"""
-        {{
-            getTests({get_test_param}, limit: 1) {{
-                total
-            }}
-        }}
+    ) -> List[TestEntity]:
+        return self._get_paged_results(
+            _graphql.GET_TESTS_TOTAL,
+            _graphql.GET_TESTS_PAGE,
+            self._get_xray_tests_variables(repo_folder, customized_field_jql),
+            lambda data: data["getTests"]["total"],
+            lambda data: data["results"],
+            _xray_test_to_entity,
+        )
+
+    def get_xray_test_by_repo_folder(
+        self, issue: str, repo_folder: str, customized_field_jql: str = ""
+    ) -> Optional[TestEntity]:
+        """
+        :param issue: str, jira issue key or id
+        :return: the test, None if it is not an automated test of the repo folder
         """
-        total = self.context.execute_xray_graphql(payload)["getTests"]["total"]
-        pages = total // 100 + 1
-        # max 25 resolvers, each query contains 3 resolvers, so it will have 8 batch queries
-        max_resovler_batch = 8
-        all_results: List[dict] = []
+        variables = self._get_xray_tests_variables(repo_folder, customized_field_jql)
+        variables["jql"] = f"{variables['jql']} and issue = '{issue}'"
+        data = self.context.execute_xray_graphql(
+            _graphql.build_batch_document(_graphql.GET_TESTS_PAGE, 1),
+            _graphql.build_batch_variables(variables, [0]),
+        )
+        results = data["page0"]["results"]
+        return _xray_test_to_entity(results[0]) if results else None
 
-        def _worker(batch_start):
-            batch_end = min(batch_start + max_resovler_batch, pages)
-            batch_payload = ""
-            for page in range(batch_start, batch_end):
-                logger.debug(f"Start getting tests from page {page} to {batch_end}")
-                each_page_payload = f"""
-                query{page}: getTests({get_test_param}, limit: 100, start: {page * 100}) {{
-                    results {{
-                        issueId
-                        unstructured
-                        folder {{
-                            path
-                        }}
-                        jira(fields: ["key", "summary", "description", "labels", "issuelinks"])
-                    }}
-                }}
-                """
-                batch_payload = batch_payload + each_page_payload
-            batch_payload = f"{{{batch_payload}}}"
-            batch_results = self.context.execute_xray_graphql(batch_payload)
-            return list(batch_results.values())
-
-        with ThreadPoolExecutor() as executor:
-            all_results.extend(
-                executor.map(_worker, range(0, pages, max_resovler_batch))
+    def iter_xray_tests_by_repo_folder(
+        self, repo_folder: str, customized_field_jql: str = ""
+    ) -> Iterator[TestEntity]:
+        """
+        Yield the xray tests sorted by key, one batch of pages is held at a time.
+        Each batch queries the keys after the last yielded key instead of an
+        offset, so tests obsoleted or added meanwhile never shift the pages.
+        """
+        variables = self._get_xray_tests_variables(repo_folder, customized_field_jql)
+        base_jql = variables["jql"]
+        page_starts = [
+            page * _graphql.PAGE_SIZE for page in range(_graphql.MAX_PAGES_PER_BATCH)
+        ]
+        document = _graphql.build_batch_document(
+            _graphql.GET_TESTS_PAGE, len(page_starts)
+        )
+        last_key = None
+        while True:
+            key_jql = f" and key > '{last_key}'" if last_key is not None else ""
+            variables["jql"] = f"{base_jql}{key_jql} order by key asc"
+            logger.debug(f"Start getting xray tests after: {last_key}")
+            batch_results = self.context.execute_xray_graphql(
+                document, _graphql.build_batch_variables(variables, page_starts)
             )
-        return sum([_["results"] for _ in sum([_ for _ in all_results], [])], [])
-
-    @cached_property
+            tests = [
+                _xray_test_to_entity(result)
+                for page in batch_results.values()
+                for result in page["results"]
+            ]
+            tests.sort(key=lambda _: jira_key_order(_.key))
+            yield from tests
+            if len(tests) < len(page_starts) * _graphql.PAGE_SIZE:
+                return
+            last_key = tests[-1].key
+
+    @synchronized_cached_property
     def all_folders(self):
+        metadata_cache = self.context.metadata_cache
+        if metadata_cache is not None:
+            folders = metadata_cache.get(FOLDERS)
+            if folders is not None:
+                self._folders_from_cache = True
+                return folders
         logger.info(
             f"Start getting all test folders for project: {self.context.project_key}"
         )
-        query = f"""
-        {{
-            getFolder(projectId: "{self.context.project_id}", path: "/") {{
-                name
-                path
-                testsCount
-                folders
-            }}
-        }}
+        folders = self.context.execute_xray_graphql(
+            _graphql.GET_ROOT_FOLDER, {"projectId": self.context.project_id}
+        )["getFolder"]
+        self._folders_from_cache = False
+        if metadata_cache is not None:
+            metadata_cache.put(FOLDERS, folders)
+        return folders
+
+    def refresh_all_folders(self, invalidate_cache: bool = True):
+        """
+        Query the folders again on next use, safe to call from several threads.
+        :param invalidate_cache: bool, also drop the folders of the metadata cache
         """
-        return self.context.execute_xray_graphql(query)["getFolder"]
+        if invalidate_cache:
+            self._invalidate_cached_folders()
+        with self._all_folders_lock:
+            self.__dict__.pop("all_folders", None)
+
+    def _invalidate_cached_folders(self):
+        if self.context.metadata_cache is not None:
+            self.context.metadata_cache.invalidate(FOLDERS)
+
+    def relink_test(self, test_entity: TestEntity):
+        # links are removed and created as a whole, so a retry never duplicates links
+        self.remove_links(test_entity)
+        self.link_test(test_entity)
 
     def remove_links(self, test_entity: TestEntity):
         issue = self.context.jira.get_issue(test_entity.key)
@@ -113,8 +265,12 @@ class _XrayAPIWrapper:
 
     def link_test(self, test_entity: TestEntity):
         for req_key in test_entity.req_keys:
-            logger.info(
-                f"Start linking test {test_entity.key} to requirement: {req_key}"
+            logger.event(
+                "link_test",
+                "Start linking test %s to requirement: %s",
+                test_entity.key,
+                req_key,
+                test_key=test_entity.key,
             )
             link_param = {
                 "type": {"name": "Test"},
@@ -128,7 +284,13 @@ class _XrayAPIWrapper:
                     f"Link requirement {req_key} with error: {e}"
                 ) from e
         for defect_key in test_entity.defect_keys:
-            logger.info(f"Start linking test {test_entity.key} to defect: {defect_key}")
+            logger.event(
+                "link_test",
+                "Start linking test %s to defect: %s",
+                test_entity.key,
+                defect_key,
+                test_key=test_entity.key,
+            )
             link_param = {
                 "type": {"name": "Defect"},
                 "inwardIssue": {"key": test_entity.key},
@@ -139,21 +301,35 @@ class _XrayAPIWrapper:
             except Exception as e:
                 raise AssertionError(f"Link defect {defect_key} with error: {e}") from e
 
-    @retry(tries=10, delay=3, logger=logger)
     def move_test_folder(self, test_entity: TestEntity):
         assert test_entity.issue_id is not None, "Test entity issue id cannot be None"
         folder_path = "/".join(
             [self.context.config.automation_folder_name] + test_entity.repo_path
         )
-        payload = f"""
-        mutation {{
-            updateTestFolder(
-                issueId: "{test_entity.issue_id}",
-                folderPath: "{folder_path}"
-            )
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        move = partial(
+            self.context.execute_xray_graphql,
+            _graphql.UPDATE_TEST_FOLDER,
+            {"issueId": test_entity.issue_id, "folderPath": folder_path},
+        )
+        try:
+            move()
+        except Exception as e:
+            if not self._folders_from_cache or classify_error(e) != PERMANENT:
+                raise
+            # the cached folders could list a deleted folder, so it was never
+            # created, query the folders again and move once more
+            logger.info(f"Move failed with cached folders, create {folder_path}: {e}")
+            self.refresh_all_folders()
+            for depth in range(1, len(test_entity.repo_path) + 1):
+                self.create_repo_folder(
+                    "/".join(
+                        [self.context.config.automation_folder_name]
+                        + test_entity.repo_path[:depth]
+                    )
+                )
+            move()
+        if self.folder_model is not None:
+            self.folder_model.move_test(test_entity.issue_id, f"/{folder_path}")
 
     def create_repo_folder(self, folder_path: str):
         folder_path = (
@@ -170,28 +346,31 @@ class _XrayAPIWrapper:
             return False
 
         if not _is_folder_path_existing(self.all_folders["folders"]):
-            payload = f"""
-                    mutation {{
-                        createFolder(
-                            projectId: "{self.context.project_id}",
-                            path: "{folder_path}"
-                        ) {{
-                            folder {{
-                                name
-                                path
-                                testsCount
-                            }}
-                            warnings
-                        }}
-                    }}
-                    """
             logger.info(f"Start creating repo folder: {folder_path}")
-            self.context.execute_xray_graphql(payload)["createFolder"]
+            try:
+                self.context.execute_xray_graphql(
+                    _graphql.CREATE_FOLDER,
+                    {"projectId": self.context.project_id, "path": folder_path},
+                )
+                self._invalidate_cached_folders()
+            except Exception:
+                # the folder could be created by another sync shard meanwhile
+                self.refresh_all_folders()
+                if not _is_folder_path_existing(self.all_folders["folders"]):
+                    raise
+                logger.info(f"Using concurrently created folder: {folder_path}")
         else:
             logger.info(f"Using existing folder: {folder_path}")
+        if self.folder_model is not None:
+            self.folder_model.add_folder(folder_path)
 
     def finalize_test_from_any_status(self, test_entity: TestEntity):
-        logger.info(f"Start finalizing test: {test_entity.key}")
+        logger.event(
+            "finalize_test",
+            "Start finalizing test: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         status = self.context.jira.get_issue_status(test_entity.key)
         if status == "Finalized":
             return
@@ -207,7 +386,12 @@ class _XrayAPIWrapper:
         assert status == "Finalized", f"Test {test_entity.key} cannot be finalized."
 
     def renew_test_details(self, marked_test: TestEntity):
-        logger.info(f"Start renewing external marked test: {marked_test.key}")
+        logger.event(
+            "renew_test_details",
+            "Start renewing external marked test: %s",
+            marked_test.key,
+            test_key=marked_test.key,
+        )
         assert marked_test.key is not None, "Marked test key cannot be None"
         result = self.context.jira.get_issue(
             marked_test.key, fields=("project", "issuetype", "status")
@@ -231,79 +415,158 @@ class _XrayAPIWrapper:
             key=marked_test.key,
             fields=fields,
         )
-        self.update_test_type(marked_test)
-        self.update_unstructured_test_definition(marked_test)
+
+    def bulk_edit_labels(
+        self, issue_ids: List[str], labels: List[str], option: str
+    ) -> List[str]:
+        """
+        Add or remove the same labels of many issues with a single jira bulk edit
+        task, and wait for the task to finish.
+        :param issue_ids: list, at most MAX_ISSUES_PER_BULK_EDIT issue ids
+        :param labels: list, labels to add or remove
+        :param option: str, "ADD" or "REMOVE"
+        :return: issue ids which were not edited
+        """
+        logger.info(
+            f"Start bulk editing labels of {len(issue_ids)} tests: {option} {labels}"
+        )
+        payload = {
+            "selectedIssueIdsOrKeys": issue_ids,
+            "selectedActions": ["labels"],
+            "editedFieldsInput": {
+                "labelsFields": [
+                    {
+                        "fieldId": "labels",
+                        "bulkEditMultiSelectFieldOption": option,
+                        "labels": [{"name": _} for _ in labels],
+                    }
+                ]
+            },
+            "sendBulkNotification": False,
+        }
+        response = self.context.jira.post(BULK_EDIT_FIELDS_URL, data=payload)
+        assert response is not None, "Bulk edit returned no task"
+        task_id = response["taskId"]
+        task = self._wait_bulk_task(task_id)
+        processed = set(str(_) for _ in task.get("processedAccessibleIssues") or [])
+        failed = [
+            _
+            for _ in issue_ids
+            if _ not in processed or _ in (task.get("failedAccessibleIssues") or {})
+        ]
+        logger.info(
+            f"Bulk edit task {task_id} finished with status {task['status']}, "
+            f"{len(failed)} tests failed"
+        )
+        return failed
+
+    def _wait_bulk_task(self, task_id: str) -> dict:
+        deadline = time.monotonic() + BULK_EDIT_TIMEOUT
+        delay = 0.5
+        while True:
+            task = self.context.jira.get(f"{BULK_QUEUE_URL}/{task_id}")
+            assert task is not None, f"Bulk edit task {task_id} not found"
+            if task["status"] not in _BULK_TASK_PENDING_STATUSES:
+                return task
+            assert time.monotonic() < deadline, (
+                f"Bulk edit task {task_id} not finished in {BULK_EDIT_TIMEOUT}s"
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
 
     def update_test_type(self, test_entity: TestEntity):
-        logger.info(f"Start updating test type: {test_entity.key}")
+        logger.event(
+            "update_test_type",
+            "Start updating test type: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         assert test_entity.issue_id is not None, "Test entity issue id cannot be None"
-        payload = f"""
-        mutation {{
-            updateTestType(issueId: "{test_entity.issue_id}", testType: {{ name: "Automated" }}) {{
-                issueId
-            }}
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        self.context.execute_xray_graphql(
+            _graphql.UPDATE_TEST_TYPE, {"issueId": test_entity.issue_id}
+        )
 
     def update_unstructured_test_definition(self, test_entity: TestEntity):
-        logger.info(f"Start updating unstructured test definition: {test_entity.key}")
+        logger.event(
+            "update_test_definition",
+            "Start updating unstructured test definition: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         assert test_entity.issue_id is not None, "Test entity issue id cannot be None"
-        payload = f"""
-        mutation {{
-            updateUnstructuredTestDefinition(issueId: "{test_entity.issue_id}", unstructured: "{test_entity.unique_identifier}" ) {{
-                issueId
-                unstructured
-            }}
-        }}
+        self.context.execute_xray_graphql(
+            _graphql.UPDATE_UNSTRUCTURED_TEST_DEFINITION,
+            {
+                "issueId": test_entity.issue_id,
+                "unstructured": test_entity.unique_identifier,
+            },
+        )
+
+    def call_with_issue_id(self, key: str, func: Callable[[str], T]) -> T:
         """
-        self.context.execute_xray_graphql(payload)
+        Call func with the issue id of the key. A cached issue id leading to a not
+        found or validation error is queried again, and func called once more with
+        the fresh issue id.
+        """
+        issue_id = self.get_issue_id_by_key(key)
+        try:
+            return func(issue_id)
+        except Exception as e:
+            metadata_cache = self.context.metadata_cache
+            if metadata_cache is None or classify_error(e) != PERMANENT:
+                raise
+            self.context.test_index.discard_issue_id(key)
+            metadata_cache.discard(ISSUE_IDS, key)
+            fresh_issue_id = self.get_issue_id_by_key(key)
+            if fresh_issue_id == issue_id:
+                raise
+            logger.info(f"Retry with the fresh issue id of {key}: {fresh_issue_id}")
+            return func(fresh_issue_id)
+
+    def _get_cached_key(self, name: str, summary: str) -> Optional[str]:
+        if self.context.metadata_cache is None:
+            return None
+        return (self.context.metadata_cache.get(name) or {}).get(summary)
+
+    def _cache_metadata(self, name: str, values: Dict[str, str]):
+        if self.context.metadata_cache is not None:
+            self.context.metadata_cache.update(name, values)
 
     def create_test_plan(self, test_plan_name: str) -> str:
+        indexed_key = self.context.test_index.get_test_plan_key(test_plan_name)
+        if indexed_key is not None:
+            logger.info(f"Found indexed test plan: {indexed_key}")
+            return indexed_key
+        cached_key = self._get_cached_key(TEST_PLANS, test_plan_name)
+        if cached_key is not None:
+            logger.info(f"Found cached test plan: {cached_key}")
+            self.context.test_index.put_test_plan_keys({test_plan_name: cached_key})
+            return cached_key
         jql = f"project='{self.context.project_key}' and reporter='{self.context.jira_username}'"
-        payload = f"""
-        {{
-            getTestPlans(jql: "{jql}", limit: 1) {{
-                total
-            }}
-        }}
-        """
-        total = self.context.execute_xray_graphql(payload)["getTestPlans"]["total"]
-        pages = total // 100 + 1
-        max_resovler_batch = 8
-        all_results: List[dict] = []
-
-        def _worker(batch_start):
-            batch_end = min(batch_start + max_resovler_batch, pages)
-            batch_payload = ""
-            for page in range(batch_start, batch_end):
-                batch_payload = (
-                    batch_payload
-                    + f"""
-                query{page}: getTestPlans(jql: "{jql}", limit: 100, start: {page * 100}) {{
-                    results {{
-                        issueId
-                        jira(fields: ["key", "summary"])
-                    }}
-                }}
-                """
-                )
-            batch_payload = f"{{{batch_payload}}}"
-            batch_results = self.context.execute_xray_graphql(batch_payload)
-            return list(batch_results.values())
-
-        with ThreadPoolExecutor() as executor:
-            all_results.extend(
-                executor.map(_worker, range(0, pages, max_resovler_batch))
-            )
-        all_test_plans: List[dict] = sum(
-            [_["results"] for _ in sum([_ for _ in all_results], [])], []
+        all_test_plans = self._get_paged_results(
+            _graphql.GET_TEST_PLANS_TOTAL,
+            _graphql.GET_TEST_PLANS_PAGE,
+            {"jql": jql},
+            lambda data: data["getTestPlans"]["total"],
+            lambda data: data["results"],
         )
+        test_plan_keys: Dict[str, str] = {}
+        test_plan_issue_ids: Dict[str, str] = {}
         for test_plan in all_test_plans:
-            if test_plan["jira"]["summary"] == test_plan_name:
-                key = test_plan["jira"]["key"]
-                logger.info(f"Found existing test plan: {key}")
-                return key
+            test_plan_issue_ids[test_plan["jira"]["key"]] = test_plan["issueId"]
+            self.context.test_index.put_issue_id(
+                test_plan["jira"]["key"], test_plan["issueId"]
+            )
+            test_plan_keys.setdefault(
+                test_plan["jira"]["summary"], test_plan["jira"]["key"]
+            )
+        self.context.test_index.put_test_plan_keys(test_plan_keys)
+        self._cache_metadata(TEST_PLANS, test_plan_keys)
+        self._cache_metadata(ISSUE_IDS, test_plan_issue_ids)
+        if test_plan_name in test_plan_keys:
+            key = test_plan_keys[test_plan_name]
+            logger.info(f"Found existing test plan: {key}")
+            return key
 
         fields = {
             "project": {"key": self.context.project_key},
@@ -311,68 +574,58 @@ class _XrayAPIWrapper:
             "assignee": {"accountId": self.context.jira_account_id},
         }
 
-        payload = f"""
-        mutation {{
-            createTestPlan(jira: {{ fields: {dict_to_graphql_param(fields)} }}) {{
-                testPlan {{
-                    issueId
-                    jira(fields: ["key"])
-                }}
-            }}
-        }}
-        """
-        result = self.context.execute_xray_graphql(payload)["createTestPlan"][
-            "testPlan"
-        ]
+        result = self.context.execute_xray_graphql(
+            _graphql.CREATE_TEST_PLAN, {"jira": {"fields": fields}}
+        )["createTestPlan"]["testPlan"]
         test_plan_key = result["jira"]["key"]
+        self.context.test_index.put_issue_id(test_plan_key, result["issueId"])
+        self._cache_metadata(TEST_PLANS, {test_plan_name: test_plan_key})
+        self._cache_metadata(ISSUE_IDS, {test_plan_key: result["issueId"]})
+        self.context.test_index.put_test_plan_keys({test_plan_name: test_plan_key})
         logger.info(f"Created new test plan: {test_plan_key}")
         return test_plan_key
 
     def create_test_execution(self, test_execution_name: str) -> str:
-        jql = f"project='{self.context.project_key}' and reporter='{self.context.jira_username}'"
-        payload = f"""
-        {{
-            getTestExecutions(jql: "{jql}", limit: 1) {{
-                total
-            }}
-        }}
-        """
-        total = self.context.execute_xray_graphql(payload)["getTestExecutions"]["total"]
-        pages = total // 100 + 1
-        max_resovler_batch = 8
-        all_results: List[dict] = []
-
-        def _worker(batch_start):
-            batch_end = min(batch_start + max_resovler_batch, pages)
-            batch_payload = ""
-            for page in range(batch_start, batch_end):
-                batch_payload = (
-                    batch_payload
-                    + f"""
-                query{page}: getTestExecutions(jql: "{jql}", limit: 100, start: {page * 100}) {{
-                    results {{
-                        issueId
-                        jira(fields: ["key", "summary"])
-                    }}
-                }}
-                """
-                )
-            batch_payload = f"{{{batch_payload}}}"
-            batch_results = self.context.execute_xray_graphql(batch_payload)
-            return list(batch_results.values())
-
-        with ThreadPoolExecutor() as executor:
-            all_results.extend(
-                executor.map(_worker, range(0, pages, max_resovler_batch))
+        indexed_key = self.context.test_index.get_test_execution_key(
+            test_execution_name
+        )
+        if indexed_key is not None:
+            logger.info(f"Found indexed test execution: {indexed_key}")
+            return indexed_key
+        cached_key = self._get_cached_key(TEST_EXECUTIONS, test_execution_name)
+        if cached_key is not None:
+            logger.info(f"Found cached test execution: {cached_key}")
+            self.context.test_index.put_test_execution_keys(
+                {test_execution_name: cached_key}
             )
-        all_test_executions: List[dict] = sum(
-            [_["results"] for _ in sum([_ for _ in all_results], [])], []
+            return cached_key
+        jql = f"project='{self.context.project_key}' and reporter='{self.context.jira_username}'"
+        all_test_executions = self._get_paged_results(
+            _graphql.GET_TEST_EXECUTIONS_TOTAL,
+            _graphql.GET_TEST_EXECUTIONS_PAGE,
+            {"jql": jql},
+            lambda data: data["getTestExecutions"]["total"],
+            lambda data: data["results"],
         )
+        test_execution_keys: Dict[str, str] = {}
+        test_execution_issue_ids: Dict[str, str] = {}
         for test_execution in all_test_executions:
-            if test_execution["jira"]["summary"] == test_execution_name:
-                key = test_execution["jira"]["key"]
-                logger.info(f"Found existing test execution: {key}")
-                return key
+            test_execution_issue_ids[test_execution["jira"]["key"]] = test_execution[
+                "issueId"
+            ]
+            self.context.test_index.put_issue_id(
+                test_execution["jira"]["key"], test_execution["issueId"]
+            )
+            test_execution_keys.setdefault(
+                test_execution["jira"]["summary"], test_execution["jira"]["key"]
+            )
+        self.context.test_index.put_test_execution_keys(test_execution_keys)
+        self._cache_metadata(TEST_EXECUTIONS, test_execution_keys)
+        self._cache_metadata(ISSUE_IDS, test_execution_issue_ids)
+        if test_execution_name in test_execution_keys:
+            key = test_execution_keys[test_execution_name]
+            logger.info(f"Found existing test execution: {key}")
+            return key
 
         fields = {
             "project": {"key": self.context.project_key},
@@ -380,111 +633,41 @@ class _XrayAPIWrapper:
             "assignee": {"accountId": self.context.jira_account_id},
         }
 
-        payload = f"""
-        mutation {{
-            createTestExecution(jira: {{ fields: {dict_to_graphql_param(fields)} }}) {{
-                testExecution {{
-                    issueId
-                    jira(fields: ["key"])
-                }}
-            }}
-        }}
-        """
-        result = self.context.execute_xray_graphql(payload)["createTestExecution"][
-            "testExecution"
-        ]
+        result = self.context.execute_xray_graphql(
+            _graphql.CREATE_TEST_EXECUTION, {"jira": {"fields": fields}}
+        )["createTestExecution"]["testExecution"]
         test_execution_key = result["jira"]["key"]
+        self.context.test_index.put_issue_id(test_execution_key, result["issueId"])
+        self._cache_metadata(TEST_EXECUTIONS, {test_execution_name: test_execution_key})
+        self._cache_metadata(ISSUE_IDS, {test_execution_key: result["issueId"]})
+        self.context.test_index.put_test_execution_keys(
+            {test_execution_name: test_execution_key}
+        )
         logger.info(f"Created new test execution: {test_execution_key}")
         return test_execution_key
 
     def get_tests_from_test_plan(self, test_plan_key) -> List[dict]:
-        test_plan_issue_id = self.get_issue_id_by_key(test_plan_key)
-        resp = self.context.execute_xray_graphql(f"""
-        {{
-            getTestPlan(issueId: "{test_plan_issue_id}") {{
-                tests(limit: 1) {{
-                    total
-                }}
-            }}
-        }}
-        """)
-        total = resp["getTestPlan"]["tests"]["total"]
-        pages = total // 100 + 1
-        max_resovler_batch = 8
-        all_results: List[dict] = []
-
-        def _worker(batch_start):
-            batch_end = min(batch_start + max_resovler_batch, pages)
-            batch_payload = ""
-            for page in range(batch_start, batch_end):
-                batch_payload = (
-                    batch_payload
-                    + f"""
-                query{page}: getTestPlan(issueId: "{test_plan_issue_id}") {{
-                    tests(limit: 100, start: {page * 100}) {{
-                        results {{
-                            issueId,
-                            jira(fields: ["key", "status"])
-                        }}
-                    }}
-                }}
-                """
-                )
-            batch_payload = f"{{{batch_payload}}}"
-            batch_results = self.context.execute_xray_graphql(batch_payload)
-            return list(batch_results.values())
-
-        with ThreadPoolExecutor() as executor:
-            all_results.extend(
-                executor.map(_worker, range(0, pages, max_resovler_batch))
-            )
-        return sum(
-            [_["tests"]["results"] for _ in sum([_ for _ in all_results], [])], []
+        return self.call_with_issue_id(
+            test_plan_key,
+            lambda test_plan_issue_id: self._get_paged_results(
+                _graphql.GET_TEST_PLAN_TESTS_TOTAL,
+                _graphql.GET_TEST_PLAN_TESTS_PAGE,
+                {"issueId": test_plan_issue_id},
+                lambda data: data["getTestPlan"]["tests"]["total"],
+                lambda data: data["tests"]["results"],
+            ),
         )
 
     def get_tests_from_test_execution(self, test_execution_key) -> List[dict]:
-        test_execution_issue_id = self.get_issue_id_by_key(test_execution_key)
-        resp = self.context.execute_xray_graphql(f"""
-        {{
-            getTestExecution(issueId: "{test_execution_issue_id}") {{
-                tests(limit: 1) {{
-                    total
-                }}
-            }}
-        }}
-        """)
-        total = resp["getTestExecution"]["tests"]["total"]
-        pages = total // 100 + 1
-        max_resovler_batch = 8
-        all_results: List[dict] = []
-
-        def _worker(batch_start):
-            batch_end = min(batch_start + max_resovler_batch, pages)
-            batch_payload = ""
-            for page in range(batch_start, batch_end):
-                batch_payload = (
-                    batch_payload
-                    + f"""
-                query{page}: getTestExecution(issueId: "{test_execution_issue_id}") {{
-                    tests(limit: 100, start: {page * 100}) {{
-                        results {{
-                            issueId,
-                            jira(fields: ["key", "status"])
-                        }}
-                    }}
-                }}
-                """
-                )
-            batch_payload = f"{{{batch_payload}}}"
-            batch_results = self.context.execute_xray_graphql(batch_payload)
-            return list(batch_results.values())
-
-        with ThreadPoolExecutor() as executor:
-            all_results.extend(
-                executor.map(_worker, range(0, pages, max_resovler_batch))
-            )
-        return sum(
-            [_["tests"]["results"] for _ in sum([_ for _ in all_results], [])], []
+        return self.call_with_issue_id(
+            test_execution_key,
+            lambda test_execution_issue_id: self._get_paged_results(
+                _graphql.GET_TEST_EXECUTION_TESTS_TOTAL,
+                _graphql.GET_TEST_EXECUTION_TESTS_PAGE,
+                {"issueId": test_execution_issue_id},
+                lambda data: data["getTestExecution"]["tests"]["total"],
+                lambda data: data["tests"]["results"],
+            ),
         )
 
     def add_test_environments_to_test_execution(
@@ -493,20 +676,16 @@ class _XrayAPIWrapper:
         logger.info(
             f"Start adding test environments: {test_environments} to test execution: {test_execution_key}"
         )
-        test_execution_issue_id = self.get_issue_id_by_key(test_execution_key)
-        test_environments_param = (
-            ",".join([f'"{_}"' for _ in test_environments])
-            if test_environments
-            else "[]"
-        )
-        payload = f"""
-        mutation {{
-            addTestEnvironmentsToTestExecution(issueId: "{test_execution_issue_id}", testEnvironments: {test_environments_param}) {{
-                warning
-            }}
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        self.call_with_issue_id(
+            test_execution_key,
+            lambda test_execution_issue_id: self.context.execute_xray_graphql(
+                _graphql.ADD_TEST_ENVIRONMENTS_TO_TEST_EXECUTION,
+                {
+                    "issueId": test_execution_issue_id,
+                    "testEnvironments": test_environments,
+                },
+            ),
+        )
 
     def fuzzy_update(self, jira_key: str, payload: dict):
         fields = {}
@@ -522,86 +701,187 @@ class _XrayAPIWrapper:
         except HTTPError as e:
             logger.error(f"Update failed with error: {e.response.text}")
 
-    def delete_folder(self, path: str):
-        try:
-            payload = f"""
-            mutation {{
-                deleteFolder(projectId: "{self.context.project_id}", path: "{path}")
-            }}
-            """
-            self.context.execute_xray_graphql(payload)
-        except HTTPError as e:
-            # parent folder could be deleted by other worker
-            # ignore such errors
-            logger.warning(f"Ignore errors: {e}")
-
-    def get_all_empty_folders(self) -> List[str]:
-        obsolete_folder_path = f"/{self.context.config.automation_folder_name}/{self.context.config.obsolete_automation_folder_name}"
-
-        def _iter_folders(_folders: List[dict]):
-            _result: List[str] = []
-            for _folder in _folders:
-                sub_folders = _folder["folders"]
-                tests_count = _folder["testsCount"]
-                folder_path = _folder["path"]
-                if sub_folders:
-                    _result = _result + _iter_folders(sub_folders)
-                elif tests_count == 0 and folder_path != obsolete_folder_path:
-                    _result.append(folder_path)
-            return _result
+    def start_folder_model(self) -> FolderModel:
+        self.folder_model = FolderModel(self.all_folders)
+        return self.folder_model
+
+    def delete_folders(self, paths: List[str]):
+        variables: Dict[str, Any] = {"projectId": self.context.project_id}
+        variables.update({f"path{i}": path for i, path in enumerate(paths)})
+        self.context.execute_xray_graphql(
+            _graphql.build_delete_folders_document(len(paths)), variables
+        )
+        self._invalidate_cached_folders()
+        if self.folder_model is not None:
+            self.folder_model.remove_folders(paths)
 
-        for folder in self.all_folders["folders"]:
-            if folder["name"] == self.context.config.automation_folder_name:
-                return _iter_folders(folder["folders"])
-        return []
+    def get_empty_folders(self) -> List[List[str]]:
+        """
+        :return: empty folder paths under the automation folder, grouped by depth
+        with the deepest first, so each group can be deleted after the previous
+        """
+        folder_model = self.folder_model
+        if folder_model is None or self._folders_from_cache:
+            # test counts of cached folders could be outdated, never delete by them
+            self.refresh_all_folders()
+            folder_model = self.start_folder_model()
+        automation_folder_path = f"/{self.context.config.automation_folder_name}"
+        return folder_model.get_empty_folders(
+            automation_folder_path,
+            [
+                f"{automation_folder_path}/{self.context.config.obsolete_automation_folder_name}"
+            ],
+        )
+
+    def attach_file(self, issue_key: str, path: str, filename: str):
+        """
+        Attach the file to the jira issue, the file is streamed from disk. The
+        caller reserves its size from `attachment_budget`.
+        """
+        size = os.path.getsize(path)
+        logger.event(
+            "attach_file",
+            "Start attaching %s (%d bytes) to: %s",
+            path,
+            size,
+            issue_key,
+            issue_key=issue_key,
+            size=size,
+        )
+        body = MultipartFileBody(path, filename)
+        try:
+            r = self.context.jira.session.post(
+                f"{self.context.jira.url.rstrip('/')}/rest/api/3/issue/{issue_key}/attachments",
+                data=body,
+                headers={
+                    "Content-Type": body.content_type,
+                    "X-Atlassian-Token": "no-check",
+                },
+                timeout=10 * 60,
+            )
+        finally:
+            body.close()
+        r.raise_for_status()
 
-    @lru_cache
     def get_issue_id_by_key(self, key: str) -> str:
-        logger.info(f"Start getting issue id by key: {key}")
-        return self.context.jira.get_issue(key, fields=["id"])["id"]
+        issue_id = self.context.test_index.get_issue_id(key)
+        if issue_id is None:
+            issue_id = self._issue_id_flights.do(
+                key, partial(self._query_issue_id_by_key, key)
+            )
+        return issue_id
+
+    def _query_issue_id_by_key(self, key: str) -> str:
+        logger.event("get_issue_id", "Start getting issue id by key: %s", key, key=key)
+        issue_id = self.context.jira.get_issue(key, fields=["id"])["id"]
+        self.context.test_index.put_issue_id(key, issue_id)
+        self._cache_metadata(ISSUE_IDS, {key: issue_id})
+        return issue_id
+
+    def get_issue_ids_by_keys(self, keys: List[str]) -> Dict[str, str]:
+        """
+        Look up the issue ids of many keys, the keys not indexed yet are queried
+        by jql searches of many keys instead of one request per key.
+        :return: issue id by key, the keys not found are missing from it
+        """
+        issue_ids: Dict[str, str] = {}
+        missing_keys = []
+        for key in dict.fromkeys(keys):
+            issue_id = self.context.test_index.get_issue_id(key)
+            if issue_id is not None:
+                issue_ids[key] = issue_id
+            else:
+                missing_keys.append(key)
+
+        def _search(chunk: List[str]) -> Dict[str, str]:
+            logger.info(f"Start getting issue ids of {len(chunk)} keys")
+            try:
+                # quoted keys, unknown keys are warned about instead of failing
+                # the whole search
+                result = self.context.jira.get(
+                    ISSUE_SEARCH_URL,
+                    params={
+                        "jql": f"key in ({', '.join(json.dumps(_) for _ in chunk)})",
+                        "fields": "id",
+                        "maxResults": len(chunk),
+                        "validateQuery": "warn",
+                    },
+                )
+                assert result is not None, "Issue search returned no result"
+            except Exception as e:
+                if is_fatal_error(e):
+                    raise
+                logger.warning(
+                    f"Issue id search of {len(chunk)} keys failed, look them up one by one: {e}"
+                )
+                return {}
+            return {issue["key"]: issue["id"] for issue in result["issues"]}
+
+        found: Dict[str, str] = {}
+        for chunk_ids in self.context.executor.map(
+            _search,
+            [
+                missing_keys[i : i + MAX_KEYS_PER_ISSUE_ID_SEARCH]
+                for i in range(0, len(missing_keys), MAX_KEYS_PER_ISSUE_ID_SEARCH)
+            ],
+        ):
+            found.update(chunk_ids)
+        for key, issue_id in found.items():
+            self.context.test_index.put_issue_id(key, issue_id)
+        self._cache_metadata(ISSUE_IDS, found)
+        issue_ids.update(found)
+        for key in missing_keys:
+            if key in issue_ids:
+                continue
+            # e.g: a moved issue is found by the search under its new key
+            try:
+                issue_ids[key] = self.get_issue_id_by_key(key)
+            except Exception as e:
+                if is_fatal_error(e):
+                    raise
+                logger.warning(f"Issue id of {key} not found: {e}")
+        return issue_ids
 
     def add_tests_to_test_execution(
         self, test_execution_issue_id: str, test_issue_ids: List[str]
     ):
-        test_issue_ids_param = ",".join([f'"{_}"' for _ in test_issue_ids])
-        payload = f"""
-        mutation {{
-            addTestsToTestExecution(issueId: "{test_execution_issue_id}", testIssueIds: [{test_issue_ids_param}]) {{
-                warning
-            }}
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        self.context.execute_xray_graphql(
+            _graphql.ADD_TESTS_TO_TEST_EXECUTION,
+            {"issueId": test_execution_issue_id, "testIssueIds": test_issue_ids},
+        )
 
     def add_tests_to_test_plan(
         self, test_plan_issue_id: str, test_issue_ids: List[str]
     ):
-        test_issue_ids_param = ",".join([f'"{_}"' for _ in test_issue_ids])
-        payload = f"""
-        mutation {{
-            addTestsToTestPlan(issueId: "{test_plan_issue_id}", testIssueIds: [{test_issue_ids_param}]) {{
-                warning
-            }}
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        self.context.execute_xray_graphql(
+            _graphql.ADD_TESTS_TO_TEST_PLAN,
+            {"issueId": test_plan_issue_id, "testIssueIds": test_issue_ids},
+        )
 
     def add_test_execution_to_test_plan(
         self, test_plan_key: str, test_execution_key: str
     ):
-        test_plan_issue_id = self.get_issue_id_by_key(test_plan_key)
-        test_execution_issue_id = self.get_issue_id_by_key(test_execution_key)
-        payload = f"""
-        mutation {{
-            addTestExecutionsToTestPlan(issueId: "{test_plan_issue_id}", testExecIssueIds: "{test_execution_issue_id}") {{
-                warning
-            }}
-        }}
-        """
-        self.context.execute_xray_graphql(payload)
+        self.call_with_issue_id(
+            test_plan_key,
+            lambda test_plan_issue_id: self.call_with_issue_id(
+                test_execution_key,
+                lambda test_execution_issue_id: self.context.execute_xray_graphql(
+                    _graphql.ADD_TEST_EXECUTIONS_TO_TEST_PLAN,
+                    {
+                        "issueId": test_plan_issue_id,
+                        "testExecIssueIds": [test_execution_issue_id],
+                    },
+                ),
+            ),
+        )
 
 
 class _XrayBotWorker:
+    # the worker manager retries the whole run
+    retry_run = True
+    # requests sent for any task, on top of one per link or list item
+    operations = 1
+
     def __init__(self, api_wrapper: _XrayAPIWrapper):
         self.api_wrapper = api_wrapper
         self.context = self.api_wrapper.context
@@ -611,19 +891,81 @@ class _XrayBotWorker:
         pass
 
 
-class _ObsoleteTestWorker(_XrayBotWorker):
+@dataclass
+class _WorkerStep:
+    # the retry policy is looked up by the step name
+    name: str
+    func: Callable[[], Any]
+
+
+class _XrayBotStepWorker(_XrayBotWorker):
+    """
+    Worker made of steps which are retried on their own, a failed step never
+    re-runs the steps completed before it.
+    """
+
+    # steps are retried instead of the whole run
+    retry_run = False
+
+    @abstractmethod
+    def steps(self, test_entity: TestEntity) -> List[_WorkerStep]:
+        pass
+
     def run(self, test_entity: TestEntity):
-        logger.info(f"Start obsoleting test: {test_entity.key}")
-        self.context.jira.set_issue_status(test_entity.key, "Obsolete")
-        self.api_wrapper.remove_links(test_entity)
+        for step in self.steps(test_entity):
+            logger.event(
+                "test_step",
+                "Start step %s of test: %s",
+                step.name,
+                test_entity.key,
+                level=logging.DEBUG,
+                step=step.name,
+                test_key=test_entity.key,
+            )
+            try:
+                self.context.retrier.call(step.name, step.func)
+            except Exception as e:
+                if is_fatal_error(e):
+                    raise
+                raise AssertionError(f"Step {step.name} failed with error: {e}") from e
+
+
+class _ObsoleteTestWorker(_XrayBotStepWorker):
+    operations = 3
+
+    def steps(self, test_entity: TestEntity) -> List[_WorkerStep]:
+        logger.event(
+            "obsolete_test",
+            "Start obsoleting test: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         # set current test repo path to `Obsolete` folder
         test_entity.repo_path = [self.context.config.obsolete_automation_folder_name]
-        self.api_wrapper.move_test_folder(test_entity)
+        return [
+            _WorkerStep(
+                "set_obsolete_status",
+                partial(
+                    self.context.jira.set_issue_status, test_entity.key, "Obsolete"
+                ),
+            ),
+            _WorkerStep(
+                "remove_links", partial(self.api_wrapper.remove_links, test_entity)
+            ),
+            _WorkerStep(
+                "move_test_folder",
+                partial(self.api_wrapper.move_test_folder, test_entity),
+            ),
+        ]
 
 
 class _DraftTestCreateWorker(_XrayBotWorker):
     def run(self, test_entity: TestEntity):
-        logger.info(f"Start creating test draft: {test_entity.summary}")
+        logger.event(
+            "create_test_draft",
+            "Start creating test draft: %s",
+            test_entity.summary,
+        )
 
         fields = {
             "issuetype": {"name": "Test"},
@@ -634,99 +976,146 @@ class _DraftTestCreateWorker(_XrayBotWorker):
             "reporter": {"accountId": self.context.jira_account_id},
             **self.context.config.get_tests_custom_fields_payload(),
         }
-        fields_param = dict_to_graphql_param(fields, multilines_keys=["description"])
-
-        payload = f"""
-        mutation {{
-          createTest(
-            testType: {{ name: "Automated" }},
-            unstructured: "{test_entity.unique_identifier}",
-            jira: {{
-              fields: {fields_param}
-            }}
-          ) {{
-            test {{
-              issueId
-              jira(fields: ["key"])
-            }}
-          }}
-        }}
-        """
-        result = self.context.execute_xray_graphql(payload)["createTest"]["test"]
+        result = self.context.execute_xray_graphql(
+            _graphql.CREATE_TEST,
+            {"unstructured": test_entity.unique_identifier, "jira": {"fields": fields}},
+        )["createTest"]["test"]
         test_entity.key = result["jira"]["key"]
         test_entity.issue_id = result["issueId"]
-        logger.info(f"Created xray test draft: {test_entity.key}")
+        logger.event(
+            "create_test_draft",
+            "Created xray test draft: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         return test_entity
 
 
-class _ExternalMarkedTestUpdateWorker(_XrayBotWorker):
-    def run(self, test_entity: TestEntity):
-        logger.info(f"Start updating external marked test: {test_entity.key}")
-        self.api_wrapper.renew_test_details(test_entity)
-        self.api_wrapper.finalize_test_from_any_status(test_entity)
-        self.api_wrapper.remove_links(test_entity)
-        self.api_wrapper.link_test(test_entity)
-        self.api_wrapper.move_test_folder(test_entity)
+class _ExternalMarkedTestUpdateWorker(_XrayBotStepWorker):
+    operations = 10
+
+    def steps(self, test_entity: TestEntity) -> List[_WorkerStep]:
+        logger.event(
+            "update_test",
+            "Start updating external marked test: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
+        return [
+            _WorkerStep(
+                "renew_test_details",
+                partial(self.api_wrapper.renew_test_details, test_entity),
+            ),
+            _WorkerStep(
+                "update_test_type",
+                partial(self.api_wrapper.update_test_type, test_entity),
+            ),
+            _WorkerStep(
+                "update_unstructured_test_definition",
+                partial(
+                    self.api_wrapper.update_unstructured_test_definition, test_entity
+                ),
+            ),
+            _WorkerStep(
+                "finalize_test",
+                partial(self.api_wrapper.finalize_test_from_any_status, test_entity),
+            ),
+            _WorkerStep(
+                "relink_test", partial(self.api_wrapper.relink_test, test_entity)
+            ),
+            _WorkerStep(
+                "move_test_folder",
+                partial(self.api_wrapper.move_test_folder, test_entity),
+            ),
+        ]
 
 
-class _InternalMarkedTestUpdateWorker(_XrayBotWorker):
-    def run(self, test_entity: TestEntity):
-        logger.info(f"Start updating internal marked test: {test_entity.key}")
+class _InternalMarkedTestUpdateWorker(_XrayBotStepWorker):
+    operations = 4
+
+    def steps(self, test_entity: TestEntity) -> List[_WorkerStep]:
+        logger.event(
+            "update_test",
+            "Start updating internal marked test: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
         assert test_entity.key is not None, "Jira test key cannot be None"
         fields = {
             "summary": test_entity.summary,
             "description": test_entity.description,
             "labels": test_entity.labels,
         }
+        return [
+            _WorkerStep(
+                "update_fields",
+                partial(
+                    self.context.jira.update_issue_field,
+                    key=test_entity.key,
+                    fields=fields,
+                ),
+            ),
+            _WorkerStep(
+                "update_unstructured_test_definition",
+                partial(
+                    self.api_wrapper.update_unstructured_test_definition, test_entity
+                ),
+            ),
+            _WorkerStep(
+                "relink_test", partial(self.api_wrapper.relink_test, test_entity)
+            ),
+            _WorkerStep(
+                "move_test_folder",
+                partial(self.api_wrapper.move_test_folder, test_entity),
+            ),
+        ]
+
+
+class _UpdateTestLabelsWorker(_XrayBotWorker):
+    def run(self, test_entity: TestEntity):
+        logger.event(
+            "update_test_labels",
+            "Start updating test labels: %s",
+            test_entity.key,
+            test_key=test_entity.key,
+        )
+        assert test_entity.key is not None, "Jira test key cannot be None"
         self.context.jira.update_issue_field(
-            key=test_entity.key,
-            fields=fields,
+            key=test_entity.key, fields={"labels": test_entity.labels}
         )
-        self.api_wrapper.update_unstructured_test_definition(test_entity)
-        self.api_wrapper.remove_links(test_entity)
-        self.api_wrapper.link_test(test_entity)
-        self.api_wrapper.move_test_folder(test_entity)
+        return test_entity
 
 
 class _AddTestsToPlanWorker(_XrayBotWorker):
-    def run(
-        self, test_plan_key: str, test_key_and_ids: List[Tuple[str, Optional[str]]]
-    ):
-        logger.info(f"Start adding tests to test plan: {test_plan_key}")
-        test_issue_ids = []
-        for test_key, issue_id in test_key_and_ids:
-            if issue_id is None:
-                issue_id = self.api_wrapper.get_issue_id_by_key(test_key)
-            test_issue_ids.append(issue_id)
-        test_plan_issue_id = self.api_wrapper.get_issue_id_by_key(test_plan_key)
-        self.api_wrapper.add_tests_to_test_plan(test_plan_issue_id, test_issue_ids)
+    def run(self, test_plan_key: str, test_issue_ids: List[str]):
+        logger.info(
+            f"Start adding {len(test_issue_ids)} tests to test plan: {test_plan_key}"
+        )
+        self.api_wrapper.call_with_issue_id(
+            test_plan_key,
+            partial(
+                self.api_wrapper.add_tests_to_test_plan, test_issue_ids=test_issue_ids
+            ),
+        )
 
 
 class _AddTestsToExecutionWorker(_XrayBotWorker):
-    def run(
-        self, test_execution_key: str, test_key_and_ids: List[Tuple[str, Optional[str]]]
-    ):
-        logger.info(f"Start adding tests to test execution: {test_execution_key}")
-        test_issue_ids = []
-        for test_key, issue_id in test_key_and_ids:
-            if issue_id is None:
-                issue_id = self.api_wrapper.get_issue_id_by_key(test_key)
-            test_issue_ids.append(issue_id)
-        test_execution_issue_id = self.api_wrapper.get_issue_id_by_key(
-            test_execution_key
+    def run(self, test_execution_key: str, test_issue_ids: List[str]):
+        logger.info(
+            f"Start adding {len(test_issue_ids)} tests to test execution: {test_execution_key}"
         )
-        self.api_wrapper.add_tests_to_test_execution(
-            test_execution_issue_id, test_issue_ids
+        self.api_wrapper.call_with_issue_id(
+            test_execution_key,
+            partial(
+                self.api_wrapper.add_tests_to_test_execution,
+                test_issue_ids=test_issue_ids,
+            ),
         )
 
 
 class _UpdateTestResultsWorker(_XrayBotWorker):
     def run(self, test_execution_key: str, test_results: List[TestResultEntity]):
         logger.info(f"Start updating test results: {test_execution_key}")
-        headers = {
-            "Authorization": f"Bearer {self.context._xray_api_token}",
-            "Content-Type": "application/json",
-        }
         tests = [
             {
                 "testKey": t.key,
@@ -735,9 +1124,8 @@ class _UpdateTestResultsWorker(_XrayBotWorker):
             for t in test_results
         ]
         payload = {"testExecutionKey": test_execution_key, "tests": tests}
-        r = requests.post(
+        r = self.context.xray_session.post(
             f"{self.context._xray_url}/import/execution",
-            headers=headers,
             data=json.dumps(payload),
             timeout=10 * 60,
         )
@@ -745,57 +1133,49 @@ class _UpdateTestResultsWorker(_XrayBotWorker):
         return r.json()
 
 
+class _AttachEvidenceWorker(_XrayBotWorker):
+    def run(self, issue_key: str, test_key: str, path: str):
+        # prefix the test key, the evidences of all tests share the same issue
+        self.api_wrapper.attach_file(
+            issue_key, path, f"{test_key}_{os.path.basename(path)}"
+        )
+
+
 class _CleanTestExecutionWorker(_XrayBotWorker):
-    def run(self, test_execution_key: str, test_execution_tests: List[dict]):
-        test_execution_issue_id = self.api_wrapper.get_issue_id_by_key(
-            test_execution_key
-        )
-        to_be_deleted_test_issue_ids = [
-            _["issueId"]
-            for _ in test_execution_tests
-            if _["jira"]["status"]["name"] != "Finalized"
-        ]
-        if to_be_deleted_test_issue_ids:
-            to_be_deleted_test_issue_ids_param = ",".join(
-                [f'"{_}"' for _ in to_be_deleted_test_issue_ids]
-            )
-            logger.info(
-                f"Start removing tests from test execution: {to_be_deleted_test_issue_ids_param}"
-            )
-            payload = f"""
-            mutation {{
-                removeTestsFromTestExecution(issueId: "{test_execution_issue_id}", testIssueIds: [{to_be_deleted_test_issue_ids_param}])
-            }}
-            """
-            self.context.execute_xray_graphql(payload)
+    def run(self, test_execution_key: str, test_issue_ids: List[str]):
+        logger.info(
+            f"Start removing {len(test_issue_ids)} tests from test execution: {test_execution_key}"
+        )
+        self.api_wrapper.call_with_issue_id(
+            test_execution_key,
+            lambda test_execution_issue_id: self.context.execute_xray_graphql(
+                _graphql.REMOVE_TESTS_FROM_TEST_EXECUTION,
+                {"issueId": test_execution_issue_id, "testIssueIds": test_issue_ids},
+            ),
+        )
 
 
 class _CleanTestPlanWorker(_XrayBotWorker):
-    def run(self, test_plan_key: str, test_plan_tests: List[dict]):
-        test_plan_issue_id = self.api_wrapper.get_issue_id_by_key(test_plan_key)
-        to_be_deleted_test_issue_ids = [
-            _["issueId"]
-            for _ in test_plan_tests
-            if _["jira"]["status"]["name"] != "Finalized"
-        ]
-        if to_be_deleted_test_issue_ids:
-            to_be_deleted_test_issue_ids_param = ",".join(
-                [f'"{_}"' for _ in to_be_deleted_test_issue_ids]
-            )
-            logger.info(
-                f"Start removing tests from test plan: {to_be_deleted_test_issue_ids_param}"
-            )
-            payload = f"""
-            mutation {{
-                removeTestsFromTestPlan(issueId: "{test_plan_issue_id}", testIssueIds: [{to_be_deleted_test_issue_ids_param}])
-            }}
-            """
-            self.context.execute_xray_graphql(payload)
+    def run(self, test_plan_key: str, test_issue_ids: List[str]):
+        logger.info(
+            f"Start removing {len(test_issue_ids)} tests from test plan: {test_plan_key}"
+        )
+        self.api_wrapper.call_with_issue_id(
+            test_plan_key,
+            lambda test_plan_issue_id: self.context.execute_xray_graphql(
+                _graphql.REMOVE_TESTS_FROM_TEST_PLAN,
+                {"issueId": test_plan_issue_id, "testIssueIds": test_issue_ids},
+            ),
+        )
 
 
 class _BulkGetJiraDetailsWorker(_XrayBotWorker):
     def run(self, jira_keys: List[str]):
-        logger.info(f"Bulk checking jira keys: {jira_keys}...")
+        logger.event(
+            "bulk_get_jira_details",
+            "Bulk checking jira keys: %s",
+            Truncated(jira_keys),
+        )
         results = self.context.jira.bulk_issue(jira_keys, fields="status,issuetype")
         results = [
             (
@@ -813,18 +1193,20 @@ class _BulkGetJiraDetailsWorker(_XrayBotWorker):
 
 
 class _CleanRepoFolderWorker(_XrayBotWorker):
-    def run(self, folder_path: str):
-        logger.info(f"Start deleting empty folder: {folder_path}")
-        self.api_wrapper.delete_folder(folder_path)
+    def run(self, folder_paths: List[str]):
+        logger.info("Start deleting empty folders: %s", Truncated(folder_paths))
+        self.api_wrapper.delete_folders(folder_paths)
 
 
 class WorkerType(Enum):
     ObsoleteTest = _ObsoleteTestWorker
     ExternalMarkedTestUpdate = _ExternalMarkedTestUpdateWorker
     InternalMarkedTestUpdate = _InternalMarkedTestUpdateWorker
+    UpdateTestLabels = _UpdateTestLabelsWorker
     AddTestsToPlan = _AddTestsToPlanWorker
     AddTestsToExecution = _AddTestsToExecutionWorker
     UpdateTestResults = _UpdateTestResultsWorker
+    AttachEvidence = _AttachEvidenceWorker
     CleanTestExecution = _CleanTestExecutionWorker
     CleanTestPlan = _CleanTestPlanWorker
     BulkGetJiraDetails = _BulkGetJiraDetailsWorker
@@ -836,31 +1218,91 @@ class XrayBotWorkerMgr:
     def __init__(self, context: XrayBotContext):
         self.context = context
         self.api_wrapper = _XrayAPIWrapper(self.context)
+        self.cost_model = WorkerCostModel()
 
-    @staticmethod
-    def _worker_wrapper(worker_func, *iterables) -> WorkerResult:
-        try:
+    def estimate_cost(self, worker_type: WorkerType, *args) -> float:
+        """
+        :return: estimated seconds the worker runs for with the args
+        """
+        return self.cost_model.estimate(
+            worker_type.name, args, worker_type.value.operations
+        )
 
-            @retry(tries=3, delay=1, logger=logger)
-            def run_with_retry():
-                ret = worker_func(*iterables)
-                return WorkerResult(success=True, data=ret)
+    def load_cost_model(self):
+        """
+        Start from the latency learned by the previous runs, if cached.
+        """
+        metadata_cache = self.context.metadata_cache
+        if metadata_cache is not None:
+            self.cost_model.load(metadata_cache.get(COST_MODEL) or {})
+
+    def save_cost_model(self):
+        metadata_cache = self.context.metadata_cache
+        if metadata_cache is not None:
+            metadata_cache.put(COST_MODEL, self.cost_model.dump())
+
+    def _worker_wrapper(self, worker: _XrayBotWorker, *iterables) -> WorkerResult:
+        open_hosts = self.context.circuit_breaker.open_hosts
+        if open_hosts:
+            # fail fast, the pending workers drain without sending any request
+            return WorkerResult(
+                success=False,
+                data=f"{CANCELLED_MARK} Cancelled, circuit is open for: {', '.join(open_hosts)}",
+                cancelled=True,
+            )
+        with self.context.concurrency_slot():
+            return self._run_timed_worker(worker, *iterables)
+
+    def _run_timed_worker(self, worker: _XrayBotWorker, *iterables) -> WorkerResult:
+        start = time.monotonic()
+        result = self._run_worker(worker, *iterables)
+        if result.success:
+            self.cost_model.observe(
+                WorkerType(type(worker)).name,
+                iterables,
+                time.monotonic() - start,
+                worker.operations,
+            )
+        return result
 
-            return run_with_retry()
+    def _run_worker(self, worker: _XrayBotWorker, *iterables) -> WorkerResult:
+        try:
+            if worker.retry_run:
+                ret = self.context.retrier.call(
+                    WorkerType(type(worker)).name, lambda: worker.run(*iterables)
+                )
+            else:
+                ret = worker.run(*iterables)
+            return WorkerResult(success=True, data=ret)
         except Exception as e:
             logger.info(
-                f"Worker [{worker_func.__qualname__.split('.')[0].lstrip('_')}] raised error: {e}"
+                f"Worker [{type(worker).__name__.lstrip('_')}] raised error: {e}"
             )
             converted = [str(_) for _ in iterables]
             err_msg = f"❌{e} -> 🐛{' | '.join(converted)}"
             return WorkerResult(success=False, data=err_msg)
 
+    def run_worker(self, worker_type: WorkerType, *args) -> WorkerResult:
+        worker: _XrayBotWorker = worker_type.value(self.api_wrapper)
+        return self._worker_wrapper(worker, *args)
+
     def start_worker(self, worker_type: WorkerType, *iterables) -> List[WorkerResult]:
+        """
+        The largest tasks, by links and list items, are started first, so a few
+        slow tasks at the end of the input never decide when all the tasks finish.
+        The tasks share the worker type, its cost model would rank them by size
+        all the same.
+        :return: results in the input order
+        """
         worker: _XrayBotWorker = worker_type.value(self.api_wrapper)
-        with ThreadPoolExecutor(self.context.config.worker_num) as executor:
-            results = executor.map(
-                self._worker_wrapper,
-                [worker.run for _ in range(len(iterables[0]))],
-                *iterables,
-            )
-            return list(results)
+        tasks = list(zip(*iterables))
+        order = sorted(
+            range(len(tasks)), key=lambda idx: task_size(tasks[idx]), reverse=True
+        )
+        futures = {
+            idx: self.context.executor.submit(self._worker_wrapper, worker, *tasks[idx])
+            for idx in order
+        }
+        results = [futures[idx].result() for idx in range(len(tasks))]
+        self.save_cost_model()
+        return results
@@ -1,9 +1,44 @@
 import copy
-from typing import List, Union, Optional, Tuple
+import dataclasses
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    List,
+    Union,
+    Optional,
+    Tuple,
+    Dict,
+    Iterable,
+    Iterator,
+    Set,
+    FrozenSet,
+)
 from ._context import XrayBotContext
-from ._data import TestEntity, TestResultEntity
-from ._utils import logger
-from ._worker import WorkerType, XrayBotWorkerMgr
+from ._data import TestEntity, TestResultEntity, WorkerResult
+from ._journal import MAX_SNAPSHOT_AGE, SyncJournal, test_fingerprint
+from ._resilience import RetryBudget, RetryPolicy, is_fatal_error
+from ._scheduler import DependencyScheduler
+from ._shard import (
+    PARTITION_BY_KEY,
+    partition_tests,
+    dump_tests,
+    load_tests,
+    write_shard_manifest,
+    read_shard_manifests,
+)
+from ._graphql import MAX_FOLDERS_PER_DELETE_BATCH, MAX_TESTS_PER_MUTATION
+from ._utils import logger, jira_key_order
+from ._webhook import XrayWebhookReceiver
+from ._worker import (
+    MAX_ISSUES_PER_BULK_EDIT,
+    MAX_KEYS_PER_ISSUE_ID_SEARCH,
+    WorkerType,
+    XrayBotWorkerMgr,
+)
 
 
 class XrayBot:
@@ -12,6 +47,10 @@ class XrayBot:
     _MULTI_PROCESS_WORKER_NUM = 30
     _AUTOMATION_TESTS_FOLDER_NAME = "Automation Test"
     _AUTOMATION_OBSOLETE_TESTS_FOLDER_NAME = "Obsolete"
+    _TEST_INDEX_TTL = 0
+    # a bulk edit costs a request and the polling of its task, smaller groups of
+    # label changes are updated test by test
+    _MIN_TESTS_PER_BULK_EDIT = 10
 
     def __init__(
         self,
@@ -28,22 +67,36 @@ class XrayBot:
         :param jira_pwd: str
         :param project_key: str, jira project key, e.g: "TEST"
         """
-        self.context = XrayBotContext(
-            jira_url,
-            jira_username,
-            jira_pwd,
-            jira_account_id,
-            project_key,
-            timeout=self._JIRA_API_TIMEOUT,
-            xray_api_token=xray_api_token,
+        self._setup(
+            XrayBotContext(
+                jira_url,
+                jira_username,
+                jira_pwd,
+                jira_account_id,
+                project_key,
+                timeout=self._JIRA_API_TIMEOUT,
+                xray_api_token=xray_api_token,
+                pool_size=self._MULTI_PROCESS_WORKER_NUM,
+            )
         )
+
+    @classmethod
+    def _from_context(cls, context: XrayBotContext) -> "XrayBot":
+        bot = cls.__new__(cls)
+        bot._setup(context)
+        return bot
+
+    def _setup(self, context: XrayBotContext):
+        self.context = context
         self.config = self.context.config
         self.config.configure_worker_num(self._MULTI_PROCESS_WORKER_NUM)
         self.config.configure_automation_folder_name(self._AUTOMATION_TESTS_FOLDER_NAME)
         self.config.configure_obsolete_automation_folder_name(
             self._AUTOMATION_OBSOLETE_TESTS_FOLDER_NAME
         )
+        self.config.configure_test_index_ttl(self._TEST_INDEX_TTL)
         self.worker_mgr = XrayBotWorkerMgr(self.context)
+        self._webhook_receiver: Optional[XrayWebhookReceiver] = None
 
     def configure_custom_field(
         self, field_name: str, field_value: Union[str, List[str]]
@@ -55,12 +108,195 @@ class XrayBot:
         """
         self.config.configure_custom_field(field_name, field_value)
 
-    def get_xray_tests(self, filter_by_cf: bool = True) -> List[TestEntity]:
-        logger.info(
-            f"Start querying all xray tests for project: {self.context.project_key}"
+    def configure_test_index_ttl(self, ttl: float):
+        """
+        :param ttl: float, seconds the xray tests listing and the test plan/execution
+        lookups are reused across calls, 0 disables the reuse
+        """
+        self.config.configure_test_index_ttl(ttl)
+
+    def configure_circuit_breaker(self, failure_threshold: int, reset_timeout: float):
+        """
+        Requests to a host fail immediately once its circuit opens, either on an
+        authentication error or on consecutive server errors, the pending workers
+        are then cancelled.
+        :param failure_threshold: int, consecutive server errors opening a host circuit
+        :param reset_timeout: float, seconds before an open host is tried again
+        """
+        self.context.circuit_breaker.configure(failure_threshold, reset_timeout)
+
+    def configure_host_concurrency(self, jira_limit: int, xray_limit: int):
+        """
+        Bound the in-flight requests of each host, summed over all the workers and
+        listings, by default each host allows as many requests as the worker number.
+        :param jira_limit: int, max in-flight requests to the jira host
+        :param xray_limit: int, max in-flight requests to the xray host
+        """
+        self.context.configure_host_concurrency(jira_limit, xray_limit)
+
+    def configure_retry_policy(
+        self,
+        default_policy: Optional[RetryPolicy] = None,
+        overrides: Optional[Dict[str, RetryPolicy]] = None,
+        budget_ratio: float = 0.2,
+        min_retries: int = 10,
+    ):
+        """
+        Only transient errors are retried: connection errors, timeouts, 408, 429
+        and 5xx responses and GraphQL throttling, timeout or internal errors, with
+        exponential backoff and jitter.
+        :param default_policy: policy of all the operations without override
+        :param overrides: policy by operation name, either a worker type name,
+        e.g: "UpdateTestResults", or a test update step name, e.g: "move_test_folder"
+        :param budget_ratio: float, retries allowed per call in each run
+        :param min_retries: int, retries always allowed in each run
+        """
+        retrier = self.context.retrier
+        if default_policy is not None:
+            retrier.default_policy = default_policy
+        if overrides is not None:
+            retrier.overrides.update(overrides)
+        retrier.budget = RetryBudget(budget_ratio, min_retries)
+
+    def configure_cassette(
+        self, path: str, mode: str = "record", latency_scale: float = 1.0
+    ):
+        """
+        Record every jira and xray request with its response and latency into a
+        cassette file, or serve the recorded responses back without network access,
+        e.g: to measure a sync offline. The cassette is written until the bot is
+        closed, the request headers are never recorded.
+        :param path: str, cassette file
+        :param mode: str, "record" or "replay"
+        :param latency_scale: float, replayed latency relative to the recorded one,
+        0 replays as fast as possible
+        """
+        self.context.configure_cassette(path, mode, latency_scale)
+
+    def configure_metadata_cache(
+        self, cache_dir: str, ttls: Optional[Dict[str, float]] = None
+    ):
+        """
+        Keep the project id, custom fields, folders, test plan/execution keys and
+        issue ids on disk, so the next bot process starts without querying them.
+        Cached values are trusted until their ttl expires. The cached folders and
+        issue ids are validated on use: leading to a not found or validation
+        error, they are queried again and the request retried once. All the values
+        are dropped once an operation using them fails. The cache file is written
+        when the bot is closed or the process exits. The latency
+        learned for each worker type is kept too, to order the first tasks.
+        :param cache_dir: str, directory of the cache files
+        :param ttls: seconds to trust each entry for, by entry name: "project_id",
+        "custom_fields", "folders", "test_plans", "test_executions", "issue_ids",
+        "cost_model"
+        """
+        self.context.configure_metadata_cache(cache_dir, ttls)
+        self.worker_mgr.load_cost_model()
+
+    def configure_evidence_upload(self, max_concurrency: int, max_in_flight_bytes: int):
+        """
+        Evidence files of the test results are streamed from disk to the test
+        execution attachments, in parallel with the results import, by their own
+        threads.
+        :param max_concurrency: int, max concurrent evidence uploads, and number
+        of upload threads
+        :param max_in_flight_bytes: int, max total size of the evidences being
+        uploaded, a larger evidence is uploaded alone
+        """
+        self.worker_mgr.api_wrapper.attachment_budget.configure(
+            max_concurrency, max_in_flight_bytes
+        )
+
+    def start_webhook_receiver(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        secret: Optional[str] = None,
+        reconcile_interval: float = 3600,
+    ) -> XrayWebhookReceiver:
+        """
+        Keep a live mirror of the automated tests from the jira webhooks of the
+        test issues: "jira:issue_created", "jira:issue_updated",
+        "jira:issue_deleted", "issuelink_created" and "issuelink_deleted".
+        `get_xray_tests` is served from the mirror once it is loaded.
+        :param host: str, host to listen on
+        :param port: int, port to listen on, a free port is picked if 0
+        :param secret: str, secret of the jira webhook
+        :param reconcile_interval: float, seconds between full queries of the tests
+        :return: the started receiver, call `changes_since` for the changed tests
+        """
+        assert self._webhook_receiver is None, "Webhook receiver already started"
+        automation_folder_name = self.config.automation_folder_name
+
+        def _query_tests() -> List[TestEntity]:
+            self.worker_mgr.api_wrapper.init_automation_folder()
+            return self._query_xray_tests(filter_by_cf=True)
+
+        def _query_test(issue: str) -> Optional[TestEntity]:
+            return self.worker_mgr.api_wrapper.get_xray_test_by_repo_folder(
+                issue,
+                automation_folder_name,
+                self._get_customized_field_jql(filter_by_cf=True),
+            )
+
+        self._webhook_receiver = XrayWebhookReceiver(
+            _query_tests, _query_test, host, port, secret, reconcile_interval
         )
+        self._webhook_receiver.start()
+        return self._webhook_receiver
+
+    def stop_webhook_receiver(self):
+        if self._webhook_receiver is not None:
+            self._webhook_receiver.stop()
+            self._webhook_receiver = None
+
+    def close(self):
+        """
+        Stop the webhook receiver and the worker threads, waiting for the running
+        tasks. The bot can still be used afterward, the threads start again.
+        """
+        self.stop_webhook_receiver()
+        self.worker_mgr.save_cost_model()
+        self.context.close()
+
+    def __enter__(self) -> "XrayBot":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def invalidate_test_index(self):
+        """
+        Drop the indexed xray tests, test plans/executions and issue ids,
+        the next call will query them from xray again.
+        """
+        self.context.test_index.invalidate()
+
+    def get_xray_tests(
+        self, filter_by_cf: bool = True, use_index: bool = True
+    ) -> List[TestEntity]:
+        """
+        :param filter_by_cf: bool, only query tests matching the configured custom fields
+        :param use_index: bool, reuse the indexed tests if they are not expired, or
+        the tests mirrored by the webhook receiver
+        """
+        if use_index and filter_by_cf and self._webhook_receiver is not None:
+            mirrored_tests = self._webhook_receiver.mirror.get_tests()
+            if mirrored_tests is not None:
+                return mirrored_tests
+        if use_index:
+            indexed_tests = self.context.test_index.get_tests(
+                self._get_tests_filter(filter_by_cf)
+            )
+            if indexed_tests is not None:
+                logger.info(
+                    f"Using indexed xray tests for project: {self.context.project_key}"
+                )
+                return indexed_tests
         self.worker_mgr.api_wrapper.init_automation_folder()
+        return self._query_xray_tests(filter_by_cf)
 
+    def _get_customized_field_jql(self, filter_by_cf: bool) -> str:
         customized_field_jql = ""
         if filter_by_cf:
             for k, v in self.config.custom_fields.items():
@@ -71,90 +307,67 @@ class XrayBot:
                     )
                 else:
                     customized_field_jql = f"{customized_field_jql} and '{k}' = '{v}'"
+        return customized_field_jql
+
+    def _get_tests_filter(self, filter_by_cf: bool) -> str:
+        return f"{self.config.automation_folder_name}|{self._get_customized_field_jql(filter_by_cf)}"
 
-        issues = self.worker_mgr.api_wrapper.get_xray_tests_by_repo_folder(
+    def _query_xray_tests(self, filter_by_cf: bool) -> List[TestEntity]:
+        # the automation folder is expected to be initialized
+        logger.info(
+            f"Start querying all xray tests for project: {self.context.project_key}"
+        )
+        customized_field_jql = self._get_customized_field_jql(filter_by_cf)
+        tests = self.worker_mgr.api_wrapper.get_xray_tests_by_repo_folder(
             self.config.automation_folder_name, customized_field_jql
         )
-        tests = []
-        for issue in issues:
-            desc = issue["jira"]["description"]
-            desc = desc if desc is not None else ""
-            links = issue["jira"]["issuelinks"]
-            labels = issue["jira"]["labels"]
-            req_keys = [
-                _["outwardIssue"]["key"]
-                for _ in links
-                if _["type"]["name"] == "Test" and _.get("outwardIssue")
-            ]
-            defect_keys = [
-                _["outwardIssue"]["key"]
-                for _ in links
-                if _["type"]["name"] == "Defect" and _.get("outwardIssue")
-            ]
-            test = TestEntity(
-                key=issue["jira"]["key"],
-                unique_identifier=issue["unstructured"],
-                summary=issue["jira"]["summary"],
-                description=desc,
-                labels=labels,
-                repo_path=issue["folder"]["path"].split("/")[2:],
-                req_keys=req_keys,
-                defect_keys=defect_keys,
-                issue_id=issue["issueId"],
-            )
-            tests.append(test)
         self._check_tests_uniqueness(
             tests,
             "Duplicated key/unique_identifier found in xray tests, you have to fix them manually.",
         )
+        self.context.test_index.put_tests(self._get_tests_filter(filter_by_cf), tests)
+        return tests
+
+    def _query_xray_tests_by_keys(
+        self, keys: Set[Optional[str]]
+    ) -> Dict[Optional[str], TestEntity]:
+        """
+        Query the current xray tests of the given keys, in chunks of keys.
+        :return: xray tests by key, tests obsolete or moved out of the automation folder are missing
+        """
+        customized_field_jql = self._get_customized_field_jql(filter_by_cf=True)
+        sorted_keys = sorted(_ for _ in keys if _ is not None)
+        tests: Dict[Optional[str], TestEntity] = {}
+        for i in range(0, len(sorted_keys), MAX_KEYS_PER_ISSUE_ID_SEARCH):
+            chunk = sorted_keys[i : i + MAX_KEYS_PER_ISSUE_ID_SEARCH]
+            tests.update(
+                (_.key, _)
+                for _ in self.worker_mgr.api_wrapper.get_xray_tests_by_repo_folder(
+                    self.config.automation_folder_name,
+                    f"{customized_field_jql} and key in ({', '.join(json.dumps(_) for _ in chunk)})",
+                )
+            )
         return tests
 
     @staticmethod
     def _check_tests_uniqueness(tests: List[TestEntity], error_msg):
-        unique_identifiers = [t.unique_identifier for t in tests]
+        unique_identifiers = Counter(t.unique_identifier for t in tests)
         duplicated_tests = [
             f"({idx + 1}) {t}"
             for idx, t in enumerate(tests)
-            if unique_identifiers.count(t.unique_identifier) > 1
+            if unique_identifiers[t.unique_identifier] > 1
         ]
         error_msg = error_msg + "\n" + "\n".join(duplicated_tests)
         assert len(duplicated_tests) == 0, error_msg
-        keys = [t.key for t in tests if t.key is not None]
+        keys = Counter(t.key for t in tests if t.key is not None)
         duplicated_tests = [
             f"({idx + 1}) {t}"
             for idx, t in enumerate(tests)
-            if t.key is not None and keys.count(t.key) > 1
+            if t.key is not None and keys[t.key] > 1
         ]
         error_msg = error_msg + "\n" + "\n".join(duplicated_tests)
         assert len(duplicated_tests) == 0, error_msg
 
-    @staticmethod
-    def _categorize_local_tests(
-        xray_tests: List[TestEntity], local_tests: List[TestEntity]
-    ):
-        xray_tests_keys = [_.key for _ in xray_tests]
-        local_tests_keys = [_.key for _ in local_tests]
-        to_be_obsolete_xray_tests = list()
-        external_marked_local_tests = list()
-        internal_marked_local_tests = list()
-        for local_test in local_tests:
-            if local_test.key in xray_tests_keys:
-                matched_xray_test = [t for t in xray_tests if t.key == local_test.key][
-                    0
-                ]
-                local_test.issue_id = matched_xray_test.issue_id
-                internal_marked_local_tests.append(local_test)
-            else:
-                external_marked_local_tests.append(local_test)
-        for xray_test in xray_tests:
-            if xray_test.key not in local_tests_keys:
-                to_be_obsolete_xray_tests.append(xray_test)
-        return (
-            to_be_obsolete_xray_tests,
-            internal_marked_local_tests,
-            external_marked_local_tests,
-        )
-
     def create_tests_draft(self, local_tests: List[TestEntity]) -> List[TestEntity]:
         """
         Input: local tests including no existing jira key
@@ -181,11 +394,200 @@ class XrayBot:
         errors = [result.data for result in worker_results if not result.success]
         err_msg = "\n".join(errors)
         assert len(errors) == 0, f"Create draft test failed:\n {err_msg}"
+        for result in worker_results:
+            self.context.test_index.put_issue_id(result.data.key, result.data.issue_id)
         results = to_be_remained + [_.data for _ in worker_results]
         return results
 
-    def sync_tests(self, local_tests: List[TestEntity]):
-        worker_results = []
+    def sync_tests(
+        self,
+        local_tests: List[TestEntity],
+        journal_path: Optional[str] = None,
+        resume: bool = False,
+        journal_max_age: float = MAX_SNAPSHOT_AGE,
+    ):
+        """
+        :param local_tests: local tests marked with keys
+        :param journal_path: str, record the xray tests snapshot and each completed
+        per-test operation into this file, it is removed once the sync succeeds
+        :param resume: bool, resume an interrupted sync from the journal, the
+        snapshot is reused and the completed operations are skipped, once xray is
+        checked to still have their result
+        :param journal_max_age: float, seconds the snapshot is reused for, an older
+        journal is ignored and the xray tests are queried again
+        """
+        self.context.retrier.budget.reset()
+        self._prepare_local_tests_for_sync(local_tests)
+        journal = (
+            SyncJournal(journal_path, self.context.project_key, resume, journal_max_age)
+            if journal_path is not None
+            else None
+        )
+        completed = False
+        try:
+            worker_results, synced_tests = self._run_sync_tasks(
+                local_tests, journal=journal
+            )
+            self._check_sync_results(worker_results)
+            self.context.test_index.upsert_tests(synced_tests)
+            self._clean_empty_repo_folders()
+            completed = True
+        finally:
+            if journal is not None:
+                # kept for the resume unless the sync is completed
+                journal.close(remove=completed)
+
+    def sync_tests_streaming(
+        self, local_tests: Iterable[TestEntity], max_in_flight: Optional[int] = None
+    ):
+        """
+        Sync with a memory use independent of the number of tests: the local tests
+        and the xray tests sorted by key are merged as two streams, and each
+        operation is sent as soon as the merge finds it.
+        :param local_tests: local tests marked with keys, sorted by key: by the
+        project key, then by the issue number, e.g: a generator reading a file
+        :param max_in_flight: int, max pending operations, twice the worker number
+        if not specified
+        """
+        self.context.retrier.budget.reset()
+        api_wrapper = self.worker_mgr.api_wrapper
+        api_wrapper.init_automation_folder()
+        folder_model = api_wrapper.start_folder_model()
+        automation_folder = f"/{self.config.automation_folder_name}"
+        existing_folders: Set[Tuple[str, ...]] = set()
+        max_in_flight = max_in_flight or 2 * self.config.worker_num
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+        lock = threading.Lock()
+        failed_results: List[WorkerResult] = []
+        succeeded = 0
+
+        def _on_done(future):
+            nonlocal succeeded
+            try:
+                if future.cancelled():
+                    result = WorkerResult(
+                        success=False, data="❌Worker cancelled", cancelled=True
+                    )
+                elif future.exception() is not None:
+                    result = WorkerResult(success=False, data=f"❌{future.exception()}")
+                else:
+                    result = future.result()
+                with lock:
+                    if result.success:
+                        succeeded += 1
+                    else:
+                        failed_results.append(result)
+            finally:
+                # always freed, the final wait for all the slots never hangs
+                in_flight.release()
+
+        def _submit(worker_type: WorkerType, test: TestEntity):
+            in_flight.acquire()
+            try:
+                future = self.context.executor.submit(
+                    self.worker_mgr.run_worker, worker_type, test
+                )
+            except BaseException:
+                in_flight.release()
+                raise
+            future.add_done_callback(_on_done)
+
+        def _sync(local_test: TestEntity, xray_test: Optional[TestEntity]):
+            nonlocal succeeded
+            worker_type = self._get_sync_worker_type(local_test, xray_test)
+            if worker_type is None:
+                with lock:
+                    succeeded += 1
+                return
+            # folders are created in the merge thread, once per folder
+            for depth in range(1, len(local_test.repo_path) + 1):
+                folder_path = tuple(local_test.repo_path[:depth])
+                if folder_path not in existing_folders:
+                    api_wrapper.create_repo_folder(
+                        "/".join((automation_folder,) + folder_path)
+                    )
+                    existing_folders.add(folder_path)
+            _submit(worker_type, local_test)
+
+        local_iter = self._iter_sorted_tests(
+            self._iter_local_tests_for_sync(local_tests), "local"
+        )
+        xray_iter = self._iter_sorted_tests(
+            api_wrapper.iter_xray_tests_by_repo_folder(
+                self.config.automation_folder_name,
+                self._get_customized_field_jql(filter_by_cf=True),
+            ),
+            "xray",
+        )
+        try:
+            local_test = next(local_iter, None)
+            xray_test = next(xray_iter, None)
+            while local_test is not None or xray_test is not None:
+                if xray_test is not None:
+                    folder_model.track_tests([xray_test], automation_folder)
+                if xray_test is None or (
+                    local_test is not None
+                    and jira_key_order(local_test.key) < jira_key_order(xray_test.key)
+                ):
+                    assert local_test is not None
+                    _sync(local_test, None)
+                    local_test = next(local_iter, None)
+                elif local_test is None or jira_key_order(
+                    xray_test.key
+                ) < jira_key_order(local_test.key):
+                    # test only exists in xray tests while not in local tests
+                    _submit(WorkerType.ObsoleteTest, xray_test)
+                    xray_test = next(xray_iter, None)
+                else:
+                    _sync(local_test, xray_test)
+                    local_test = next(local_iter, None)
+                    xray_test = next(xray_iter, None)
+        finally:
+            # wait for the pending operations
+            for _ in range(max_in_flight):
+                in_flight.acquire()
+        # the synced tests are not kept, query them again next time
+        self.context.test_index.invalidate()
+        self._check_sync_results(failed_results, succeeded)
+        self._clean_empty_repo_folders()
+
+    @staticmethod
+    def _iter_local_tests_for_sync(
+        local_tests: Iterable[TestEntity],
+    ) -> Iterator[TestEntity]:
+        for local_test in local_tests:
+            assert local_test.key is not None, (
+                f"Local test {local_test} requires key in sync"
+            )
+            # make sure all local test keys will be considered as upper case
+            local_test.key = local_test.key.upper()
+            yield local_test
+
+    @staticmethod
+    def _iter_sorted_tests(
+        tests: Iterable[TestEntity], source: str
+    ) -> Iterator[TestEntity]:
+        """
+        Check the tests are sorted by key while streaming them, which also finds
+        the duplicated keys, only the unique identifiers are kept to find their
+        duplicates.
+        """
+        last_key = None
+        unique_identifiers: Set[str] = set()
+        for test in tests:
+            assert last_key is None or jira_key_order(last_key) < jira_key_order(
+                test.key
+            ), (
+                f"Duplicated or unsorted key found in {source} tests: {test.key} after {last_key}"
+            )
+            assert test.unique_identifier not in unique_identifiers, (
+                f"Duplicated unique_identifier found in {source} tests: {test}"
+            )
+            unique_identifiers.add(test.unique_identifier)
+            last_key = test.key
+            yield test
+
+    def _prepare_local_tests_for_sync(self, local_tests: List[TestEntity]):
         # make sure all local test keys will be considered as upper case
         for local_test in local_tests:
             if local_test.key is not None:
@@ -196,103 +598,558 @@ class XrayBot:
         self._check_tests_uniqueness(
             local_tests, "Duplicated key/unique_identifier found in local tests"
         )
-        self.worker_mgr.api_wrapper.prepare_repo_folder_hierarchy(local_tests)
-        xray_tests = self.get_xray_tests()
-        (
-            to_be_obsolete_xray_tests,
-            internal_marked_local_tests,
-            external_marked_local_tests,
-        ) = self._categorize_local_tests(xray_tests, local_tests)
-        if external_marked_local_tests:
-            # external marked test -> strategy: update and move to automation folder
-            worker_results.extend(
-                self.worker_mgr.start_worker(
-                    WorkerType.ExternalMarkedTestUpdate, external_marked_local_tests
-                )
-            )
-        if internal_marked_local_tests:
-            # internal marked test -> strategy: update all fields including unique identifier
-            filtered_xray_tests = [
-                xray_test
-                for xray_test in xray_tests
-                if xray_test.key in [_.key for _ in internal_marked_local_tests]
-            ]
-            to_be_updated = self._get_internal_marked_tests_diff(
-                filtered_xray_tests, internal_marked_local_tests
+
+    def _run_sync_tasks(
+        self,
+        local_tests: List[TestEntity],
+        journal: Optional[SyncJournal] = None,
+        snapshot_path: Optional[str] = None,
+        obsolete: bool = True,
+    ) -> Tuple[List[WorkerResult], List[TestEntity]]:
+        """
+        Schedule the sync as per-test tasks instead of barrier separated batches:
+        - the xray tests are queried while the repo folders are being created
+        - a local test is synced once its folder exists and the xray tests are known
+        - obsolete tests are handled alongside the local tests
+        - tests only differing by their labels are grouped into bulk label edits
+        :return: results of all tasks, local tests synced successfully
+        """
+        api_wrapper = self.worker_mgr.api_wrapper
+        api_wrapper.init_automation_folder()
+        # load the folders once before the folder tasks read them concurrently
+        folder_model = api_wrapper.start_folder_model()
+        scheduler = DependencyScheduler(self.context.executor)
+        xray_tests_by_key: Dict[Optional[str], TestEntity] = {}
+        local_tests_keys = set(_.key for _ in local_tests)
+        xray_tests_task = "query_xray_tests"
+        # keys of the tests synced by the bulk label edits, and of those failed
+        labels_keys: Set[Optional[str]] = set()
+        failed_labels_keys: Set[Optional[str]] = set()
+
+        def _sync_cost(local_test: TestEntity) -> float:
+            if local_test.key in labels_keys:
+                return 0.0
+            worker_type = self._get_sync_worker_type(
+                local_test, xray_tests_by_key.get(local_test.key)
             )
-            worker_results.extend(
-                self.worker_mgr.start_worker(
-                    WorkerType.InternalMarkedTestUpdate, to_be_updated
+            if worker_type is None:
+                return 0.0
+            return self.worker_mgr.estimate_cost(worker_type, local_test)
+
+        def _add_sync_tasks():
+            # the dependents of a task start in the order they are added, start
+            # the most expensive tests first, estimated by their actual worker
+            for local_test in sorted(local_tests, key=_sync_cost, reverse=True):
+                deps = [xray_tests_task]
+                if local_test.repo_path:
+                    deps.append(f"folder:{'/'.join(local_test.repo_path)}")
+                scheduler.add(
+                    f"sync:{local_test.key}",
+                    partial(
+                        self._sync_local_test,
+                        local_test,
+                        xray_tests_by_key,
+                        journal,
+                        labels_keys,
+                    ),
+                    deps,
                 )
-            )
 
-        # test only exists in xray tests while not in local tests
-        if to_be_obsolete_xray_tests:
-            worker_results.extend(
-                self.worker_mgr.start_worker(
-                    WorkerType.ObsoleteTest, to_be_obsolete_xray_tests
+        def _query_xray_tests():
+            try:
+                _load_xray_tests()
+            finally:
+                # added even if the query fails, the tests are cancelled by it
+                _add_sync_tasks()
+
+        def _load_xray_tests():
+            if journal is not None and journal.snapshot is not None:
+                logger.info("Resume sync with xray tests snapshot from journal")
+                xray_tests = journal.snapshot
+                self._confirm_completed_operations(journal)
+            elif snapshot_path is not None:
+                xray_tests = load_tests(snapshot_path, self.context.project_key)
+            else:
+                xray_tests = self._query_xray_tests(filter_by_cf=True)
+                if journal is not None:
+                    journal.record_snapshot(xray_tests)
+            xray_tests_by_key.update({_.key: _ for _ in xray_tests})
+            folder_model.track_tests(xray_tests, automation_folder)
+            labels_changes = [
+                (local_test, xray_tests_by_key[local_test.key])
+                for local_test in local_tests
+                if local_test.key in xray_tests_by_key
+                and self._is_labels_only_change(
+                    local_test, xray_tests_by_key[local_test.key]
                 )
+                and not (
+                    journal is not None
+                    and journal.is_completed(
+                        WorkerType.InternalMarkedTestUpdate.name,
+                        local_test.key,
+                        test_fingerprint(local_test),
+                    )
+                )
+            ]
+            if labels_changes:
+                labels_keys.update(_.key for _, __ in labels_changes)
+                scheduler.add(
+                    "labels",
+                    partial(
+                        self._sync_labels_changes,
+                        labels_changes,
+                        failed_labels_keys,
+                        journal,
+                    ),
+                )
+            if obsolete:
+                for xray_test in xray_tests:
+                    # test only exists in xray tests while not in local tests
+                    if xray_test.key not in local_tests_keys:
+                        scheduler.add(
+                            f"obsolete:{xray_test.key}",
+                            partial(
+                                self._run_test_worker,
+                                WorkerType.ObsoleteTest,
+                                xray_test,
+                                journal,
+                            ),
+                        )
+
+        scheduler.add(xray_tests_task, _query_xray_tests)
+        automation_folder = f"/{self.config.automation_folder_name}"
+        folder_paths = set()
+        for local_test in local_tests:
+            for depth in range(1, len(local_test.repo_path) + 1):
+                folder_paths.add(tuple(local_test.repo_path[:depth]))
+        for folder_path in folder_paths:
+            scheduler.add(
+                f"folder:{'/'.join(folder_path)}",
+                partial(
+                    api_wrapper.create_repo_folder,
+                    "/".join((automation_folder,) + folder_path),
+                ),
+                [f"folder:{'/'.join(folder_path[:-1])}"]
+                if len(folder_path) > 1
+                else [],
+            )
+        results = scheduler.run()
+        synced_tests = [
+            _
+            for _ in local_tests
+            if results[f"sync:{_.key}"].success and _.key not in failed_labels_keys
+        ]
+        if obsolete:
+            self.context.test_index.remove_tests(
+                [
+                    key
+                    for key in xray_tests_by_key
+                    if key is not None
+                    and key not in local_tests_keys
+                    and results[f"obsolete:{key}"].success
+                ]
             )
+        return list(results.values()), synced_tests
+
+    @staticmethod
+    def _get_sync_worker_type(
+        local_test: TestEntity, xray_test: Optional[TestEntity]
+    ) -> Optional[WorkerType]:
+        """
+        :return: the worker syncing the local test, None if it is up to date
+        """
+        if xray_test is None:
+            # external marked test -> strategy: update and move to automation folder
+            return WorkerType.ExternalMarkedTestUpdate
+        local_test.issue_id = xray_test.issue_id
+        if local_test == xray_test:
+            return None
+        # internal marked test -> strategy: update all fields including unique identifier
+        return WorkerType.InternalMarkedTestUpdate
+
+    @staticmethod
+    def _is_labels_only_change(local_test: TestEntity, xray_test: TestEntity) -> bool:
+        return local_test != xray_test and local_test == dataclasses.replace(
+            xray_test, labels=local_test.labels
+        )
+
+    def _sync_labels_changes(
+        self,
+        labels_changes: List[Tuple[TestEntity, TestEntity]],
+        failed_keys: Set[Optional[str]],
+        journal: Optional[SyncJournal] = None,
+    ) -> WorkerResult:
+        """
+        Sync the tests only differing from xray by their labels, the tests adding
+        and removing the same labels are edited together by jira bulk edit tasks,
+        the tests of small groups or failed by a bulk edit are updated one by one.
+        :param labels_changes: list of (local test, xray test)
+        :param failed_keys: set, filled with the keys of the tests not synced
+        """
+        # all failed until synced, in case this task raises
+        failed_keys.update(local_test.key for local_test, _ in labels_changes)
+        # fingerprint before running, as the per-test workers do
+        fingerprints = {
+            local_test.key: test_fingerprint(local_test)
+            for local_test, _ in labels_changes
+        }
+        groups: Dict[Tuple[FrozenSet[str], FrozenSet[str]], List[TestEntity]] = {}
+        for local_test, xray_test in labels_changes:
+            local_test.issue_id = xray_test.issue_id
+            added = frozenset(local_test.labels) - frozenset(xray_test.labels)
+            removed = frozenset(xray_test.labels) - frozenset(local_test.labels)
+            groups.setdefault((added, removed), []).append(local_test)
+        api_wrapper = self.worker_mgr.api_wrapper
+        bulk_available = True
+        per_test_updates: List[TestEntity] = []
+        for (added, removed), tests in groups.items():
+            if not bulk_available or len(tests) < self._MIN_TESTS_PER_BULK_EDIT:
+                per_test_updates.extend(tests)
+                continue
+            for start in range(0, len(tests), MAX_ISSUES_PER_BULK_EDIT):
+                chunk = tests[start : start + MAX_ISSUES_PER_BULK_EDIT]
+                issue_ids = [str(_.issue_id) for _ in chunk]
+                failed_ids: Set[str] = set()
+                try:
+                    for option, labels in (("ADD", added), ("REMOVE", removed)):
+                        if labels:
+                            failed_ids.update(
+                                self.context.retrier.call(
+                                    "bulk_edit_labels",
+                                    partial(
+                                        api_wrapper.bulk_edit_labels,
+                                        issue_ids,
+                                        sorted(labels),
+                                        option,
+                                    ),
+                                )
+                            )
+                except Exception as e:
+                    if is_fatal_error(e):
+                        raise
+                    # e.g: bulk edit not allowed, the next groups skip it
+                    logger.warning(f"Bulk edit failed, update tests one by one: {e}")
+                    bulk_available = False
+                    failed_ids.update(issue_ids)
+                per_test_updates.extend(_ for _ in chunk if _.issue_id in failed_ids)
+        per_test_keys = set(_.key for _ in per_test_updates)
+        worker_results = self.worker_mgr.start_worker(
+            WorkerType.UpdateTestLabels, per_test_updates
+        )
+        failed_keys.difference_update(
+            local_test.key for local_test, _ in labels_changes
+        )
+        failed_keys.update(
+            test.key
+            for test, result in zip(per_test_updates, worker_results)
+            if not result.success
+        )
+        if journal is not None:
+            for local_test, _ in labels_changes:
+                if local_test.key not in failed_keys:
+                    journal.record_completed(
+                        WorkerType.InternalMarkedTestUpdate.name,
+                        local_test.key,
+                        fingerprints[local_test.key],
+                    )
+        logger.info(
+            f"Synced labels of {len(labels_changes)} tests, "
+            f"{len(labels_changes) - len(per_test_keys)} by bulk edits, "
+            f"{len(failed_keys)} failed"
+        )
         errors = [_.data for _ in worker_results if not _.success]
-        if len(errors) > 0:
+        return WorkerResult(success=not errors, data="\n".join(errors) or None)
+
+    def _confirm_completed_operations(self, journal: SyncJournal):
+        """
+        Re-check the operations completed in the journal against the current xray
+        tests, an operation is only skipped by the resumed sync if its result is
+        still in xray, e.g: the test was not edited or moved by others since.
+        """
+        xray_tests_by_key = self._query_xray_tests_by_keys(journal.completed_keys())
+
+        def _is_confirmed(operation: str, key: Optional[str], fingerprint: str):
+            if operation == WorkerType.ObsoleteTest.name:
+                # obsolete tests are not listed in the automation folder any more
+                return key not in xray_tests_by_key
+            return (
+                key in xray_tests_by_key
+                and test_fingerprint(xray_tests_by_key[key]) == fingerprint
+            )
+
+        journal.retain_completed(_is_confirmed)
+
+    def _sync_local_test(
+        self,
+        local_test: TestEntity,
+        xray_tests_by_key: Dict[Optional[str], TestEntity],
+        journal: Optional[SyncJournal] = None,
+        labels_keys: Optional[Set[Optional[str]]] = None,
+    ) -> WorkerResult:
+        if labels_keys is not None and local_test.key in labels_keys:
+            # synced by the bulk label edits
+            return WorkerResult(success=True, data=None)
+        worker_type = self._get_sync_worker_type(
+            local_test, xray_tests_by_key.get(local_test.key)
+        )
+        if worker_type is None:
+            return WorkerResult(success=True, data=None)
+        return self._run_test_worker(worker_type, local_test, journal)
+
+    def _run_test_worker(
+        self,
+        worker_type: WorkerType,
+        test: TestEntity,
+        journal: Optional[SyncJournal] = None,
+    ) -> WorkerResult:
+        if journal is None:
+            return self.worker_mgr.run_worker(worker_type, test)
+        operation = worker_type.name
+        # fingerprint before running, workers could modify the test entity
+        fingerprint = test_fingerprint(test)
+        if journal.is_completed(operation, test.key, fingerprint):
+            logger.info(f"Skip {operation} of {test.key} completed in journal")
+            return WorkerResult(success=True, data=None)
+        result = self.worker_mgr.run_worker(worker_type, test)
+        if result.success:
+            journal.record_completed(operation, test.key, fingerprint)
+        return result
+
+    def _obsolete_xray_tests(
+        self, to_be_obsolete_xray_tests: List[TestEntity]
+    ) -> List[WorkerResult]:
+        if not to_be_obsolete_xray_tests:
+            return []
+        worker_results = self.worker_mgr.start_worker(
+            WorkerType.ObsoleteTest, to_be_obsolete_xray_tests
+        )
+        self.context.test_index.remove_tests(
+            [
+                test.key
+                for test, result in zip(to_be_obsolete_xray_tests, worker_results)
+                if result.success and test.key is not None
+            ]
+        )
+        return worker_results
+
+    def _check_sync_results(
+        self, worker_results: List[WorkerResult], extra_succeeded: int = 0
+    ):
+        """
+        :param extra_succeeded: int, succeeded operations not in the worker results
+        """
+        failed = [_ for _ in worker_results if not _.success]
+        if len(failed) > 0:
+            # the remote state is partially updated, query it again next time
+            self.context.test_index.invalidate()
+            self.context.invalidate_metadata_cache()
+            cancelled = [_.data for _ in failed if _.cancelled]
+            errors = [_.data for _ in failed if not _.cancelled]
             err_msg = ""
             for idx, err in enumerate(errors):
                 err_msg = f"{err_msg}\n({idx + 1}) {err}"
-            raise AssertionError(f"Sync failed with the following errors:\n{err_msg}.")
+            if cancelled:
+                err_msg = f"{err_msg}\n{len(cancelled)} operations did not run, e.g: {cancelled[0]}"
+            succeeded = (
+                len(worker_results) - len(errors) - len(cancelled) + extra_succeeded
+            )
+            raise AssertionError(
+                f"Sync failed with the following errors, {succeeded} operations succeeded:\n{err_msg}."
+            )
+
+    def _clean_empty_repo_folders(self):
+        """
+        Delete the empty folders level by level from the deepest, so a parent is
+        only deleted once all its empty sub folders are gone.
+        """
         logger.info("Start cleaning empty repo folders")
-        self.worker_mgr.start_worker(
-            WorkerType.CleanRepoFolder,
-            self.worker_mgr.api_wrapper.get_all_empty_folders(),
+        api_wrapper = self.worker_mgr.api_wrapper
+        failed_paths: List[str] = []
+        for paths in api_wrapper.get_empty_folders():
+            # parents of an undeleted folder are not empty
+            paths = [
+                path
+                for path in paths
+                if not any(_.startswith(f"{path}/") for _ in failed_paths)
+            ]
+            batches = [
+                paths[i : i + MAX_FOLDERS_PER_DELETE_BATCH]
+                for i in range(0, len(paths), MAX_FOLDERS_PER_DELETE_BATCH)
+            ]
+            worker_results = self.worker_mgr.start_worker(
+                WorkerType.CleanRepoFolder, batches
+            )
+            for batch, result in zip(batches, worker_results):
+                if not result.success:
+                    logger.warning(f"Failed to delete empty folders: {result.data}")
+                    failed_paths.extend(batch)
+        # folders are changed, query them again next time
+        api_wrapper.folder_model = None
+        api_wrapper.refresh_all_folders()
+
+    def create_sync_snapshot(self, snapshot_path: str):
+        """
+        Dump the xray tests into a snapshot file shared by the sync shards.
+        :param snapshot_path: str, path of the snapshot file
+        """
+        dump_tests(
+            snapshot_path,
+            self.context.project_key,
+            self.get_xray_tests(use_index=False),
         )
 
-    @staticmethod
-    def _get_internal_marked_tests_diff(
-        filtered_xray_tests: List[TestEntity],
-        internal_marked_local_tests: List[TestEntity],
+    def sync_tests_shard(
+        self,
+        local_tests: List[TestEntity],
+        shard_index: int,
+        shard_count: int,
+        manifest_path: str,
+        snapshot_path: Optional[str] = None,
+        partition_by: str = PARTITION_BY_KEY,
     ):
-        to_be_updated = list()
-        assert len(filtered_xray_tests) == len(internal_marked_local_tests), (
-            "Internal marked test num is incorrect."
+        """
+        Create and update the local tests of one shard, tests are never obsoleted
+        here, run `merge_sync_shards` with the manifests of all shards afterward.
+        :param local_tests: all local tests or only the tests of this shard, tests of
+        other shards are skipped
+        :param shard_index: int, index of this shard, starting from 0
+        :param shard_count: int, total number of shards
+        :param manifest_path: str, path to write the shard manifest to
+        :param snapshot_path: str, snapshot created by `create_sync_snapshot`, the
+        xray tests are queried by this shard if not specified
+        :param partition_by: str, "key" to partition by the key hash, "repo_path"
+        to keep each top level repo folder in one shard
+        """
+        assert 0 <= shard_index < shard_count, (
+            f"Shard index {shard_index} is out of range of {shard_count} shards"
         )
+        shard_tests = partition_tests(local_tests, shard_count, partition_by)[
+            shard_index
+        ]
+        logger.info(
+            f"Start syncing shard {shard_index + 1}/{shard_count} with {len(shard_tests)} tests"
+        )
+        self.context.retrier.budget.reset()
+        self._prepare_local_tests_for_sync(shard_tests)
+        worker_results, synced_tests = self._run_sync_tasks(
+            shard_tests, snapshot_path=snapshot_path, obsolete=False
+        )
+        write_shard_manifest(
+            manifest_path,
+            self.context.project_key,
+            shard_index,
+            shard_count,
+            partition_by,
+            [_.key for _ in shard_tests if _.key is not None],
+            [_.data for _ in worker_results if not _.success],
+        )
+        self._check_sync_results(worker_results)
+        self.context.test_index.upsert_tests(synced_tests)
 
-        def get_matched_xray_test(key):
-            matched_tests = [t for t in filtered_xray_tests if t.key == key]
-            assert len(matched_tests) == 1, "Exact one match test is expected"
-            return matched_tests[0]
-
-        for local_test in internal_marked_local_tests:
-            if local_test != get_matched_xray_test(local_test.key):
-                to_be_updated.append(local_test)
+    def merge_sync_shards(self, manifest_paths: List[str]):
+        """
+        Obsolete the xray tests missing from all the shards and clean the empty
+        repo folders.
+        :param manifest_paths: manifests written by `sync_tests_shard` of all shards
+        """
+        self.context.retrier.budget.reset()
+        manifests = read_shard_manifests(manifest_paths, self.context.project_key)
+        local_tests_keys = set()
+        shard_errors = []
+        for manifest in manifests:
+            local_tests_keys.update(manifest["keys"])
+            shard_errors.extend(manifest["errors"])
+        xray_tests = self.get_xray_tests(use_index=False)
+        self.worker_mgr.api_wrapper.start_folder_model().track_tests(
+            xray_tests, f"/{self.config.automation_folder_name}"
+        )
+        to_be_obsolete_xray_tests = [
+            _ for _ in xray_tests if _.key not in local_tests_keys
+        ]
+        worker_results = self._obsolete_xray_tests(to_be_obsolete_xray_tests)
+        worker_results.extend(
+            WorkerResult(success=False, data=f"Shard error: {_}") for _ in shard_errors
+        )
+        self._check_sync_results(worker_results)
+        self._clean_empty_repo_folders()
 
-        return to_be_updated
+    def _sync_tests_membership(
+        self,
+        key: str,
+        test_key_and_ids: List[Tuple[str, Optional[str]]],
+        clean_obsolete: bool,
+        is_test_plan: bool,
+    ) -> WorkerResult:
+        """
+        Fetch the tests of the test plan/execution once, then only add the missing
+        tests and remove the obsolete ones, in parallel size bounded chunks.
 
-    def _clean_test_execution(self, test_execution_key: str):
-        logger.info(f"Start cleaning test execution {test_execution_key}")
-        test_execution_tests = (
-            self.worker_mgr.api_wrapper.get_tests_from_test_execution(
-                test_execution_key
+        :param key: str, test plan or test execution key
+        :param test_key_and_ids: tests the test plan/execution should contain
+        :param clean_obsolete: bool, remove the non-finalized tests
+        :param is_test_plan: bool, whether the key is a test plan key
+        """
+        api_wrapper = self.worker_mgr.api_wrapper
+        if is_test_plan:
+            members = api_wrapper.get_tests_from_test_plan(key)
+            add_worker, remove_worker = (
+                WorkerType.AddTestsToPlan,
+                WorkerType.CleanTestPlan,
             )
+        else:
+            members = api_wrapper.get_tests_from_test_execution(key)
+            add_worker, remove_worker = (
+                WorkerType.AddTestsToExecution,
+                WorkerType.CleanTestExecution,
+            )
+        member_ids = {_["issueId"] for _ in members}
+        to_be_removed = (
+            [
+                _["issueId"]
+                for _ in members
+                if _["jira"]["status"]["name"] != "Finalized"
+            ]
+            if clean_obsolete
+            else []
         )
-
-        # delete obsolete tests from test execution
-        self.worker_mgr.start_worker(
-            WorkerType.CleanTestExecution,
-            [test_execution_key],
-            [test_execution_tests],
-        )
-
-    def _clean_test_plan(self, test_plan_key: str):
-        logger.info(f"Start cleaning test plan: {test_plan_key}")
-        test_plan_tests = self.worker_mgr.api_wrapper.get_tests_from_test_plan(
-            test_plan_key
+        missing_issue_ids = api_wrapper.get_issue_ids_by_keys(
+            [test_key for test_key, issue_id in test_key_and_ids if issue_id is None]
         )
-        # delete obsolete tests from test plan
-        self.worker_mgr.start_worker(
-            WorkerType.CleanTestPlan,
-            [test_plan_key],
-            [test_plan_tests],
+        to_be_added = []
+        for test_key, issue_id in test_key_and_ids:
+            if issue_id is None:
+                issue_id = missing_issue_ids.get(test_key)
+            if issue_id is None:
+                # missing from jira, its result is still imported
+                logger.warning(f"Skip adding missing test {test_key} to {key}")
+                continue
+            if issue_id not in member_ids:
+                member_ids.add(issue_id)
+                to_be_added.append(issue_id)
+        logger.info(
+            f"Start syncing tests of {key}: {len(to_be_added)} to add, "
+            f"{len(to_be_removed)} to remove, {len(members)} existing"
         )
 
+        def chunks(xs, n=MAX_TESTS_PER_MUTATION):
+            return list(xs[i : i + n] for i in range(0, len(xs), n))
+
+        results = []
+        for worker_type, issue_ids in [
+            (add_worker, to_be_added),
+            (remove_worker, to_be_removed),
+        ]:
+            issue_ids_chunks = chunks(issue_ids)
+            results.extend(
+                self.worker_mgr.start_worker(
+                    worker_type, [key] * len(issue_ids_chunks), issue_ids_chunks
+                )
+            )
+        errors = [str(_.data) for _ in results if not _.success]
+        if errors:
+            return WorkerResult(success=False, data="\n".join(errors))
+        return WorkerResult(success=True, data=None)
+
     def _update_test_plan_execution_status(self, key):
         for status in ["In Progress", "Executed"]:
             try:
@@ -301,6 +1158,40 @@ class XrayBot:
                 # ignore errors from any status
                 logger.debug(f"Update test plan/execution status with error: {e}")
 
+    def _attach_evidences(
+        self, test_execution_key: str, test_results: List[TestResultEntity]
+    ) -> List[WorkerResult]:
+        evidences = [(r.key, path) for r in test_results for path in r.evidences]
+        if not evidences:
+            return []
+        logger.info(
+            f"Start attaching {len(evidences)} evidences to test execution: {test_execution_key}"
+        )
+        budget = self.worker_mgr.api_wrapper.attachment_budget
+
+        def _attach(test_key: str, path: str) -> WorkerResult:
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                return WorkerResult(success=False, data=f"❌{e} -> 🐛{path}")
+            # reserved before running the worker, an upload waiting for the byte
+            # budget never holds a concurrency slot
+            with budget.reserve(size):
+                return self.worker_mgr.run_worker(
+                    WorkerType.AttachEvidence, test_execution_key, test_key, path
+                )
+
+        # a dedicated pool, the uploads waiting for the byte budget never hold
+        # the shared threads the membership and import steps need
+        with ThreadPoolExecutor(
+            budget.max_concurrency, thread_name_prefix="xraybot-evidence"
+        ) as executor:
+            return list(
+                executor.map(
+                    _attach, [_[0] for _ in evidences], [_[1] for _ in evidences]
+                )
+            )
+
     def upload_test_results_by_key(
         self,
         test_execution_key: str,
@@ -310,56 +1201,116 @@ class XrayBot:
         full_test_set: bool = False,
         ignore_missing: bool = False,
     ):
-        xray_tests = self.get_xray_tests()
-        xray_tests_keys = [t.key for t in xray_tests]
-        if not ignore_missing:
-            for result in test_results:
-                assert result.key in xray_tests_keys, (
-                    f"Unrecognized test {result.key} from test results"
-                )
+        """
+        The steps run as a dependency graph, the test plan steps run along the
+        test execution steps and the results are imported once the test execution
+        contains the tests.
+        """
+        self.context.retrier.budget.reset()
+        scheduler = DependencyScheduler(self.context.executor)
+        test_key_and_ids: List[Tuple[str, Optional[str]]] = []
 
-        if full_test_set:
-            test_key_and_ids = [(t.key, t.issue_id) for t in xray_tests]
-        else:
-            test_key_and_ids = []
-            for result in test_results:
-                matched_xray_test = [t for t in xray_tests if t.key == result.key]
-                if matched_xray_test:
-                    issue_id = matched_xray_test[0].issue_id
-                else:
-                    issue_id = None
-                test_key_and_ids.append((result.key, issue_id))
+        def _get_test_key_and_ids():
+            xray_tests = self.get_xray_tests()
+            xray_tests_issue_ids = {t.key: t.issue_id for t in xray_tests}
+            if not ignore_missing:
+                for result in test_results:
+                    assert result.key in xray_tests_issue_ids, (
+                        f"Unrecognized test {result.key} from test results"
+                    )
+            if full_test_set:
+                test_key_and_ids.extend(
+                    (t.key, t.issue_id) for t in xray_tests if t.key is not None
+                )
+            else:
+                # tests missing from the xray tests are looked up once for both
+                # the test execution and the test plan
+                missing_issue_ids = self.worker_mgr.api_wrapper.get_issue_ids_by_keys(
+                    [_.key for _ in test_results if _.key not in xray_tests_issue_ids]
+                )
+                test_key_and_ids.extend(
+                    (
+                        result.key,
+                        xray_tests_issue_ids.get(result.key)
+                        or missing_issue_ids.get(result.key),
+                    )
+                    for result in test_results
+                )
 
-        self.worker_mgr.start_worker(
-            WorkerType.AddTestsToExecution,
-            [test_execution_key],
-            [test_key_and_ids],
+        # failures of these steps are raised, as they were before the graph
+        raising_tasks = ["xray_tests"]
+        scheduler.add("xray_tests", _get_test_key_and_ids)
+        # evidences are only attached to the test execution, upload them along
+        scheduler.add(
+            "evidences",
+            partial(self._attach_evidences, test_execution_key, test_results),
+        )
+        scheduler.add(
+            "execution:tests",
+            lambda: self._sync_tests_membership(
+                test_execution_key, test_key_and_ids, clean_obsolete, False
+            ),
+            ["xray_tests"],
+        )
+        scheduler.add(
+            "execution:status",
+            partial(self._update_test_plan_execution_status, test_execution_key),
+            after=["execution:tests"],
         )
-        self._update_test_plan_execution_status(test_execution_key)
         if clean_obsolete:
-            self._clean_test_execution(test_execution_key)
-
+            raising_tasks.append("execution:tests")
+        # the import adds the missing tests by itself, it runs even if adding the
+        # tests failed
+        scheduler.add(
+            "execution:import_results",
+            partial(
+                self.worker_mgr.run_worker,
+                WorkerType.UpdateTestResults,
+                test_execution_key,
+                test_results,
+            ),
+            ["xray_tests"],
+            after=["execution:tests"],
+        )
+        raising_tasks.append("execution:import_results")
         if test_plan_key:
-            self.worker_mgr.start_worker(
-                WorkerType.AddTestsToPlan,
-                [test_plan_key],
-                [test_key_and_ids],
+            scheduler.add(
+                "plan:tests",
+                lambda: self._sync_tests_membership(
+                    test_plan_key, test_key_and_ids, clean_obsolete, True
+                ),
+                ["xray_tests"],
             )
-            self._update_test_plan_execution_status(test_plan_key)
-            if clean_obsolete:
-                self._clean_test_plan(test_plan_key)
-
-            logger.info(
-                f"Start adding test execution {test_execution_key} to test plan {test_plan_key}"
+            scheduler.add(
+                "plan:status",
+                partial(self._update_test_plan_execution_status, test_plan_key),
+                after=["plan:tests"],
             )
-            self.worker_mgr.api_wrapper.add_test_execution_to_test_plan(
-                test_plan_key, test_execution_key
+            if clean_obsolete:
+                raising_tasks.append("plan:tests")
+            scheduler.add(
+                "plan:add_execution",
+                partial(
+                    self.worker_mgr.api_wrapper.add_test_execution_to_test_plan,
+                    test_plan_key,
+                    test_execution_key,
+                ),
+                after=["plan:tests"],
             )
+            raising_tasks.append("plan:add_execution")
+        results = scheduler.run()
 
-        # update test execution result
-        self.worker_mgr.start_worker(
-            WorkerType.UpdateTestResults, [test_execution_key], [test_results]
-        )
+        if results["evidences"].success:
+            for evidence_result in results["evidences"].data:
+                if not evidence_result.success:
+                    logger.error(f"Attach evidence failed: {evidence_result.data}")
+        if not all(_.success for _ in results.values()):
+            # a cached key or issue id could be outdated, query them again next time
+            self.context.invalidate_metadata_cache()
+        errors = [str(results[_].data) for _ in raising_tasks if not results[_].success]
+        if errors:
+            err_msg = "\n".join(errors)
+            raise AssertionError(f"Upload test results failed:\n{err_msg}")
 
     def upload_test_results(
         self,